@@ -1,596 +1,1613 @@
-from pathlib import Path
-import os
-from typing import List, Dict, Tuple, Union, Optional, AnyStr, Iterable, Mapping, Container, Sequence, Hashable, Type, Generator
-import json
-from io import StringIO
-import pyttsx3
-import pydub
-import pydub.playback
-from threading import Lock
-import random
-import time
-from queue import Queue
-from threading import Event
-
-
-def load(dir: str | Path, map:AnyStr | Mapping | Path | None = None, suffixs: List[str] | None = None) -> Dict[str, Path]:
-    path = Path(dir)
-    files = [file for file in path.rglob("*") if file.is_file()]
-    if isinstance(map, dict):
-        pass
-    elif isinstance(map, str | Path):
-        map = Path(map)
-        with open(map, 'r', encoding="utf8") as f:
-            map = json.load(f)
-    else:
-        map = {}
-    assert isinstance(map, Mapping), "map must be a Mapping"
-    data = {}
-    if suffixs is None:
-        suffixs = [".wav", ".mp3", ".flac", ".m4a"]
-    for file in files:
-        if file.is_file() and file.suffix in suffixs:
-            if file.name in map:
-                name = map[file.name]
-            elif file.stem in map:
-                name = map[file.stem]
-            else:
-                name = file.stem
-            
-            if isinstance(name, str):
-                data[name] = file
-            elif isinstance(name, Iterable):
-                for n in name:
-                    data[n] = file
-            else:
-                data[str(name)] = file
-    return data
-
-class PTrie:
-    "Trie mainly deals with prefixes"
-    def __init__(self, seqs: Iterable[Sequence[Hashable]], seqtype = None):
-        self.table:Dict[Hashable, PTrie] = {}
-        self.seqtype:Type = seqtype
-        self.is_seq_end = False
-        for seq in seqs:
-            if self.seqtype is None:
-                self.seqtype = type(seq)
-            self.add(seq)
-        if self.seqtype is None:
-            self.seqtype = list
-    
-    def add(self, seq: Sequence[Hashable]):
-        "Adds a sequence to the trie"
-        if not seq:
-            self.is_seq_end = True
-            return
-        w = seq[0]
-        _w = seq[1:]
-        if w in self.table:
-            if _w:
-                self.table[w].add(_w)
-        else:
-            self.table[w] = PTrie([_w], seqtype=self.seqtype)
-    
-    def walk(self, seq: Sequence[Hashable]) -> Generator[Sequence[Hashable], None, None]:
-        "Iterate over all sequence in the trie that start with seq"
-        subtree = self[seq]
-        for subseq in subtree:
-            yield seq + subseq
-    
-    def final(self, seq: Sequence[Hashable]) -> bool:
-        "Whether there are no longer sequences starting with seq"
-        subtree = self[seq]
-        return subtree.is_seq_end and not subtree.table
-    
-    def longest(self, seq: Sequence[Hashable], is_seq_end=True) -> Sequence[Hashable] | None:
-        "The longest sequence that can serve as the beginning of a seq"
-        if not seq:
-            return self.seqtype() if (self.is_seq_end or not is_seq_end) else None
-        
-        current = self
-        if self.seqtype == str:
-            result = []
-        else:
-            result = self.seqtype()
-        last_valid = None
-        length = 0
-        for item in seq:
-            if item not in current.table:
-                break
-            current = current.table[item]
-            if self.seqtype == str:
-                result.append(item)
-            else:
-                if hasattr(result, "append"):
-                    result.append(item)
-                elif hasattr(result, "__add__"):
-                    result += self.seqtype(item)
-                else:
-                    raise TypeError("Unsupport type")
-            length += 1
-            if current.is_seq_end:
-                last_valid = length
-        if self.seqtype == str:
-            result = "".join(result)
-
-        if is_seq_end:
-            if last_valid is None:
-                return None
-            else:
-                return result[:last_valid]
-        else:
-            return result if result else None
-    
-    def index(self, seq: Sequence[Hashable]) -> int | None:
-        "Find the index of the first sequence in the sequence that exists within itself"
-        for i in range(len(seq)):
-            current = self
-            for j in range(i, len(seq)):
-                if seq[j] not in current.table:
-                    break
-                current = current.table[seq[j]]
-                if current.is_seq_end:
-                    return i
-        return None
-
-    
-    def is_prefix(self, seq):
-        if not seq:
-            return True
-        w = seq[0]
-        _w = seq[1:]
-        if w in self.table:
-            return self.table[w].is_prefix(_w)
-        else:
-            return False
-    
-    def __repr__(self):
-        return str([i for i in self.__iter__()])
-
-    def __contains__(self, seq: Sequence[Hashable]):
-        if not seq and self.is_seq_end:
-            return True
-        w = seq[0]
-        _w = seq[1:]
-        if w in self.table:
-            return _w in self.table[w]
-        else:
-            return False
-    
-    def __iter__(self):
-        for w, sub_trie in self.table.items():
-            if sub_trie.is_seq_end:
-                yield self.seqtype([w])
-            
-            for subseq in sub_trie:
-                yield self.seqtype([w]) + subseq
-    
-    def __len__(self):
-        return len([i for i in self.__iter__()])
-    
-    def __getitem__(self, seq: Sequence[Hashable]):
-        if not seq:
-            return self
-        w = seq[0]
-        _w = seq[1:]
-        if w in self.table:
-            return self.table[w][_w]
-        else:
-            raise KeyError(seq)
-
-    def __bool__(self):
-        return bool(self.table)
-
-
-class Stream:
-    def __init__(self, queue: Queue, stop_sign = StopIteration):
-        self.queue = queue
-        self.stop_sign = stop_sign
-    
-    def __iter__(self) -> Generator:
-        while True:
-            try:
-                data = self.queue.get()
-                if data == self.stop_sign:
-                    break
-                yield data
-            except GeneratorExit:
-                break
-
-
-
-def split(string:str, words:Iterable[str], ptrie = None) -> Generator[str, None, None] | List[str]:
-    """Split a string into words and non-words"""
-    if not words:
-        yield string
-        return
-    if ptrie is None:
-        ptrie = PTrie(words)
-    current = StringIO()
-    i = 0
-    n = len(string)
-    while i < n:
-        longest_match = ptrie.longest(string[i:])
-        if longest_match:
-            if current.tell():
-                yield current.getvalue()
-                current = StringIO()
-            yield longest_match # type: ignore
-            i += len(longest_match)
-        else:
-            current.write(string[i])
-            i += 1
-    if current.tell():
-        yield current.getvalue()
-
-def _split(string, words:Iterable[str]):
-    "Simple and error free"
-    if not words:
-        yield string
-        return
-    max_len = max(len(w) for w in words)
-    current = StringIO()
-    last = 0
-    for s in range(len(string)):
-        if s < last:
-            continue
-        for e in range(min(s+max_len, len(string)), s, -1):
-            # prioritize matching the longest word
-            if string[s:e] in words:
-                if current.tell():
-                    yield current.getvalue()
-                    current = StringIO()
-                last = e
-                yield string[s:e]
-                break
-        else:
-            current.write(string[s])
-    if current.tell():
-        yield current.getvalue()
-
-
-
-
-def split_stream(stream: Iterable[str], words: Iterable[str], sep = None, ptrie = None) -> Generator[str, None, None]:
-    """Split a strem into words and non-words"""
-    def single_char(stream: Iterable[str]):
-        for string in stream:
-            if len(string) == 1:
-                yield string
-            else:
-                for char in string:
-                    yield char
-    words_set = set(words)
-    if not words_set:
-        current = StringIO()
-        for char in single_char(stream):
-            if char == sep:
-                yield current.getvalue()
-                current = StringIO()
-            else:
-                current.write(char)
-        if current.tell():
-            yield current.getvalue()
-        return
-    
-        
-    max_len = max(len(word) for word in words_set)
-    starts = {word[0] for word in words_set if word}
-    if ptrie is None:
-        prefix_tree = PTrie(words_set)
-    else:
-        prefix_tree = ptrie
-    
-    current = StringIO()
-    buffer = []
-    for char in single_char(stream): # iterate over the stream
-        if char == sep:
-            while buffer:
-                longest_match = prefix_tree.longest(buffer)
-                if longest_match is not None:
-                    if current.tell():
-                        yield current.getvalue()
-                        current = StringIO()
-                    yield longest_match # type: ignore
-                    buffer = buffer[len(longest_match):]
-                else:
-                    current.write(buffer.pop(0))
-            if current.tell():
-                yield current.getvalue()
-                current = StringIO()
-            continue
-        buffer.append(char)
-        index = prefix_tree.index(buffer) # find the index of the possible word
-        # print(buffer, index)
-        if index is not None:
-            for i in range(index):
-                # print(2)
-                current.write(buffer.pop(0))
-            if current.tell():
-                yield current.getvalue()
-                current = StringIO()
-        if buffer and buffer[0] in starts: # possible start
-            s = ''.join(buffer)
-            if len(s) < max_len: # is buffer is too long?
-                if prefix_tree.is_prefix(s) and not prefix_tree.final(s):
-                    continue # longer word may appear
-                else:
-                    longest_match = prefix_tree.longest(s)
-                    if longest_match is not None:
-                        if current.tell():
-                            yield current.getvalue()
-                        yield longest_match # type: ignore
-                        current = StringIO()
-                        buffer = buffer[len(longest_match):]
-                    else:
-                        current.write(buffer.pop(0))
-            else:
-                longest_match = prefix_tree.longest(s)
-                if longest_match is not None:
-                    if current.tell():
-                        yield current.getvalue()
-                    yield longest_match # type: ignore
-                    current = StringIO()
-                    buffer = buffer[len(longest_match):]
-                else:
-                    current.write(buffer.pop(0))
-        else:
-            current.write(buffer.pop(0))
-
-    while buffer:
-        longest_match = prefix_tree.longest(buffer)
-        if longest_match is not None:
-            if current.tell():
-                yield current.getvalue()
-            yield longest_match # type: ignore
-            current = StringIO()
-            buffer = buffer[len(longest_match):]
-        else:
-            current.write(buffer.pop(0))
-    if current.tell():
-        yield current.getvalue()
-
-
-def _split_stream(stream: Iterable[str], words: Iterable[str]):
-    "Simple and error free"
-    words_set = set(words)
-    if not words_set:
-        current = StringIO()
-        for char in stream:
-            current.write(char)
-        yield current.getvalue()
-        return
-    
-    def single_char(stream: Iterable[str]):
-        for string in stream:
-            if len(string) == 1:
-                yield string
-            else:
-                for char in string:
-                    yield char
-        
-    max_len = max(len(word) for word in words_set)
-    starts = {word[0] for word in words_set if word}
-    
-    ptrie = PTrie(words_set)
-    
-    current = StringIO()
-    buffer = []
-    for char in single_char(stream):
-        buffer.append(char)
-        if buffer and buffer[0] in starts:
-            s = ''.join(buffer)
-            if len(s) < max_len:
-                if ptrie.is_prefix(s):
-                    continue
-                else:
-                    found = None
-                    for e in range(len(s), 0, -1):
-                        candidate = s[:e]
-                        if candidate in words_set:
-                            found = e
-                            break
-                    if found is not None:
-                        if current.tell():
-                            yield current.getvalue()
-                        yield candidate
-                        current = StringIO()
-                        buffer = buffer[found:]
-                    else:
-                        current.write(buffer.pop(0))
-            else:
-                found = None
-                for e in range(min(len(buffer), max_len), 0, -1):
-                    candidate = ''.join(buffer[:e])
-                    if candidate in words_set:
-                        found = e
-                        break
-                if found is not None:
-                    if current.tell():
-                        yield current.getvalue()
-                    yield candidate
-                    current = StringIO()
-                    buffer = buffer[found:]
-                else:
-                    current.write(buffer.pop(0))
-        else:
-            if buffer:
-                current.write(buffer.pop(0))
-                
-    while buffer:
-        if buffer and buffer[0] in starts:
-            s = ''.join(buffer)
-            if len(s) < max_len:
-                if ptrie.is_prefix(s):
-                    found = None
-                    for e in range(min(len(buffer), max_len), 0, -1):
-                        candidate = ''.join(buffer[:e])
-                        if candidate in words_set:
-                            found = e
-                            break
-                    if found is not None:
-                        if current.tell():
-                            yield current.getvalue()
-                        yield candidate
-                        current = StringIO()
-                        buffer = buffer[found:]
-                    else:
-                        current.write(buffer.pop(0))
-                else:
-                    found = None
-                    for e in range(len(s), 0, -1):
-                        candidate = s[:e]
-                        if candidate in words_set:
-                            found = e
-                            break
-                    if found is not None:
-                        if current.tell():
-                            yield current.getvalue()
-                        yield candidate
-                        current = StringIO()
-                        buffer = buffer[found:]
-                    else:
-                        current.write(buffer.pop(0))
-            else:
-                found = None
-                for e in range(min(len(buffer), max_len), 0, -1):
-                    candidate = ''.join(buffer[:e])
-                    if candidate in words_set:
-                        found = e
-                        break
-                if found is not None:
-                    if current.tell():
-                        yield current.getvalue()
-                    yield candidate
-                    current = StringIO()
-                    buffer = buffer[found:]
-                else:
-                    current.write(buffer.pop(0))
-        else:
-            current.write(buffer.pop(0))
-            
-    content = current.getvalue()
-    if content:
-        yield content
-
-
-def speak(texts: Iterable[str], data: dict):
-    if type(texts) != str:
-        for word in texts:
-            if word in data:
-                obj = pydub.AudioSegment.from_file(data[word])
-                pydub.playback.play(obj)
-            else:
-                os.system("powershell -Command \"Add-Type –AssemblyName System.Speech; (New-Object System.Speech.Synthesis.SpeechSynthesizer).Speak('%s')\""%word.replace("'", '"'))
-    else:
-        if texts in data:
-            obj = pydub.AudioSegment.from_file(data[texts])
-            pydub.playback.play(obj)
-        else:
-            os.system("powershell -Command \"Add-Type –AssemblyName System.Speech; (New-Object System.Speech.Synthesis.SpeechSynthesizer).Speak('%s')\""%texts.replace("'", '"'))
-
-def main():
-    data = load("./audios", "./name.json")
-
-    # print([i for i in data])
-    while True:
-        words = [i for i in _split(input(">>> "), data)]
-        print(words)
-        speak(words, data=data)
-
-
-def stream_test():
-    data = load("./audios", "./name.json")
-    def _stream_ouput(words: Iterable[str]):
-        for word in words:
-            print(word)
-            speak(word, data=data)
-    def _stream_input():
-        while True:
-            try:
-                yield input(">>> ")
-            except EOFError:
-                break
-            except KeyboardInterrupt:
-                break
-            except GeneratorExit:
-                break
-    while True:
-        _stream_ouput(split_stream(_stream_input(), data, sep="\\"))
-
-def random_data(data_size, min_l, max_l, word_count, ratio = 0.1):
-    words = set()
-    for i in range(word_count):
-        word = StringIO()
-        for j in range(random.randint(min_l, max_l + 1)):
-            word.write(str(random.randint(0, 10)))
-        words.add(word.getvalue())
-    words_ = list(words)
-    data = StringIO()
-    i = 0
-    while i < data_size:
-        if random.random() < (ratio / (min_l + max_l) * 2):
-            w = random.choice(words_)
-            data.write(w)
-            i += len(w)
-            continue
-        data.write(str(random.randint(0, 10)))
-        i += 1
-    data = data.getvalue()
-    return data, words
-
-def _time(func, args = [], kwargs = {}):
-    t1 = time.time()
-    result = len([i for i in func(*args, **kwargs)])
-    t2 = time.time()
-    return result, t2 - t1
-
-
-# if __name__ == "__main__":
-#     data, words = random_data(1e6, 5, 20, 256)
-#     funcs = [_split_stream, split_stream]
-#     times = [0. for _ in funcs]
-#     for _ in range(10):
-#         for i in range(len(funcs)):
-#             r, t = _time(funcs[i], args=(data, words))
-#             times[i] += t / 10
-#     print(times)
-#     while True:
-#         exec(input(">>> "))
-
-if __name__ == "__main__":
-    # ptrie = PTrie(["a", "ab"])
-    # print(ptrie.index("a"))
-    # main()
-    stream_test()
-    
-
-# def aaa(s:str):
-#     d:set[str] = set()
-#     d.add(s)
-#     d.add(s.lower())
-#     d.add(s.upper())
-#     d.add(s.title())
-#     d.add(s[0].upper() + s[1:].lower())
-#     a = d.copy()
-#     d.update({x.replace(" ","") for x in a})
-#     return list(d)
-
-# print(json.dumps(aaa("Never Gonna Tell a Lie And Hurt You"), ensure_ascii=False, indent=4))
-
-
-# if __name__ == "__main__":
-#     print([i for i in split_stream("""```
-# 庭院深深深几许，
-# 杨柳堆烟，帘幕无重数。
-# 玉勒雕鞍游冶处，
-# 楼高不见章台路。
-
-# 雨横风狂三月暮，
-# 门掩黄昏，无计留春住。
-# 泪眼问花花不语，
-# 乱红飞过秋千去。
-# ```
-
+from pathlib import Path
+import os
+from typing import List, Dict, Tuple, Union, Optional, AnyStr, Iterable, Mapping, Container, Sequence, Hashable, Type, Generator, Iterator
+import json
+from io import StringIO
+from threading import Lock, Thread
+import random
+import time
+from queue import Queue
+from threading import Event
+from array import array
+from bisect import bisect_left
+import struct
+import sys
+import re
+from heapq import heappush, heappop
+import hashlib
+import pickle
+import unicodedata
+
+
+class Normalizer:
+    """Folds text before it is matched: case, full-width forms, whitespace and equivalence classes,
+    every character of a class is matched as the first one. Applied to the lexicon and to the input,
+    map() remembers where each folded character came from so segments can be given back as the original text"""
+    def __init__(self, casefold: bool = True, width: bool = True, whitespace: bool = True, equivalents: Iterable[str] = ()):
+        self.casefold = casefold
+        self.width = width
+        self.whitespace = whitespace
+        self.equivalents = list(equivalents)
+        self.classes: Dict[str, str] = {}
+        for chars in self.equivalents:
+            folded = [self._fold(char) for char in chars]
+            for char in folded:
+                self.classes[char] = folded[0]
+        self.table = _FoldTable(self)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "Normalizer":
+        "From a JSON file with the arguments of Normalizer"
+        with open(path, "r", encoding="utf8") as f:
+            return cls(**json.load(f))
+
+    def _fold(self, char: str) -> str:
+        if self.width:
+            char = unicodedata.normalize("NFKC", char)
+        if self.casefold:
+            char = char.casefold()
+        return char
+
+    def fold(self, char: str) -> str:
+        "What one character is matched as, may be empty, whitespace is empty here and map() puts spaces back between Latin words"
+        if self.whitespace and char.isspace():
+            return ""
+        return "".join(self.classes.get(c, c) for c in self._fold(char))
+
+    def key(self) -> str:
+        return json.dumps([self.casefold, self.width, self.whitespace, self.equivalents], ensure_ascii=False)
+
+    def __call__(self, text: str) -> str:
+        if self.whitespace and _SPACE.search(text):
+            return self.map(text)[0]
+        return text.translate(self.table)
+
+    def map(self, text: str, before: str = "") -> Tuple[str, List[int]]:
+        """Folded text and, for every folded character, the index in text it came from.
+        Whitespace right after an ASCII letter or digit becomes one space so "a new car" does not turn into "anewcar",
+        any other whitespace is dropped, before is the character that came right before text, if any"""
+        table = self.table
+        parts = []
+        offsets = []
+        last = " " if before.isspace() else table[ord(before)][-1:] if before else ""
+        for i, char in enumerate(text):
+            folded = table[ord(char)]
+            if folded:
+                parts.append(folded)
+                offsets += [i] * len(folded)
+                last = folded[-1]
+            elif self.whitespace and char.isspace():
+                if last.isascii() and last.isalnum():
+                    parts.append(" ")
+                    offsets.append(i)
+                last = " "
+        return "".join(parts), offsets
+
+    def restore(self, text: str, offsets: List[int], segments: Iterable[str]) -> Generator[str, None, None]:
+        "The pieces of text that segments of its folded form came from, folded away characters go with the segment after them"
+        start = 0
+        pos = 0
+        for segment in segments:
+            pos += len(segment)
+            end = offsets[pos - 1] + 1
+            if pos < len(offsets):
+                end = min(end, offsets[pos])
+            yield text[start:end]
+            start = end
+        if start < len(text):  # folded away characters at the very end
+            yield text[start:]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["table"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.table = _FoldTable(self)
+
+    def __repr__(self):
+        return "Normalizer(%s)" % self.key()
+
+
+_SPACE = re.compile(r"\s")
+
+
+class _FoldTable(dict):
+    "str.translate table filled in as characters are first seen"
+    def __init__(self, normalizer: Normalizer):
+        super().__init__()
+        self.normalizer = normalizer
+
+    def __missing__(self, code: int) -> str:
+        folded = self[code] = self.normalizer.fold(chr(code))
+        return folded
+
+
+class FoldedDict(dict):
+    "Keyed by folded names, lookups fold the key first so every variant of a name finds the clip"
+    def __init__(self, normalizer: Normalizer, items: Mapping = {}):
+        super().__init__()
+        self.normalizer = normalizer
+        for key, value in items.items():
+            dict.__setitem__(self, normalizer(key), value)
+
+    def __contains__(self, key):
+        return isinstance(key, str) and dict.__contains__(self, self.normalizer(key))
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, self.normalizer(key))
+
+    def get(self, key, default = None):
+        return dict.get(self, self.normalizer(key), default) if isinstance(key, str) else default
+
+
+def load(dir: str | Path, map:AnyStr | Mapping | Path | None = None, suffixs: List[str] | None = None) -> Dict[str, Path]:
+    path = Path(dir)
+    files = [file for file in path.rglob("*") if file.is_file()]
+    if isinstance(map, dict):
+        pass
+    elif isinstance(map, str | Path):
+        map = Path(map)
+        with open(map, 'r', encoding="utf8") as f:
+            map = json.load(f)
+    else:
+        map = {}
+    assert isinstance(map, Mapping), "map must be a Mapping"
+    data = {}
+    if suffixs is None:
+        suffixs = [".wav", ".mp3", ".flac", ".m4a"]
+    for file in files:
+        if file.suffix in suffixs:
+            if file.name in map:
+                name = map[file.name]
+            elif file.stem in map:
+                name = map[file.stem]
+            else:
+                name = file.stem
+            
+            if isinstance(name, str):
+                data[name] = file
+            elif isinstance(name, Iterable):
+                for n in name:
+                    data[n] = file
+            else:
+                data[str(name)] = file
+    return data
+
+
+LEXICON_VERSION = 3
+
+def _lexicon_key(path: Path, map, suffixs: List[str] | None, normalizer: Normalizer | None = None) -> str:
+    h = hashlib.sha1(("%d\0%s\0%s\0%s\0" % (LEXICON_VERSION, path.resolve(), suffixs, normalizer.key() if normalizer else None)).encode("utf8"))
+    if isinstance(map, str | Path):
+        with open(map, "rb") as f:
+            h.update(f.read())
+    elif isinstance(map, Mapping):
+        h.update(json.dumps(map, sort_keys=True, ensure_ascii=False).encode("utf8"))
+    return h.hexdigest()
+
+def _lexicon_cache(path: Path, map, suffixs: List[str] | None, normalizer: Normalizer | None = None) -> Path:
+    """Manifest of one way to load dir, next to it. Callers with another map file, suffixs or normalizer get a file of their own
+    instead of overwriting each other's, editing the map rewrites the same file"""
+    if isinstance(map, str | Path):
+        map = Path(map).resolve()
+    elif isinstance(map, Mapping):
+        map = json.dumps(map, sort_keys=True, ensure_ascii=False)
+    h = hashlib.sha1(("%s\0%s\0%s\0%s" % (path.resolve(), map, suffixs, normalizer.key() if normalizer else None)).encode("utf8"))
+    return path.with_name("%s.%s.lexicon" % (path.name, h.hexdigest()[:12]))
+
+def _dir_stats(dirs: Iterable[str]) -> List[Tuple[str, int, int]] | None:
+    stats = []
+    for d in dirs:
+        try:
+            st = os.stat(d)
+        except OSError:
+            return None
+        stats.append((d, st.st_mtime_ns, st.st_size))
+    return stats
+
+def load_cached(dir: str | Path, map:AnyStr | Mapping | Path | None = None, suffixs: List[str] | None = None, cache: str | Path | None = None,
+                normalizer: Normalizer | str | Path | None = None) -> Tuple[Dict[str, Path], "ACAutomaton"]:
+    """load() plus the compiled matcher, kept in a manifest next to dir and rebuilt only when
+    a directory under dir, the map, the suffixs or the normalizer change.
+    With a normalizer (or the path of its JSON file) names are folded, data is a FoldedDict and the matcher folds its input"""
+    path = Path(dir)
+    if isinstance(normalizer, str | Path):
+        normalizer = Normalizer.load(normalizer)
+    cache = Path(cache) if cache is not None else _lexicon_cache(path, map, suffixs, normalizer)
+    key = _lexicon_key(path, map, suffixs, normalizer)
+    try:
+        with open(cache, "rb") as f:
+            manifest = pickle.load(f)
+        # adding, removing or renaming a file changes the mtime of the directory that holds it
+        if manifest["key"] == key and _dir_stats(d for d, _, _ in manifest["dirs"]) == manifest["dirs"]:
+            data = {name: path / file for name, file in manifest["data"].items()}
+            return (FoldedDict(normalizer, data) if normalizer else data), manifest["matcher"]
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError, AttributeError):
+        pass
+    stats = _dir_stats(_dirs(path))
+    data = load(path, map, suffixs)
+    if normalizer:
+        data = FoldedDict(normalizer, data)
+    matcher = ACAutomaton(data, normalizer)
+    _save_lexicon(cache, key, stats, path, data, matcher)
+    return data, matcher
+
+def _dirs(path: Path) -> List[str]:
+    return [str(path)] + [str(d) for d in path.rglob("*") if d.is_dir()]
+
+def _save_lexicon(cache: Path, key: str, stats, path: Path, data: Dict[str, Path], matcher: "ACAutomaton"):
+    manifest = {
+        "key": key,
+        "dirs": stats,
+        "data": {name: file.relative_to(path) for name, file in data.items()},
+        "matcher": matcher,
+    }
+    try:
+        tmp = cache.with_name(cache.name + ".tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache)
+    except OSError:
+        pass # read-only install, just don't cache
+
+
+class Lexicon:
+    """load_cached() that follows the directory, the map and the normalizer file.
+    current() is one consistent (version, data, matcher), check() or the watch() thread publishes a new one by
+    replacing it whole, so a stream that took the old version finishes with it and the next one gets the new one.
+    Added and removed names are applied to a copy of the matcher instead of rebuilding it"""
+    def __init__(self, dir: str | Path, map:AnyStr | Mapping | Path | None = None, suffixs: List[str] | None = None,
+                 cache: str | Path | None = None, normalizer: Normalizer | str | Path | None = None):
+        self.dir = Path(dir)
+        self.map = map
+        self.suffixs = suffixs
+        self.cache = Path(cache) if cache is not None else None  # None follows the normalizer, see _lexicon_cache
+        self.normalizer_file = normalizer if isinstance(normalizer, str | Path) else None
+        self.normalizer = Normalizer.load(normalizer) if self.normalizer_file else normalizer
+        self.listeners: List = []  # listener(version, data, matcher) after every change, on the thread that found it
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.stamp = self._stamp()
+        data, matcher = load_cached(self.dir, map, suffixs, self.cache, self.normalizer)
+        self._current = (0, data, matcher)
+
+    def current(self) -> Tuple[int, Dict[str, Path], "ACAutomaton"]:
+        return self._current
+
+    def _stamp(self):
+        def stat(file):
+            try:
+                st = os.stat(file)
+            except OSError:
+                return None
+            return st.st_mtime_ns, st.st_size
+        # adding, removing or renaming a file changes the mtime of the directory that holds it
+        return (_dir_stats(_dirs(self.dir)),
+                stat(self.map) if isinstance(self.map, str | Path) else None,
+                stat(self.normalizer_file) if self.normalizer_file else None)
+
+    def check(self) -> bool:
+        "Publish a new version if anything changed since the last one, True if it did"
+        with self.lock:
+            stamp = self._stamp()
+            if stamp == self.stamp:
+                return False
+            version, data, matcher = self._current
+            if stamp[2] != self.stamp[2]:
+                self.normalizer = Normalizer.load(self.normalizer_file)
+                data, matcher = load_cached(self.dir, self.map, self.suffixs, self.cache, self.normalizer)
+            else:
+                new = load(self.dir, self.map, self.suffixs)
+                if self.normalizer:
+                    new = FoldedDict(self.normalizer, new)
+                added = new.keys() - data.keys()
+                removed = data.keys() - new.keys()
+                if len(added) + len(removed) > len(new) // 4:
+                    matcher = ACAutomaton(new, self.normalizer)
+                elif added or removed:
+                    matcher = matcher.copy()
+                    for name in removed:
+                        matcher.remove(name)
+                    for name in added:
+                        matcher.add(name)
+                data = new
+                cache = self.cache if self.cache is not None else _lexicon_cache(self.dir, self.map, self.suffixs, self.normalizer)
+                _save_lexicon(cache, _lexicon_key(self.dir, self.map, self.suffixs, self.normalizer), stamp[0], self.dir, data, matcher)
+            self.stamp = stamp
+            self._current = current = (version + 1, data, matcher)
+        for listener in self.listeners:
+            listener(*current)
+        return True
+
+    def watch(self, interval: float = 1.) -> "Lexicon":
+        "check() every interval seconds on a daemon thread"
+        def run():
+            while not self.stopped.wait(interval):
+                try:
+                    self.check()
+                except Exception:
+                    pass # a map saved halfway, the next poll tries again
+        if self.thread is None:
+            self.thread = Thread(target=run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+class PTrie:
+    "Trie mainly deals with prefixes"
+    def __init__(self, seqs: Iterable[Sequence[Hashable]], seqtype = None):
+        self.table:Dict[Hashable, PTrie] = {}
+        self.seqtype:Type = seqtype
+        self.is_seq_end = False
+        for seq in seqs:
+            if self.seqtype is None:
+                self.seqtype = type(seq)
+            self.add(seq)
+        if self.seqtype is None:
+            self.seqtype = list
+    
+    def add(self, seq: Sequence[Hashable]):
+        "Adds a sequence to the trie"
+        if not seq:
+            self.is_seq_end = True
+            return
+        w = seq[0]
+        _w = seq[1:]
+        if w in self.table:
+            self.table[w].add(_w)
+        else:
+            self.table[w] = PTrie([_w], seqtype=self.seqtype)
+    
+    def walk(self, seq: Sequence[Hashable]) -> Generator[Sequence[Hashable], None, None]:
+        "Iterate over all sequence in the trie that start with seq"
+        subtree = self[seq]
+        for subseq in subtree:
+            yield seq + subseq
+    
+    def final(self, seq: Sequence[Hashable]) -> bool:
+        "Whether there are no longer sequences starting with seq"
+        subtree = self[seq]
+        return subtree.is_seq_end and not subtree.table
+    
+    def longest(self, seq: Sequence[Hashable], is_seq_end=True) -> Sequence[Hashable] | None:
+        "The longest sequence that can serve as the beginning of a seq"
+        if not seq:
+            return self.seqtype() if (self.is_seq_end or not is_seq_end) else None
+        
+        current = self
+        last_valid = None
+        length = 0
+        for item in seq:
+            if item not in current.table:
+                break
+            current = current.table[item]
+            length += 1
+            if current.is_seq_end:
+                last_valid = length
+        if not is_seq_end:
+            last_valid = length or None
+        if last_valid is None:
+            return None
+        # a slice of seq instead of collecting the items one by one
+        result = seq[:last_valid]
+        if type(result) == self.seqtype:
+            return result
+        return "".join(result) if self.seqtype == str else self.seqtype(result)
+    
+    def index(self, seq: Sequence[Hashable]) -> int | None:
+        "Find the index of the first sequence in the sequence that exists within itself"
+        for i in range(len(seq)):
+            current = self
+            for j in range(i, len(seq)):
+                if seq[j] not in current.table:
+                    break
+                current = current.table[seq[j]]
+                if current.is_seq_end:
+                    return i
+        return None
+
+    
+    def is_prefix(self, seq):
+        if not seq:
+            return True
+        w = seq[0]
+        _w = seq[1:]
+        if w in self.table:
+            return self.table[w].is_prefix(_w)
+        else:
+            return False
+    
+    def __repr__(self):
+        return str([i for i in self.__iter__()])
+
+    def __contains__(self, seq: Sequence[Hashable]):
+        if not seq and self.is_seq_end:
+            return True
+        w = seq[0]
+        _w = seq[1:]
+        if w in self.table:
+            return _w in self.table[w]
+        else:
+            return False
+    
+    def __iter__(self):
+        for w, sub_trie in self.table.items():
+            if sub_trie.is_seq_end:
+                yield self.seqtype([w])
+            
+            for subseq in sub_trie:
+                yield self.seqtype([w]) + subseq
+    
+    def __len__(self):
+        return len([i for i in self.__iter__()])
+    
+    def __getitem__(self, seq: Sequence[Hashable]):
+        if not seq:
+            return self
+        w = seq[0]
+        _w = seq[1:]
+        if w in self.table:
+            return self.table[w][_w]
+        else:
+            raise KeyError(seq)
+
+    def __bool__(self):
+        return bool(self.table)
+
+
+class CompactTrie:
+    "Array backed trie of strings with the same lookups as PTrie, can be saved to a single file"
+    __slots__ = ("first", "labels", "ends", "size")
+    MAGIC = b"PTRIE\x01"
+
+    def __init__(self, seqs: Iterable[str] = ()):
+        # nodes are numbered breadth first, so the children of a node are consecutive
+        # and edge i (labels[i]) always leads to node i + 1
+        self.first = array("I", [0])  # first[n]:first[n + 1] are the edges of node n
+        self.labels = array("I")  # code point of each edge
+        self.ends = bytearray()  # whether a word ends at node n
+        words = sorted(set(seqs))
+        self.size = sum(1 for word in words if word)
+        queue = [(0, len(words), 0)]  # each node is a run of sorted words sharing a prefix
+        for lo, hi, depth in queue:
+            if lo < hi and len(words[lo]) == depth:
+                self.ends.append(1)
+                lo += 1
+            else:
+                self.ends.append(0)
+            while lo < hi:
+                char = words[lo][depth]
+                end = lo + 1
+                while end < hi and words[end][depth] == char:
+                    end += 1
+                self.labels.append(ord(char))
+                queue.append((lo, end, depth + 1))
+                lo = end
+            self.first.append(len(self.labels))
+
+    def _child(self, node: int, char: str) -> int | None:
+        lo, hi = self.first[node], self.first[node + 1]
+        code = ord(char)
+        i = bisect_left(self.labels, code, lo, hi) if hi - lo > 1 else lo
+        if i < hi and self.labels[i] == code:
+            return i + 1
+        return None
+
+    def _node(self, seq: Sequence[str]) -> int | None:
+        node = 0
+        for char in seq:
+            node = self._child(node, char)
+            if node is None:
+                return None
+        return node
+
+    def walk(self, seq: Sequence[str]) -> Generator[str, None, None]:
+        "Iterate over all sequence in the trie that start with seq"
+        node = self._node(seq)
+        if node is None:
+            raise KeyError(seq)
+        prefix = "".join(seq)
+        for suffix in self._iter(node):
+            yield prefix + suffix
+
+    def final(self, seq: Sequence[str]) -> bool:
+        "Whether there are no longer sequences starting with seq"
+        node = self._node(seq)
+        if node is None:
+            raise KeyError(seq)
+        return bool(self.ends[node]) and self.first[node] == self.first[node + 1]
+
+    def longest(self, seq: Sequence[str], is_seq_end=True) -> str | None:
+        "The longest sequence that can serve as the beginning of a seq"
+        if not seq:
+            return "" if (self.ends[0] or not is_seq_end) else None
+        first, labels, ends = self.first, self.labels, self.ends
+        node = 0
+        length = 0
+        last_valid = None
+        for char in seq:
+            lo, hi = first[node], first[node + 1]
+            code = ord(char)
+            i = bisect_left(labels, code, lo, hi) if hi - lo > 1 else lo
+            if i == hi or labels[i] != code:
+                break
+            node = i + 1
+            length += 1
+            if ends[node]:
+                last_valid = length
+        if not is_seq_end:
+            last_valid = length or None
+        if last_valid is None:
+            return None
+        return seq[:last_valid] if isinstance(seq, str) else "".join(seq[:last_valid])
+
+    def index(self, seq: Sequence[str]) -> int | None:
+        "Find the index of the first sequence in the sequence that exists within itself"
+        for i in range(len(seq)):
+            node = 0
+            for j in range(i, len(seq)):
+                node = self._child(node, seq[j])
+                if node is None:
+                    break
+                if self.ends[node]:
+                    return i
+        return None
+
+    def is_prefix(self, seq: Sequence[str]) -> bool:
+        return self._node(seq) is not None
+
+    def save(self, path: str | Path):
+        "Write the trie to a single binary file"
+        header = struct.pack("<6sBIII", self.MAGIC, sys.byteorder == "little", self.size, len(self.first), len(self.labels))
+        with open(path, "wb") as f:
+            f.write(header)
+            f.write(self.first.tobytes())
+            f.write(self.labels.tobytes())
+            f.write(self.ends)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "CompactTrie":
+        "Read a trie written by save"
+        with open(path, "rb") as f:
+            raw = f.read()
+        magic, little, size, n_first, n_labels = struct.unpack_from("<6sBIII", raw)
+        if magic != cls.MAGIC:
+            raise ValueError("%s is not a trie file" % path)
+        self = cls.__new__(cls)
+        offset = struct.calcsize("<6sBIII")
+        self.first = array("I")
+        self.first.frombytes(raw[offset:offset + n_first * self.first.itemsize])
+        offset += n_first * self.first.itemsize
+        self.labels = array("I")
+        self.labels.frombytes(raw[offset:offset + n_labels * self.labels.itemsize])
+        offset += n_labels * self.labels.itemsize
+        self.ends = bytearray(raw[offset:])
+        self.size = size
+        if bool(little) != (sys.byteorder == "little"):
+            self.first.byteswap()
+            self.labels.byteswap()
+        return self
+
+    def _iter(self, node: int) -> Generator[str, None, None]:
+        stack = [(node, "")]
+        while stack:
+            node, prefix = stack.pop()
+            if self.ends[node] and prefix:
+                yield prefix
+            for i in range(self.first[node + 1] - 1, self.first[node] - 1, -1):
+                stack.append((i + 1, prefix + chr(self.labels[i])))
+
+    def __repr__(self):
+        return str([i for i in self.__iter__()])
+
+    def __contains__(self, seq: Sequence[str]):
+        node = self._node(seq)
+        return node is not None and bool(self.ends[node])
+
+    def __iter__(self):
+        return self._iter(0)
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.first[0] != self.first[1]
+
+
+TEXT = -1  # clip id of plain text in spans
+
+
+class ACAutomaton:
+    "Aho-Corasick automaton, finds every word of the lexicon in a single pass. With a normalizer words and input are folded first"
+    def __init__(self, words: Iterable[str], normalizer: Normalizer | None = None):
+        self.normalizer = normalizer
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.depth: List[int] = [0]
+        self.end: List[bool] = [False]  # whether a word ends at this node
+        self.dict_link: List[int] = [0]  # nearest node on the failure chain where a word ends
+        self.words = set()
+        self.free: List[int] = []  # nodes dropped by remove, reused by add
+        self._reverse: List[set] | None = None
+        for word in words:
+            if normalizer is not None:
+                word = normalizer(word)
+            if word:
+                self._insert(word)
+        self.build()
+
+    def _insert(self, word: str):
+        node = 0
+        for char in word:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[node] + 1)
+                self.end.append(False)
+                self.dict_link.append(0)
+                self.goto[node][char] = child
+            node = child
+        self.end[node] = True
+        self.words.add(word)
+
+    def build(self):
+        "Compute the failure and dictionary links breadth first"
+        goto, fail, end, dict_link = self.goto, self.fail, self.end, self.dict_link
+        queue = list(goto[0].values())
+        for node in queue:
+            fail[node] = 0
+            dict_link[node] = 0
+        for node in queue:
+            for char, child in goto[node].items():
+                f = fail[node]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(char, 0)
+                fail[child] = f
+                dict_link[child] = fail[child] if end[fail[child]] else dict_link[fail[child]]
+                queue.append(child)
+
+    def copy(self) -> "ACAutomaton":
+        "An independent automaton to apply updates to while this one stays in use"
+        other = ACAutomaton.__new__(ACAutomaton)
+        other.__dict__.update(self.__dict__)
+        other.goto = [children.copy() for children in self.goto]
+        other.fail = self.fail.copy()
+        other.depth = self.depth.copy()
+        other.end = self.end.copy()
+        other.dict_link = self.dict_link.copy()
+        other.words = self.words.copy()
+        other.free = self.free.copy()
+        other._reverse = None
+        return other
+
+    def add(self, word: str):
+        """Insert one word without rebuilding, fixing the failure links of the nodes that now have a longer suffix.
+        Only changes this automaton, use copy() first if it is being read"""
+        if self.normalizer is not None:
+            word = self.normalizer(word)
+        if not word or word in self.words:
+            return
+        reverse = self._reversed()
+        goto, fail, depth = self.goto, self.fail, self.depth
+        node = 0
+        relink = []
+        for char in word:
+            child = goto[node].get(char)
+            if child is not None:
+                node = child
+                continue
+            child = self._new_node(depth[node] + 1)
+            goto[node][char] = child
+            # the same as build() for the new node
+            f = fail[node]
+            while f and char not in goto[f]:
+                f = fail[f]
+            f = goto[f].get(char, 0) if node else 0
+            fail[child] = f
+            reverse[f].add(child)
+            # nodes whose longest suffix in the trie is now the new node, they are reached through char
+            # from nodes that fail to node, a deeper match below them already has a longer suffix
+            stack = list(reverse[node])
+            while stack:
+                w = stack.pop()
+                v = goto[w].get(char)
+                if v is None:
+                    stack.extend(reverse[w])
+                elif depth[fail[v]] < depth[child]:
+                    reverse[fail[v]].discard(v)
+                    fail[v] = child
+                    reverse[child].add(v)
+                    relink.append(v)
+            relink.append(child)
+            node = child
+        self.end[node] = True
+        self.words.add(word)
+        relink.extend(reverse[node])
+        for v in relink:
+            self._relink(v)
+
+    def remove(self, word: str):
+        "Delete one word without rebuilding, nodes no other word needs are dropped. Same caveat as add"
+        if self.normalizer is not None:
+            word = self.normalizer(word)
+        if word not in self.words:
+            return
+        reverse = self._reversed()
+        goto, fail = self.goto, self.fail
+        path = [0]
+        for char in word:
+            path.append(goto[path[-1]][char])
+        node = path[-1]
+        self.end[node] = False
+        self.words.discard(word)
+        for v in reverse[node]:
+            self._relink(v)
+        for i in range(len(word), 0, -1):
+            node = path[i]
+            if self.end[node] or goto[node]:
+                break
+            del goto[path[i - 1]][word[i - 1]]
+            # node ends no word, so moving its dependants to its own suffix keeps their dictionary links
+            for v in reverse[node]:
+                fail[v] = fail[node]
+                reverse[fail[node]].add(v)
+            reverse[fail[node]].discard(node)
+            reverse[node] = set()
+            self.free.append(node)
+
+    def _new_node(self, depth: int) -> int:
+        if self.free:
+            node = self.free.pop()
+            self.goto[node] = {}
+            self.fail[node] = 0
+            self.depth[node] = depth
+            self.end[node] = False
+            self.dict_link[node] = 0
+            return node
+        self.goto.append({})
+        self.fail.append(0)
+        self.depth.append(depth)
+        self.end.append(False)
+        self.dict_link.append(0)
+        if self._reverse is not None:
+            self._reverse.append(set())
+        return len(self.goto) - 1
+
+    def _reversed(self) -> List[set]:
+        "Children in the failure tree, only kept once the automaton is updated in place"
+        if self._reverse is None:
+            self._reverse = [set() for _ in self.goto]
+            free = set(self.free)
+            for node in range(1, len(self.goto)):
+                if node not in free:
+                    self._reverse[self.fail[node]].add(node)
+        return self._reverse
+
+    def _relink(self, root: int):
+        "Recompute the dictionary links of root and every node that fails into it"
+        fail, end, dict_link, reverse = self.fail, self.end, self.dict_link, self._reverse
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            f = fail[node]
+            dict_link[node] = f if end[f] else dict_link[f]
+            stack.extend(reverse[node])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_reverse"] = None  # rebuilt on the next update
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("free", [])
+        self.__dict__.setdefault("_reverse", None)
+
+    def _node(self, seq: Sequence[str]) -> int | None:
+        node = 0
+        for char in seq:
+            node = self.goto[node].get(char)
+            if node is None:
+                return None
+        return node
+
+    def step(self, state: int, char: str) -> int:
+        "Advance the automaton by one character"
+        goto, fail = self.goto, self.fail
+        while state and char not in goto[state]:
+            state = fail[state]
+        return goto[state].get(char, 0)
+
+    def matches(self, state: int) -> Generator[int, None, None]:
+        "Lengths of all words ending at state, longest first"
+        node = state if self.end[state] else self.dict_link[state]
+        while node:
+            yield self.depth[node]
+            node = self.dict_link[node]
+
+    def longest(self, seq: Sequence[str], is_seq_end=True) -> str | None:
+        "The longest word that can serve as the beginning of a seq"
+        goto, end = self.goto, self.end
+        node = 0
+        length = 0
+        last_valid = None
+        for char in seq:
+            node = goto[node].get(char)
+            if node is None:
+                break
+            length += 1
+            if end[node]:
+                last_valid = length
+        if not is_seq_end:
+            last_valid = length
+        if not last_valid:
+            return "" if not seq and not is_seq_end else None
+        return "".join(seq[:last_valid])
+
+    def index(self, seq: Sequence[str]) -> int | None:
+        "Find the index of the first word that exists within seq"
+        depth = self.depth
+        state = 0
+        best = None
+        for pos, char in enumerate(seq):
+            state = self.step(state, char)
+            for length in self.matches(state):
+                start = pos + 1 - length
+                if best is None or start < best:
+                    best = start
+            # every later match starts at or after pos + 1 - depth[state]
+            if best is not None and best <= pos + 1 - depth[state]:
+                return best
+        return best
+
+    def is_prefix(self, seq: Sequence[str]) -> bool:
+        return self._node(seq) is not None
+
+    def final(self, seq: Sequence[str]) -> bool:
+        "Whether there are no longer words starting with seq"
+        node = self._node(seq)
+        if node is None:
+            raise KeyError(seq)
+        return self.end[node] and not self.goto[node]
+
+    def walk(self, seq: Sequence[str]) -> Generator[str, None, None]:
+        "Iterate over all words that start with seq"
+        prefix = "".join(seq)
+        for word in self.words:
+            if word.startswith(prefix):
+                yield word
+
+    def split(self, string: str) -> Iterator[str]:
+        "Leftmost-longest segmentation of string, same output as split"
+        if self.normalizer is not None:
+            folded, offsets = self.normalizer.map(string)
+            if folded != string:
+                return self.normalizer.restore(string, offsets, self._segments(folded))
+        return self._segments(string)
+
+    def _segments(self, string: str) -> Generator[str, None, None]:
+        text = 0  # start of the pending non-word run
+        for start, end, _ in self.spans(string):
+            if text < start:
+                yield string[text:start]
+            yield string[start:end]
+            text = end
+        if text < len(string):
+            yield string[text:]
+
+    def spans(self, string: str, start: int = 0, stop: int | None = None) -> Generator[Tuple[int, int, int], None, None]:
+        """(start, end, clip id) of the words of the leftmost-longest segmentation of string[start:], only words starting
+        before stop. The clip id is the node the word ends at, clips() maps it to the clip"""
+        depth, end, dict_link = self.depth, self.end, self.dict_link
+        n = len(string)
+        stop = n if stop is None else min(stop, n)
+        best: Dict[int, int] = {}  # start -> node of the longest word found so far
+        state = 0
+        cursor = start  # positions before cursor are already segmented
+        for pos in range(start, n + 1):
+            if pos < n:
+                state = self.step(state, string[pos])
+                node = state if end[state] else dict_link[state]
+                while node:
+                    begin = pos + 1 - depth[node]
+                    if cursor <= begin < stop:
+                        best[begin] = node
+                    node = dict_link[node]
+                # no word starting before frontier can still grow
+                frontier = pos + 1 - depth[state]
+            else:
+                frontier = n
+            if not best:
+                cursor = max(cursor, frontier)
+                if cursor >= stop:
+                    return
+                continue
+            while cursor < frontier:
+                node = best.pop(cursor, None)
+                if node is None:
+                    cursor += 1
+                    continue
+                stop_at = cursor + depth[node]
+                yield cursor, stop_at, node
+                for i in range(cursor + 1, stop_at):
+                    best.pop(i, None)
+                cursor = stop_at
+
+    def split_spans(self, string: str, numpy: bool = False):
+        """split() as (start, end, clip id) of every segment flattened into one array("q"), without building any
+        substring. Plain text has clip id TEXT, offsets are in string even when it is normalized.
+        numpy=True gives an (n, 3) int64 view of the same buffer"""
+        out = array("q")
+        offsets = None
+        folded = string
+        if self.normalizer is not None:
+            folded, offsets = self.normalizer.map(string)
+        def orig(p):
+            "Where the segment ending at folded position p ends in string, same as Normalizer.restore"
+            if offsets is None:
+                return p
+            end = offsets[p - 1] + 1
+            return min(end, offsets[p]) if p < len(offsets) else end
+        text = 0  # folded start of the pending non-word run
+        last = 0  # end of the last segment in string
+        for start, end, node in self.spans(folded):
+            if text < start:
+                start = orig(start)
+                out.extend((last, start, TEXT))
+                last = start
+            text = end
+            end = orig(end)
+            out.extend((last, end, node))
+            last = end
+        if text < len(folded):
+            end = orig(len(folded))
+            out.extend((last, end, TEXT))
+            last = end
+        if last < len(string):
+            out.extend((last, len(string), TEXT))  # folded away characters at the very end
+        if numpy:
+            import numpy as np
+            return np.frombuffer(out, dtype=np.int64).reshape(-1, 3)
+        return out
+
+    def names(self) -> Dict[int, str]:
+        "The (folded) word of every clip id"
+        names = {}
+        stack = [(0, "")]
+        while stack:
+            node, word = stack.pop()
+            if self.end[node]:
+                names[node] = word
+            for char, child in self.goto[node].items():
+                stack.append((child, word + char))
+        return names
+
+    def clips(self, data: Mapping) -> List:
+        "Clip of every clip id, a list indexed by it, None where data has no clip for the word"
+        table = [None] * len(self.goto)
+        for node, word in self.names().items():
+            table[node] = data.get(word)
+        return table
+
+    def __contains__(self, seq: Sequence[str]):
+        if self.normalizer is not None and isinstance(seq, str):
+            seq = self.normalizer(seq)
+        node = self._node(seq)
+        return node is not None and self.end[node]
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __bool__(self):
+        return bool(self.words)
+
+    def __repr__(self):
+        return str(list(self.words))
+
+
+class Stream:
+    def __init__(self, queue: Queue, stop_sign = StopIteration):
+        self.queue = queue
+        self.stop_sign = stop_sign
+    
+    def __iter__(self) -> Generator:
+        while True:
+            try:
+                data = self.queue.get()
+                if data == self.stop_sign:
+                    break
+                yield data
+            except GeneratorExit:
+                break
+
+
+
+def split(string:str, words:Iterable[str], ptrie = None) -> Generator[str, None, None] | List[str]:
+    """Split a string into words and non-words"""
+    if not words:
+        yield string
+        return
+    if isinstance(ptrie, ACAutomaton):
+        yield from ptrie.split(string)
+        return
+    if ptrie is None:
+        ptrie = PTrie(words)
+    text = 0  # start of the pending non-word run
+    i = 0
+    n = len(string)
+    while i < n:
+        longest_match = ptrie.longest(string[i:])
+        if longest_match:
+            if text < i:
+                yield string[text:i]
+            yield longest_match # type: ignore
+            i += len(longest_match)
+            text = i
+        else:
+            i += 1
+    if text < n:
+        yield string[text:]
+
+def _split(string, words:Iterable[str], ptrie = None):
+    "Simple and error free"
+    if not words:
+        yield string
+        return
+    if isinstance(ptrie, ACAutomaton):
+        yield from ptrie.split(string)
+        return
+    max_len = max(len(w) for w in words)
+    text = 0  # start of the pending non-word run
+    last = 0
+    for s in range(len(string)):
+        if s < last:
+            continue
+        for e in range(min(s+max_len, len(string)), s, -1):
+            # prioritize matching the longest word
+            if string[s:e] in words:
+                if text < s:
+                    yield string[text:s]
+                last = text = e
+                yield string[s:e]
+                break
+    if text < len(string):
+        yield string[text:]
+
+
+
+
+def split_stream(stream: Iterable[str], words: Iterable[str], sep = None, ptrie = None) -> Generator[str, None, None]:
+    """Split a strem into words and non-words"""
+    if isinstance(ptrie, ACAutomaton) and ptrie.words:
+        splitter = StreamSplitter(words, sep, ptrie)
+        for string in stream:
+            yield from splitter.feed(string)
+        yield from splitter.flush()
+        return
+    def single_char(stream: Iterable[str]):
+        for string in stream:
+            if len(string) == 1:
+                yield string
+            else:
+                for char in string:
+                    yield char
+    words_set = set(words)
+    if not words_set:
+        current = StringIO()
+        for char in single_char(stream):
+            if char == sep:
+                yield current.getvalue()
+                current = StringIO()
+            else:
+                current.write(char)
+        if current.tell():
+            yield current.getvalue()
+        return
+    
+        
+    max_len = max(len(word) for word in words_set)
+    starts = {word[0] for word in words_set if word}
+    if ptrie is None:
+        prefix_tree = PTrie(words_set)
+    else:
+        prefix_tree = ptrie
+    
+    current = StringIO()
+    buffer = []
+    for char in single_char(stream): # iterate over the stream
+        if char == sep:
+            while buffer:
+                longest_match = prefix_tree.longest(buffer)
+                if longest_match is not None:
+                    if current.tell():
+                        yield current.getvalue()
+                        current = StringIO()
+                    yield longest_match # type: ignore
+                    buffer = buffer[len(longest_match):]
+                else:
+                    current.write(buffer.pop(0))
+            if current.tell():
+                yield current.getvalue()
+                current = StringIO()
+            continue
+        buffer.append(char)
+        index = prefix_tree.index(buffer) # find the index of the possible word
+        # print(buffer, index)
+        if index is not None:
+            for i in range(index):
+                # print(2)
+                current.write(buffer.pop(0))
+            if current.tell():
+                yield current.getvalue()
+                current = StringIO()
+        if buffer and buffer[0] in starts: # possible start
+            s = ''.join(buffer)
+            if len(s) < max_len: # is buffer is too long?
+                if prefix_tree.is_prefix(s) and not prefix_tree.final(s):
+                    continue # longer word may appear
+                else:
+                    longest_match = prefix_tree.longest(s)
+                    if longest_match is not None:
+                        if current.tell():
+                            yield current.getvalue()
+                        yield longest_match # type: ignore
+                        current = StringIO()
+                        buffer = buffer[len(longest_match):]
+                    else:
+                        current.write(buffer.pop(0))
+            else:
+                longest_match = prefix_tree.longest(s)
+                if longest_match is not None:
+                    if current.tell():
+                        yield current.getvalue()
+                    yield longest_match # type: ignore
+                    current = StringIO()
+                    buffer = buffer[len(longest_match):]
+                else:
+                    current.write(buffer.pop(0))
+        else:
+            current.write(buffer.pop(0))
+
+    while buffer:
+        longest_match = prefix_tree.longest(buffer)
+        if longest_match is not None:
+            if current.tell():
+                yield current.getvalue()
+            yield longest_match # type: ignore
+            current = StringIO()
+            buffer = buffer[len(longest_match):]
+        else:
+            current.write(buffer.pop(0))
+    if current.tell():
+        yield current.getvalue()
+
+
+class StreamSplitter:
+    "Stateful split_stream, feed chunks and get back the segments that are finished"
+    def __init__(self, words: Iterable[str], sep = None, ptrie: ACAutomaton | None = None):
+        self.automaton = ptrie if isinstance(ptrie, ACAutomaton) else ACAutomaton(words)
+        self.sep = sep
+        self.max_len = max((len(word) for word in self.automaton.words), default=0)
+        self.starts = {word[0] for word in self.automaton.words}
+        # runs of characters that can not start a word skip the automaton entirely
+        self._skip = re.compile("[%s]" % "".join(re.escape(c) for c in self.starts)) if self.starts else None
+        self.current = StringIO()
+        # with a normalizer the automaton sees folded text, the original characters wait in raw until their segment is out
+        self.normalizer = self.automaton.normalizer if self.automaton.words else None
+        self.raw: List[str] = []
+        self.raw_base = 0  # position of raw[0] in the original stream
+        self.offsets: List[int] = []  # original position of every folded character not segmented yet
+        self.previous = ""  # last original character of the utterance, whitespace folds depending on it
+        self._reset()
+
+    def _reset(self):
+        self.buffer: List[str] = []  # characters not segmented yet, buffer[0] is at position self.base
+        self.base = 0
+        self.front = 0  # position of the first character not segmented yet
+        self.pos = 0  # position of the next character
+        self.state = 0
+        self.best: Dict[int, int] = {}  # start -> end of the longest word found in the buffer
+        self.heap: List[int] = []  # starts of words found in the buffer
+
+    def feed(self, chunk: str) -> List[str]:
+        "Consume a chunk, return the segments that can no longer change"
+        out = []
+        if not isinstance(chunk, str):
+            if chunk is self.sep or chunk == self.sep:
+                self._end(out, True)
+            return out
+        if isinstance(self.sep, str) and len(self.sep) == 1:
+            pieces = chunk.split(self.sep)
+        else:
+            pieces = [chunk]
+        for i, piece in enumerate(pieces):
+            if i:
+                self._end(out, True)
+            self._feed(piece, out)
+        return out
+
+    def flush(self) -> List[str]:
+        "End of stream, segment whatever is left"
+        out = []
+        self._end(out, False)
+        return out
+
+    def _feed(self, piece: str, out: List[str]):
+        if not self.automaton.words:
+            self.current.write(piece)
+            return
+        if self.normalizer is not None:
+            n = len(out)
+            folded, offsets = self.normalizer.map(piece, self.previous)
+            self.previous = piece[-1:] or self.previous
+            base = self.raw_base + len(self.raw)
+            self.offsets += [base + i for i in offsets]
+            self.raw += piece
+            self._scan(folded, out)
+            self._restore(out, n)
+        else:
+            self._scan(piece, out)
+
+    def _scan(self, piece: str, out: List[str]):
+        i = 0
+        n = len(piece)
+        while i < n:
+            if self.front == self.pos:
+                match = self._skip.search(piece, i)
+                j = match.start() if match else n
+                if j > i:
+                    self.current.write(piece[i:j])
+                    i = j
+                    continue
+            self._char(piece[i], out)
+            i += 1
+
+    def _char(self, char: str, out: List[str]):
+        ac = self.automaton
+        self.buffer.append(char)
+        self.pos += 1
+        self.state = ac.step(self.state, char)
+        for length in ac.matches(self.state):
+            start = self.pos - length
+            if start >= self.front:
+                if start not in self.best:
+                    heappush(self.heap, start)
+                self.best[start] = self.pos
+        heap = self.heap
+        while heap and heap[0] < self.front:
+            heappop(heap)
+        if heap:  # a word is complete, everything before it is plain text
+            self._text(heap[0] - self.front)
+            if self.current.tell():
+                out.append(self._take())
+        if self.buffer[self.front - self.base] in self.starts:
+            length = self.pos - self.front
+            if length < self.max_len:
+                node = self._anchor(length)
+                if node is not None and not (ac.end[node] and not ac.goto[node]):
+                    return  # longer word may appear
+            self._word_or_char(out)
+        else:
+            self._text(1)
+        if self.front == self.pos:
+            self._reset()
+        elif self.front - self.base > 1024:
+            del self.buffer[:self.front - self.base]
+            self.base = self.front
+
+    def _anchor(self, length: int) -> int | None:
+        "The trie node of the buffer, None if the buffer is not a prefix of any word"
+        ac = self.automaton
+        node = self.state
+        while ac.depth[node] > length:
+            node = ac.fail[node]
+        return node if ac.depth[node] == length else None
+
+    def _text(self, n: int):
+        for i in range(self.front, self.front + n):
+            self.current.write(self.buffer[i - self.base])
+            self.best.pop(i, None)
+        self.front += n
+
+    def _word_or_char(self, out: List[str]):
+        end = self.best.get(self.front)
+        if end is None:
+            self._text(1)
+            return
+        if self.current.tell():
+            out.append(self._take())
+        out.append("".join(self.buffer[self.front - self.base:end - self.base]))
+        for i in range(self.front, end):
+            self.best.pop(i, None)
+        self.front = end
+
+    def _take(self) -> str:
+        value = self.current.getvalue()
+        self.current = StringIO()
+        return value
+
+    def _end(self, out: List[str], sep: bool):
+        if not self.automaton.words:
+            if sep or self.current.tell():
+                out.append(self._take())
+            return
+        n = len(out)
+        while self.front < self.pos:
+            self._word_or_char(out)
+        if self.current.tell():
+            out.append(self._take())
+        self._reset()
+        if self.normalizer is not None:
+            self.previous = ""
+            self._restore(out, n)
+            if self.raw:  # folded away characters at the very end
+                out.append("".join(self.raw))
+                self.raw_base += len(self.raw)
+                self.raw = []
+
+    def _restore(self, out: List[str], n: int):
+        "Replace the folded segments out[n:] with the original text they came from"
+        for k in range(n, len(out)):
+            i = len(out[k])
+            stop = self.offsets[i - 1] + 1
+            if i < len(self.offsets):
+                stop = min(stop, self.offsets[i])
+            out[k] = "".join(self.raw[:stop - self.raw_base])
+            del self.raw[:stop - self.raw_base]
+            del self.offsets[:i]
+            self.raw_base = stop
+
+
+def _split_stream(stream: Iterable[str], words: Iterable[str]):
+    "Simple and error free"
+    words_set = set(words)
+    if not words_set:
+        current = StringIO()
+        for char in stream:
+            current.write(char)
+        yield current.getvalue()
+        return
+    
+    def single_char(stream: Iterable[str]):
+        for string in stream:
+            if len(string) == 1:
+                yield string
+            else:
+                for char in string:
+                    yield char
+        
+    max_len = max(len(word) for word in words_set)
+    starts = {word[0] for word in words_set if word}
+    
+    ptrie = PTrie(words_set)
+    
+    current = StringIO()
+    buffer = []
+    for char in single_char(stream):
+        buffer.append(char)
+        if buffer and buffer[0] in starts:
+            s = ''.join(buffer)
+            if len(s) < max_len:
+                if ptrie.is_prefix(s):
+                    continue
+                else:
+                    found = None
+                    for e in range(len(s), 0, -1):
+                        candidate = s[:e]
+                        if candidate in words_set:
+                            found = e
+                            break
+                    if found is not None:
+                        if current.tell():
+                            yield current.getvalue()
+                        yield candidate
+                        current = StringIO()
+                        buffer = buffer[found:]
+                    else:
+                        current.write(buffer.pop(0))
+            else:
+                found = None
+                for e in range(min(len(buffer), max_len), 0, -1):
+                    candidate = ''.join(buffer[:e])
+                    if candidate in words_set:
+                        found = e
+                        break
+                if found is not None:
+                    if current.tell():
+                        yield current.getvalue()
+                    yield candidate
+                    current = StringIO()
+                    buffer = buffer[found:]
+                else:
+                    current.write(buffer.pop(0))
+        else:
+            if buffer:
+                current.write(buffer.pop(0))
+                
+    while buffer:
+        if buffer and buffer[0] in starts:
+            s = ''.join(buffer)
+            if len(s) < max_len:
+                if ptrie.is_prefix(s):
+                    found = None
+                    for e in range(min(len(buffer), max_len), 0, -1):
+                        candidate = ''.join(buffer[:e])
+                        if candidate in words_set:
+                            found = e
+                            break
+                    if found is not None:
+                        if current.tell():
+                            yield current.getvalue()
+                        yield candidate
+                        current = StringIO()
+                        buffer = buffer[found:]
+                    else:
+                        current.write(buffer.pop(0))
+                else:
+                    found = None
+                    for e in range(len(s), 0, -1):
+                        candidate = s[:e]
+                        if candidate in words_set:
+                            found = e
+                            break
+                    if found is not None:
+                        if current.tell():
+                            yield current.getvalue()
+                        yield candidate
+                        current = StringIO()
+                        buffer = buffer[found:]
+                    else:
+                        current.write(buffer.pop(0))
+            else:
+                found = None
+                for e in range(min(len(buffer), max_len), 0, -1):
+                    candidate = ''.join(buffer[:e])
+                    if candidate in words_set:
+                        found = e
+                        break
+                if found is not None:
+                    if current.tell():
+                        yield current.getvalue()
+                    yield candidate
+                    current = StringIO()
+                    buffer = buffer[found:]
+                else:
+                    current.write(buffer.pop(0))
+        else:
+            current.write(buffer.pop(0))
+            
+    content = current.getvalue()
+    if content:
+        yield content
+
+
+def speak(texts: Iterable[str], data: dict, synthesizer = None):
+    # the audio stack is only imported here, so segmentation alone does not need pydub or a TTS engine
+    from audio import clips, play
+    from synth import default_synthesizer, group
+    if type(texts) == str:
+        texts = [texts]
+    for text, is_meme in group(texts, data):
+        if is_meme:
+            play(clips.get(data[text]))
+        elif text.strip():
+            play((synthesizer or default_synthesizer()).synthesize(text))
+
+def main():
+    data, ptrie = load_cached("./audios", "./name.json", normalizer="./normalize.json")
+
+    # print([i for i in data])
+    while True:
+        words = [i for i in _split(input(">>> "), data, ptrie)]
+        print(words)
+        speak(words, data=data)
+
+
+def stream_test():
+    data, ptrie = load_cached("./audios", "./name.json", normalizer="./normalize.json")
+    def _stream_ouput(words: Iterable[str]):
+        for word in words:
+            print(word)
+            speak(word, data=data)
+    def _stream_input():
+        while True:
+            try:
+                yield input(">>> ")
+            except EOFError:
+                break
+            except KeyboardInterrupt:
+                break
+            except GeneratorExit:
+                break
+    while True:
+        _stream_ouput(split_stream(_stream_input(), data, sep="\\", ptrie=ptrie))
+
+def random_data(data_size, min_l, max_l, word_count, ratio = 0.1):
+    words = set()
+    for i in range(word_count):
+        word = StringIO()
+        for j in range(random.randint(min_l, max_l + 1)):
+            word.write(str(random.randint(0, 10)))
+        words.add(word.getvalue())
+    words_ = list(words)
+    data = StringIO()
+    i = 0
+    while i < data_size:
+        if random.random() < (ratio / (min_l + max_l) * 2):
+            w = random.choice(words_)
+            data.write(w)
+            i += len(w)
+            continue
+        data.write(str(random.randint(0, 10)))
+        i += 1
+    data = data.getvalue()
+    return data, words
+
+def _time(func, args = [], kwargs = {}):
+    t1 = time.time()
+    result = len([i for i in func(*args, **kwargs)])
+    t2 = time.time()
+    return result, t2 - t1
+
+
+# if __name__ == "__main__":
+#     data, words = random_data(1e6, 5, 20, 256)
+#     funcs = [_split_stream, split_stream]
+#     times = [0. for _ in funcs]
+#     for _ in range(10):
+#         for i in range(len(funcs)):
+#             r, t = _time(funcs[i], args=(data, words))
+#             times[i] += t / 10
+#     print(times)
+#     while True:
+#         exec(input(">>> "))
+
+if __name__ == "__main__":
+    # ptrie = PTrie(["a", "ab"])
+    # print(ptrie.index("a"))
+    # main()
+    stream_test()
+    
+
+# def aaa(s:str):
+#     d:set[str] = set()
+#     d.add(s)
+#     d.add(s.lower())
+#     d.add(s.upper())
+#     d.add(s.title())
+#     d.add(s[0].upper() + s[1:].lower())
+#     a = d.copy()
+#     d.update({x.replace(" ","") for x in a})
+#     return list(d)
+
+# print(json.dumps(aaa("Never Gonna Tell a Lie And Hurt You"), ensure_ascii=False, indent=4))
+
+
+# if __name__ == "__main__":
+#     print([i for i in split_stream("""```
+# 庭院深深深几许，
+# 杨柳堆烟，帘幕无重数。
+# 玉勒雕鞍游冶处，
+# 楼高不见章台路。
+
+# 雨横风狂三月暮，
+# 门掩黄昏，无计留春住。
+# 泪眼问花花不语，
+# 乱红飞过秋千去。
+# ```
+
 # 这是宋代词人欧阳修的《蝶恋花·庭院深深深几许》词的上阕。如需其他类型的多行文本，请随时告知。""", {"bcdef"}, sep="\n")])
\ No newline at end of file
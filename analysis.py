@@ -0,0 +1,183 @@
+"""One-time analysis of every clip: where its leading and trailing silence ends, how loud it is and how long it lasts
+
+python analysis.py [audios dir] [-o audios.analysis] [-j workers] writes the results next to the lexicon cache,
+clips.use_analysis() then hands out every analyzed clip trimmed and at the same loudness. Trimming slices the PCM,
+the gain is applied once when a clip is decoded or the bank is built, so playing a clip costs nothing extra"""
+from typing import Dict, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from pathlib import Path
+import argparse
+import json
+import time
+import sys
+import os
+import numpy as np
+import pydub
+from audio import ANALYSIS
+
+ANALYSIS_VERSION = 1
+SETTINGS = {
+    "silence_db": -45.,  # blocks quieter than this (dBFS RMS) are silence
+    "block_ms": 10,
+    "pad_ms": 30,  # silence kept before and after the sound so attacks and tails are not cut
+    "target_db": -20.,  # RMS every clip is brought to
+    "ceiling_db": -1.,  # the gain never pushes the peak above this
+}
+FLOOR_DB = -120.
+DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+def db(value: float) -> float:
+    return max(20 * float(np.log10(value)), FLOOR_DB) if value > 0 else FLOOR_DB
+
+
+def samples(segment: pydub.AudioSegment) -> np.ndarray:
+    "Samples of segment as (frames, channels) floats from -1 to 1"
+    if segment.sample_width not in DTYPES:
+        segment = segment.set_sample_width(2)
+    dtype = DTYPES[segment.sample_width]
+    data = np.frombuffer(segment.raw_data, dtype=dtype)
+    return (data.astype(np.float32) / -np.iinfo(dtype).min).reshape(-1, segment.channels)
+
+
+def analyze_segment(segment: pydub.AudioSegment, silence_db: float = -45., block_ms: int = 10, pad_ms: int = 30,
+                    target_db: float = -20., ceiling_db: float = -1.) -> Dict[str, float]:
+    "Trim points and duration in seconds, RMS and peak of the trimmed clip in dBFS and the gain that brings it to target_db"
+    x = samples(segment)
+    rate = segment.frame_rate
+    n = len(x)
+    block = max(rate * block_ms // 1000, 1)
+    blocks = -(-n // block)
+    power = np.zeros(blocks * block, dtype=np.float32)
+    power[:n] = np.square(x).mean(axis=1)
+    loud = np.flatnonzero(np.sqrt(power.reshape(blocks, block).mean(axis=1)) > 10 ** (silence_db / 20))
+    if len(loud):
+        pad = rate * pad_ms // 1000
+        start, end = max(int(loud[0]) * block - pad, 0), min((int(loud[-1]) + 1) * block + pad, n)
+    else:
+        start, end = 0, n  # nothing but silence, leave it alone
+    kept = x[start:end]
+    rms = db(float(np.sqrt(np.square(kept).mean()))) if len(kept) else FLOOR_DB
+    peak = db(float(np.abs(kept).max())) if len(kept) else FLOOR_DB
+    gain = min(target_db - rms, ceiling_db - peak) if len(loud) else 0.
+    return {
+        "duration": round(n / rate, 4),
+        "start": round(start / rate, 4),
+        "end": round(end / rate, 4),
+        "rms_db": round(rms, 2),
+        "peak_db": round(peak, 2),
+        "gain_db": round(gain, 2),
+    }
+
+
+def apply(segment: pydub.AudioSegment, info: Dict[str, float]) -> pydub.AudioSegment:
+    "segment trimmed to info and at its gain, the trim is a view of segment's data and only a gain copies it"
+    width = segment.frame_width
+    start = round(info["start"] * segment.frame_rate) * width
+    end = round(info["end"] * segment.frame_rate) * width
+    data = memoryview(segment.raw_data)[start:end]
+    if abs(info["gain_db"]) >= .05 and segment.sample_width in DTYPES:
+        dtype = DTYPES[segment.sample_width]
+        limits = np.iinfo(dtype)
+        scaled = np.frombuffer(data, dtype=dtype).astype(np.float32)
+        scaled *= 10 ** (info["gain_db"] / 20)
+        np.clip(scaled, limits.min, limits.max, out=scaled)
+        data = scaled.astype(dtype).tobytes()
+    return pydub.AudioSegment(data=data, sample_width=segment.sample_width, frame_rate=segment.frame_rate, channels=segment.channels)
+
+
+class Analysis:
+    """Results of analyze_segment for many clips, stored as JSON and keyed relative to the file like AudioBank.
+    Every entry keeps the mtime and size of the clip it was made from, a clip that changed since is not used"""
+    def __init__(self, path: str | Path = ANALYSIS, settings: Dict[str, float] | None = None):
+        self.path = Path(path)
+        self.root = self.path.resolve().parent
+        self.settings = dict(SETTINGS, **(settings or {}))
+        self.clips: Dict[str, Dict] = {}
+        self.failed: Dict[str, str] = {}  # path -> error, of the last update
+        self.lock = Lock()
+        try:
+            with open(self.path, encoding="utf8") as f:
+                saved = json.load(f)
+            if saved["version"] == ANALYSIS_VERSION and saved["settings"] == self.settings:
+                self.clips = saved["clips"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def key(self, path: str | Path) -> str:
+        return Path(os.path.relpath(Path(path).resolve(), self.root)).as_posix()
+
+    def get(self, path: str | Path) -> Dict[str, float] | None:
+        "The analysis of path, None if there is none or the file changed since"
+        info = self.clips.get(self.key(path))
+        if info is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_mtime_ns != info["mtime"] or st.st_size != info["size"]:
+            return None
+        return info
+
+    def add(self, path: str | Path, segment: pydub.AudioSegment) -> Dict[str, float]:
+        "Analyze the decoded clip of path"
+        info = analyze_segment(segment, **self.settings)
+        st = os.stat(path)
+        info["mtime"], info["size"] = st.st_mtime_ns, st.st_size
+        with self.lock:
+            self.clips[self.key(path)] = info
+        return info
+
+    def update(self, files: Iterable[str | Path], workers: int | None = None) -> int:
+        """Analyze every file without a fresh result on a thread pool, returns how many were analyzed.
+        A file that can not be read or decoded is skipped and goes into failed, the rest are still analyzed"""
+        todo = [file for file in dict.fromkeys(Path(f) for f in files) if self.get(file) is None]
+        self.failed = {}
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            done = list(executor.map(self._try_add, todo))
+        return sum(done)
+
+    def _try_add(self, file: Path) -> bool:
+        try:
+            self.add(file, pydub.AudioSegment.from_file(file))
+            return True
+        except Exception as e:
+            print("analysis of %s failed: %r" % (file, e), file=sys.stderr)
+            with self.lock:
+                self.failed[str(file)] = repr(e)
+            return False
+
+    def save(self):
+        with self.lock:
+            encoded = json.dumps({"version": ANALYSIS_VERSION, "settings": self.settings, "clips": self.clips}, ensure_ascii=False)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w", encoding="utf8") as f:
+            f.write(encoded)
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self.clips)
+
+
+if __name__ == "__main__":
+    from utils import load
+    parser = argparse.ArgumentParser(description="find the silence around every clip and how loud it is, once")
+    parser.add_argument("dir", nargs="?", default="./audios")
+    parser.add_argument("-o", "--out", default=ANALYSIS)
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--silence-db", type=float, default=SETTINGS["silence_db"])
+    parser.add_argument("--target-db", type=float, default=SETTINGS["target_db"])
+    args = parser.parse_args()
+    files = [Path(f) for f in load(args.dir).values()]
+    analysis = Analysis(args.out, {"silence_db": args.silence_db, "target_db": args.target_db})
+    t = time.perf_counter()
+    count = analysis.update(files, args.workers)
+    elapsed = time.perf_counter() - t
+    analysis.save()
+    infos = [info for info in map(analysis.get, dict.fromkeys(files)) if info is not None]
+    trimmed = sum(info["duration"] - info["end"] + info["start"] for info in infos)
+    loudness = np.array([info["rms_db"] for info in infos if info["rms_db"] > FLOOR_DB])
+    print("%d clips, %d analyzed in %.2fs, %d failed, %.1fs of silence trimmed, loudness %.1f ± %.1f dBFS before" % (
+        len(infos), count, elapsed, len(analysis.failed), trimmed, loudness.mean() if len(loudness) else 0., loudness.std() if len(loudness) else 0.))
@@ -0,0 +1,548 @@
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, TYPE_CHECKING
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock, Condition, Thread
+import os
+import time
+import wave
+import sys
+import json
+import mmap
+import struct
+import pydub
+if TYPE_CHECKING:
+    from analysis import Analysis
+
+
+BANK = "audios.bank"
+ANALYSIS = "audios.analysis"  # analysis.py and numpy are only imported once there is one
+
+
+class AudioBank:
+    "Raw PCM of many clips in one memory-mapped file, all in the same format"
+    MAGIC = b"MEMEBANK"
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.root = self.path.resolve().parent
+        self.file = open(self.path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:8] != self.MAGIC:
+            raise ValueError("%s is not an audio bank" % path)
+        (length,) = struct.unpack_from("<Q", self.mm, 8)
+        header = json.loads(self.mm[16:16 + length].decode("utf8"))
+        self.frame_rate: int = header["frame_rate"]
+        self.channels: int = header["channels"]
+        self.sample_width: int = header["sample_width"]
+        self.index: Dict[str, List[int]] = header["clips"]  # key -> [offset, length, mtime, size]
+        self.analysis: Dict | None = header.get("analysis")  # settings the clips were trimmed and leveled with
+        start = 16 + length
+        self.data = memoryview(self.mm)[start + -start % 16:]  # PCM starts 16 byte aligned after the header
+
+    def key(self, path: str | Path) -> str:
+        "Clips are stored relative to the bank so the bank can move together with audios/"
+        return Path(os.path.relpath(Path(path).resolve(), self.root)).as_posix()
+
+    def view(self, path: str | Path) -> memoryview | None:
+        "Zero-copy PCM of path, None if it is not in the bank or the file changed since the bank was built"
+        entry = self.index.get(self.key(path))
+        if entry is None:
+            return None
+        offset, length, mtime, size = entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_mtime_ns != mtime or st.st_size != size:
+            return None
+        return self.data[offset:offset + length]
+
+    def clip(self, path: str | Path) -> pydub.AudioSegment | None:
+        "Like view, wrapped in an AudioSegment that shares the mapped memory"
+        view = self.view(path)
+        if view is None:
+            return None
+        return pydub.AudioSegment(data=view, sample_width=self.sample_width, frame_rate=self.frame_rate, channels=self.channels)
+
+    def __contains__(self, path: str | Path):
+        return self.key(path) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    @classmethod
+    def build(cls, path: str | Path, files: Iterable[str | Path], frame_rate: int = 44100, channels: int = 2, sample_width: int = 2, workers: int | None = None,
+              analysis: "Analysis | None" = None) -> "AudioBank":
+        "Decode files on a thread pool and write them into a new bank at path, with an analysis trimmed and leveled"
+        path = Path(path)
+        root = path.resolve().parent
+        files = list(dict.fromkeys(Path(f) for f in files))
+        if analysis is not None:
+            from analysis import apply
+
+        def decode(file: Path) -> bytes:
+            clip = pydub.AudioSegment.from_file(file)
+            if analysis is not None:
+                clip = apply(clip, analysis.get(file) or analysis.add(file, clip))
+            return clip.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(sample_width).raw_data
+
+        clips = {}
+        offset = 0
+        tmp = path.with_name(path.name + ".tmp")
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor, open(tmp, "wb") as data:
+            for file, raw in zip(files, executor.map(decode, files)):
+                st = file.stat()
+                clips[Path(os.path.relpath(file.resolve(), root)).as_posix()] = [offset, len(raw), st.st_mtime_ns, st.st_size]
+                data.write(raw)
+                offset += len(raw)
+        header = {"frame_rate": frame_rate, "channels": channels, "sample_width": sample_width, "clips": clips,
+                  "analysis": analysis.settings if analysis is not None else None}
+        encoded = json.dumps(header, ensure_ascii=False).encode("utf8")
+        with open(path.with_name(path.name + ".new"), "wb") as f, open(tmp, "rb") as data:
+            f.write(cls.MAGIC + struct.pack("<Q", len(encoded)) + encoded)
+            f.write(b"\0" * (-f.tell() % 16))
+            while chunk := data.read(1 << 20):
+                f.write(chunk)
+        os.remove(tmp)
+        os.replace(path.with_name(path.name + ".new"), path)
+        return cls(path)
+
+
+class ClipCache:
+    "LRU cache of decoded clips keyed by path and mtime, bounded by the bytes of PCM it holds"
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.clips: OrderedDict[str, tuple[int, pydub.AudioSegment]] = OrderedDict()  # path -> (mtime, clip)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bank: AudioBank | None = None
+        self.bank_hits = 0
+        self.analysis: "Analysis | None" = None
+
+    def use_bank(self, path: str | Path = BANK) -> bool:
+        "Serve clips from a prebuilt bank when it has a fresh copy, False if there is no bank at path"
+        if not Path(path).is_file():
+            return False
+        self.bank = AudioBank(path)
+        return True
+
+    def use_analysis(self, path: str | Path = ANALYSIS) -> bool:
+        "Hand out analyzed clips trimmed and leveled from now on, False if there is no analysis at path or no numpy to apply it"
+        if not Path(path).is_file():
+            return False
+        try:
+            from analysis import Analysis
+        except ImportError:
+            return False
+        self.analysis = Analysis(path)
+        self.clear()
+        return True
+
+    def get(self, path: str | Path) -> pydub.AudioSegment:
+        "The decoded clip of path, decodes it only if it is not cached or the file has changed"
+        key = str(path)
+        # a bank built without an analysis only saves the decode, its clips are trimmed and leveled once and cached
+        raw = self.bank is not None and self.analysis is not None and self.bank.analysis is None
+        if self.bank is not None and not raw:
+            clip = self.bank.clip(key)
+            if clip is not None:
+                with self.lock:
+                    self.bank_hits += 1
+                return clip
+        mtime = os.stat(key).st_mtime_ns
+        with self.lock:
+            entry = self.clips.get(key)
+            if entry is not None and entry[0] == mtime:
+                self.clips.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        clip = self.bank.clip(key) if raw else None
+        if clip is None:
+            clip = pydub.AudioSegment.from_file(key)
+        if self.analysis is not None:
+            info = self.analysis.get(key)
+            if info is not None:
+                from analysis import apply
+                clip = apply(clip, info)
+        self.put(key, mtime, clip)
+        return clip
+
+    def put(self, path: str | Path, mtime: int, clip: pydub.AudioSegment):
+        key = str(path)
+        size = len(clip.raw_data)
+        with self.lock:
+            old = self.clips.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1].raw_data)
+            if size > self.max_bytes:
+                return
+            self.clips[key] = (mtime, clip)
+            self.bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.clips:
+            _, (_, clip) = self.clips.popitem(last=False)
+            self.bytes -= len(clip.raw_data)
+            self.evictions += 1
+
+    def resize(self, max_bytes: int):
+        "Change the memory budget, evicting clips if needed"
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def warm(self, paths: Iterable[str | Path], workers: int | None = None, wait: bool = True) -> List[Future]:
+        "Decode paths on a thread pool, ffmpeg runs in its own process so this scales with cores"
+        executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        futures = [executor.submit(self.get, path) for path in dict.fromkeys(str(p) for p in paths)]
+        executor.shutdown(wait=wait)
+        return futures
+
+    def clear(self):
+        with self.lock:
+            self.clips.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, int | float]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bank_hits": self.bank_hits,
+                "hit_rate": self.hits / total if total else 0.,
+                "clips": len(self.clips),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def __contains__(self, path: str | Path):
+        return str(path) in self.clips
+
+    def __len__(self):
+        return len(self.clips)
+
+
+clips = ClipCache(int(os.getenv("MEMETTS_CLIP_CACHE_MB", 256)) * 1024 * 1024) # shared by every player
+
+
+def convert(segment: pydub.AudioSegment, frame_rate: int, channels: int, sample_width: int) -> pydub.AudioSegment:
+    "segment resampled only where its format differs"
+    if segment.frame_rate != frame_rate:
+        segment = segment.set_frame_rate(frame_rate)
+    if segment.channels != channels:
+        segment = segment.set_channels(channels)
+    if segment.sample_width != sample_width:
+        segment = segment.set_sample_width(sample_width)
+    return segment
+
+
+class RingBuffer:
+    "Fixed size byte FIFO, write blocks while full and read blocks while empty"
+    def __init__(self, capacity: int):
+        self.data = bytearray(capacity)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        self.closed = False
+        self.epoch = 0  # bumped by clear, aborts writes that are waiting for room
+        self.cond = Condition()
+
+    def write(self, data, epoch: int | None = None) -> int:
+        """Append all of data, waiting for room as needed, returns the bytes written before close or clear.
+        With epoch nothing is written if the buffer was cleared since that epoch was read"""
+        view = memoryview(data).cast("B")
+        written = 0
+        with self.cond:
+            epoch = self.epoch if epoch is None else epoch
+            while written < len(view):
+                while self.size == self.capacity and not self.closed and self.epoch == epoch:
+                    self.cond.wait()
+                if self.closed or self.epoch != epoch:
+                    break
+                end = (self.start + self.size) % self.capacity
+                n = min(len(view) - written, self.capacity - self.size, self.capacity - end)
+                self.data[end:end + n] = view[written:written + n]
+                self.size += n
+                written += n
+                self.cond.notify_all()
+        return written
+
+    def read(self, n: int, timeout: float | None = None) -> bytes:
+        "Up to n bytes, empty if nothing arrived before timeout or the buffer is closed and drained"
+        with self.cond:
+            if not self.size and not self.closed:
+                self.cond.wait(timeout)
+            n = min(n, self.size, self.capacity - self.start)
+            out = bytes(self.data[self.start:self.start + n])
+            self.start = (self.start + n) % self.capacity
+            self.size -= n
+            if n:
+                self.cond.notify_all()
+            return out
+
+    def clear(self) -> int:
+        "Drop everything buffered and abort pending writes, returns the bytes dropped"
+        with self.cond:
+            dropped = self.size
+            self.start = self.size = 0
+            self.epoch += 1
+            self.cond.notify_all()
+            return dropped
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return self.size
+
+
+class NullSink:
+    "Discards audio, to test throughput without a sound card, realtime paces it like a device would"
+    def __init__(self, realtime: bool = False):
+        self.realtime = realtime
+        self.bytes = 0
+        self.byte_rate = 0
+
+    def open(self, frame_rate: int, channels: int, sample_width: int):
+        self.byte_rate = frame_rate * channels * sample_width
+
+    def write(self, data: bytes):
+        self.bytes += len(data)
+        if self.realtime:
+            time.sleep(len(data) / self.byte_rate)
+
+    def close(self):
+        pass
+
+
+class WaveSink:
+    "Writes everything played into a wav file"
+    def __init__(self, path: str | Path):
+        self.path = path
+        self.file = None
+
+    def open(self, frame_rate: int, channels: int, sample_width: int):
+        self.file = wave.open(str(self.path), "wb")
+        self.file.setnchannels(channels)
+        self.file.setsampwidth(sample_width)
+        self.file.setframerate(frame_rate)
+
+    def write(self, data: bytes):
+        self.file.writeframes(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class PyAudioSink:
+    "One PyAudio output stream kept open for the whole session"
+    def __init__(self):
+        import pyaudio
+        self.pyaudio = pyaudio
+        self.audio = None
+        self.stream = None
+
+    def open(self, frame_rate: int, channels: int, sample_width: int):
+        self.audio = self.pyaudio.PyAudio()
+        try:
+            self.stream = self.audio.open(format=self.audio.get_format_from_width(sample_width), channels=channels, rate=frame_rate, output=True)
+        except BaseException:
+            self.audio.terminate()  # no output device
+            raise
+
+    def write(self, data: bytes):
+        self.stream.write(data)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.audio.terminate()
+            self.stream = None
+
+
+class Player:
+    "Plays segments back to back through one open sink, the next segment is queued while the current one plays"
+    def __init__(self, sink = None, frame_rate: int = 44100, channels: int = 2, sample_width: int = 2, buffer_seconds: float = 2., block_frames: int = 1024):
+        self.sink = sink if sink is not None else PyAudioSink()
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_width = channels * sample_width
+        self.byte_rate = frame_rate * self.frame_width
+        self.block = block_frames * self.frame_width
+        self.ring = RingBuffer(int(buffer_seconds * frame_rate) * self.frame_width)
+        self.queued = 0  # bytes handed to play
+        self.played = 0  # bytes written to the sink
+        self.drained_at = time.perf_counter()  # when the sink last ran out of queued audio
+        self.marks: deque = deque()  # (offset, callback, idle since), see play
+        self.error: BaseException | None = None  # why the output thread stopped, nothing plays after that
+        self.cond = Condition()
+        self.sink.open(frame_rate, channels, sample_width)
+        self.thread = Thread(target=self._output, daemon=True)
+        self.thread.start()
+
+    def convert(self, segment: pydub.AudioSegment) -> pydub.AudioSegment:
+        "segment in the format of the output stream"
+        return convert(segment, self.frame_rate, self.channels, self.sample_width)
+
+    @property
+    def epoch(self) -> int:
+        "Changes with every clear, read it when a segment is handed over and pass it to play"
+        return self.ring.epoch
+
+    def play(self, segment: pydub.AudioSegment, mark: Callable[[float, float | None], None] | None = None, epoch: int | None = None):
+        """Queue a segment, returns once it is buffered rather than when it has been heard.
+        mark(time, idle since) is called from the output thread when its first bytes go to the sink,
+        idle since is when the player ran dry before it or None if it played right after the previous one.
+        With epoch the segment is dropped if clear was called since that epoch was read"""
+        if epoch is not None and epoch != self.ring.epoch:
+            return
+        self.write(self.convert(segment).raw_data, mark, epoch)
+
+    def write(self, pcm, mark: Callable[[float, float | None], None] | None = None, epoch: int | None = None):
+        "Queue raw PCM already in the player's format, epoch like in play"
+        with self.cond:
+            if epoch is not None and epoch != self.ring.epoch:
+                return
+            entry = (self.queued, mark, self.drained_at if self.played >= self.queued else None)
+            if mark is not None:
+                self.marks.append(entry)
+            self.queued += len(pcm)
+        written = self.ring.write(pcm, epoch)
+        if written < len(pcm):  # cleared or closed while waiting for room
+            with self.cond:
+                self.queued -= len(pcm) - written
+                if not written and entry in self.marks:
+                    self.marks.remove(entry)  # cleared before any of it went in, it will never be heard
+                self.cond.notify_all()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        "Block until everything queued has been written to the sink"
+        with self.cond:
+            return self.cond.wait_for(lambda: self.played >= self.queued or self.ring.closed, timeout)
+
+    def idle(self) -> bool:
+        "Whether everything queued has been played"
+        with self.cond:
+            return self.played >= self.queued
+
+    def clear(self):
+        "Drop everything queued but not played yet"
+        dropped = self.ring.clear()
+        with self.cond:
+            self.queued -= dropped
+            self.marks.clear()
+            self.cond.notify_all()
+
+    def _output(self):
+        try:
+            self._pump()
+        except Exception as e:
+            # a dead sink, close the ring so writers waiting for room and wait() return instead of hanging
+            self.error = e
+            print("player stopped: %r" % e, file=sys.stderr)
+            self.ring.close()
+            with self.cond:
+                self.cond.notify_all()
+
+    def _pump(self):
+        while True:
+            data = self.ring.read(self.block)
+            if not data:
+                if self.ring.closed:
+                    break
+                continue
+            if self.marks:
+                self._mark(len(data))
+            self.sink.write(data)
+            with self.cond:
+                self.played += len(data)
+                if self.played >= self.queued:
+                    self.drained_at = time.perf_counter()
+                self.cond.notify_all()
+
+    def _mark(self, n: int):
+        marks = []
+        with self.cond:
+            while self.marks and self.marks[0][0] < self.played + n:
+                marks.append(self.marks.popleft())
+        now = time.perf_counter()
+        for _, mark, idle in marks:
+            try:
+                mark(now, idle)
+            except Exception as e:
+                print("mark failed: %r" % e, file=sys.stderr)  # a broken callback must not stop the audio
+
+    @property
+    def seconds(self) -> float:
+        "Seconds of audio played so far"
+        return self.played / self.byte_rate
+
+    def close(self):
+        self.ring.close()
+        self.thread.join()
+        self.sink.close()
+        with self.cond:
+            self.cond.notify_all()
+
+
+_player: Player | None = None
+_player_lock = Lock()
+_no_player = False  # PyAudio is missing or has no output device, not tried again
+
+def player() -> Player | None:
+    "The shared player, None when PyAudio is not installed, there is no output device or the player broke"
+    global _player, _no_player
+    with _player_lock:
+        if _player is None and not _no_player:
+            try:
+                _player = Player()
+            except (ImportError, OSError):
+                _no_player = True
+        if _player is not None and _player.error is not None:
+            return None
+        return _player
+
+def play(segment: pydub.AudioSegment, mark: Callable[[float, float | None], None] | None = None):
+    "Queue segment on the shared player, or play it right away with pydub when there is no PyAudio"
+    p = player()
+    if p is None:
+        if mark is not None:
+            mark(time.perf_counter(), None)
+        import pydub.playback
+        pydub.playback.play(segment)
+    else:
+        p.play(segment, mark)
+
+def wait():
+    "Wait until the shared player is silent, call before anything that makes sound on its own"
+    p = player()
+    if p is not None:
+        p.wait()
+
+
+if __name__ == "__main__":
+    # python audio.py [audios dir] [bank file], after python analysis.py the clips are stored trimmed and leveled
+    from utils import load
+    dir = sys.argv[1] if len(sys.argv) > 1 else "./audios"
+    analysis = None
+    if Path(ANALYSIS).is_file():
+        from analysis import Analysis
+        analysis = Analysis(ANALYSIS)
+    bank = AudioBank.build(sys.argv[2] if len(sys.argv) > 2 else BANK, load(dir).values(), analysis=analysis)
+    if analysis is not None:
+        analysis.save()  # clips that changed since were analyzed again while building
+    print("%d clips, %.1f MB" % (len(bank), len(bank.data) / 1024 / 1024))
@@ -0,0 +1,295 @@
+"""Segmentation benchmarks
+
+python bench.py [--profile quick|full] [--out bench.json] [--compare old.json]
+
+Every axis (lexicon size, word length, match density, input size, chunk size) is varied on its own
+around a base case. Each run records throughput, time to the first segment and peak traced memory,
+and checks that the output is identical to the reference of its family.
+--bench startup times fresh interpreters: importing utils, loading the lexicon and the first segment"""
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+import _utils
+from _utils import PTrie, CompactTrie, ACAutomaton, StreamSplitter, random_data
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+PROFILES = {
+    "quick": {
+        "base": {"lexicon": 1000, "length": (5, 20), "ratio": 0.1, "size": 100_000, "chunk": 16},
+        "lexicon": [100, 1000, 10_000],
+        "length": [(2, 4), (5, 20), (20, 60)],
+        "ratio": [0.01, 0.1, 0.5],
+        "size": [1_000, 100_000, 1_000_000],
+        "chunk": [1, 16, 256],
+        "slow_limit": 1_000_000,  # reference implementations are skipped on larger inputs
+    },
+    "full": {
+        "base": {"lexicon": 1000, "length": (5, 20), "ratio": 0.1, "size": 1_000_000, "chunk": 16},
+        "lexicon": [100, 1000, 10_000, 100_000],
+        "length": [(2, 4), (5, 20), (20, 60)],
+        "ratio": [0.01, 0.1, 0.5],
+        "size": [1_000, 100_000, 1_000_000, 10_000_000, 100_000_000],
+        "chunk": [1, 16, 256, 4096],
+        "slow_limit": 10_000_000,
+    },
+}
+
+BASE_DATA = 1_000_000  # larger inputs repeat a generated base, random_data is too slow to make 100 MB
+
+
+class Lexicon:
+    "Words plus every matcher built from them, built once per case"
+    def __init__(self, words: set):
+        self.words = words
+        self.ptrie = PTrie(words, seqtype=str)
+        self.compact = CompactTrie(words)
+        self.ac = ACAutomaton(words)
+
+
+def chunked(text: str, size: int) -> Iterator[str]:
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+def _stream_splitter(text: str, lex: Lexicon, chunk: int) -> Iterator[str]:
+    splitter = StreamSplitter(lex.words, ptrie=lex.ac)
+    for piece in chunked(text, chunk):
+        yield from splitter.feed(piece)
+    yield from splitter.flush()
+
+
+# name -> (family, slow, run(text, lexicon, chunk)), a family shares one expected output
+# _split_stream is leftmost-longest like _split, split_stream commits to the first word that ends
+IMPLEMENTATIONS: Dict[str, Tuple[str, bool, Callable[[str, Lexicon, int], Iterable[str]]]] = {
+    "_split": ("split", True, lambda text, lex, chunk: _utils._split(text, lex.words)),
+    "split": ("split", True, lambda text, lex, chunk: _utils.split(text, lex.words, ptrie=lex.ptrie)),
+    "split[compact]": ("split", True, lambda text, lex, chunk: _utils.split(text, lex.words, ptrie=lex.compact)),
+    "ACAutomaton.split": ("split", False, lambda text, lex, chunk: lex.ac.split(text)),
+    "split_stream": ("stream", True, lambda text, lex, chunk: _utils.split_stream(chunked(text, chunk), lex.words, ptrie=lex.ptrie)),
+    "_split_stream": ("split", True, lambda text, lex, chunk: _utils._split_stream(chunked(text, chunk), lex.words)),
+    "StreamSplitter": ("stream", False, _stream_splitter),
+}
+REFERENCES = {"split": "_split", "stream": "split_stream"}
+STREAMING = {"split_stream", "_split_stream", "StreamSplitter"}
+
+
+def make_case(case: Dict, seed: int, cache: Dict) -> Tuple[str, Lexicon]:
+    key = (case["lexicon"], tuple(case["length"]), case["ratio"])
+    if key not in cache:
+        random.seed(seed)
+        base, words = random_data(BASE_DATA, case["length"][0], case["length"][1], case["lexicon"], case["ratio"])
+        cache.clear()  # one lexicon at a time, the big ones are not small
+        cache[key] = (base, Lexicon(words))
+    base, lex = cache[key]
+    text = (base * (case["size"] // len(base) + 1))[:case["size"]]
+    return text, lex
+
+
+def measure(run: Callable[[], Iterable[str]], repeat: int) -> Dict:
+    "Best of repeat runs, throughput only counts segments so hashing does not distort it"
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        first = None
+        count = 0
+        for _ in run():
+            if first is None:
+                first = time.perf_counter() - t0
+            count += 1
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best["seconds"]:
+            best = {"seconds": elapsed, "first_segment": first, "segments": count}
+    return best
+
+
+def verify(run: Callable[[], Iterable[str]], memory: bool) -> Dict:
+    "Digest of the output and, with memory, peak traced memory of a separate run"
+    digest = hashlib.blake2b(digest_size=16)
+    if memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+    for segment in run():
+        digest.update(segment.encode("utf8"))
+        digest.update(b"\0")
+    result = {"digest": digest.hexdigest()}
+    if memory:
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def bench_split(profile: Dict, repeat: int, memory: bool, seed: int, only: List[str] | None) -> List[Dict]:
+    results = []
+    cache: Dict = {}
+    seen = set()
+    for axis in ("lexicon", "length", "ratio", "size", "chunk"):
+        for value in profile[axis]:
+            case = dict(profile["base"], **{axis: value})
+            key = json.dumps(case, sort_keys=True)
+            if key in seen:
+                continue
+            seen.add(key)
+            text, lex = make_case(case, seed, cache)
+            digests = {}
+            for name, (family, slow, impl) in IMPLEMENTATIONS.items():
+                if only and name not in only:
+                    continue
+                if axis == "chunk" and name not in STREAMING:
+                    continue
+                if slow and case["size"] > profile["slow_limit"]:
+                    continue
+                run = lambda: impl(text, lex, case["chunk"])
+                result = {"bench": "split", "impl": name, "family": family, "axis": axis, "case": case}
+                result.update(measure(run, repeat))
+                result.update(verify(run, memory))
+                result["chars_per_second"] = case["size"] / result["seconds"] if result["seconds"] else 0.
+                digests[name] = result["digest"]
+                results.append(result)
+                print("%-18s %-8s %-36s %10.0f chars/s  first %.2e s" % (name, axis, json.dumps(case)[:36], result["chars_per_second"], result["first_segment"] or 0.), file=sys.stderr)
+            for result in results[-len(digests):] if digests else []:
+                reference = REFERENCES[result["family"]]
+                if reference not in digests:
+                    if case["size"] > profile["slow_limit"]:
+                        result["identical"] = None
+                        continue
+                    digests[reference] = verify(lambda: IMPLEMENTATIONS[reference][2](text, lex, case["chunk"]), False)["digest"]
+                result["identical"] = result["digest"] == digests[reference]
+    return results
+
+
+def bench_build(profile: Dict, repeat: int, memory: bool, seed: int) -> List[Dict]:
+    results = []
+    for size in profile["lexicon"]:
+        random.seed(seed)
+        _, words = random_data(0, profile["base"]["length"][0], profile["base"]["length"][1], size)
+        for name, build in (("PTrie", lambda: PTrie(words, seqtype=str)), ("CompactTrie", lambda: CompactTrie(words)), ("ACAutomaton", lambda: ACAutomaton(words))):
+            best = min(_timed(build) for _ in range(repeat))
+            result = {"bench": "build", "impl": name, "case": {"lexicon": size}, "seconds": best, "words_per_second": len(words) / best if best else 0.}
+            if memory:
+                tracemalloc.start()
+                structure = build()
+                result["retained_bytes"] = tracemalloc.get_traced_memory()[0]
+                del structure
+                tracemalloc.stop()
+            results.append(result)
+            print("%-18s build %-8d %.3f s" % (name, size, best), file=sys.stderr)
+    return results
+
+
+STARTUP_PROBE = """
+import time
+t0 = time.perf_counter()
+import utils
+t1 = time.perf_counter()
+data, matcher = utils.load_cached(%r, %r)
+t2 = time.perf_counter()
+next(iter(utils.split(%r, data, ptrie=matcher)))
+t3 = time.perf_counter()
+import sys, json
+print(json.dumps({"import": t1 - t0, "load": t2 - t1, "first_segment": t3 - t2,
+                  "audio_imported": [m for m in ("pydub", "pyttsx3", "audio", "synth") if m in sys.modules]}))
+"""
+
+def bench_startup(profile: Dict, repeat: int, seed: int) -> List[Dict]:
+    "Fresh interpreters: cold import of utils, loading the cached lexicon, the first segment, and cli.py segment end to end"
+    results = []
+    root = Path(__file__).resolve().parent
+    for size in profile["lexicon"]:
+        random.seed(seed)
+        text, words = random_data(1000, profile["base"]["length"][0], profile["base"]["length"][1], size)
+        with tempfile.TemporaryDirectory(prefix="memetts") as tmp:
+            audios = Path(tmp) / "audios"
+            audios.mkdir()
+            for word in words:
+                (audios / (word + ".mp3")).touch()
+            map = Path(tmp) / "name.json"
+            map.write_text("{}")
+            probe = STARTUP_PROBE % (str(audios), str(map), text)
+            def run(command: List[str]) -> Tuple[float, str]:
+                t = time.perf_counter()
+                out = subprocess.run(command, cwd=root, capture_output=True, text=True, check=True).stdout
+                return time.perf_counter() - t, out
+            run([sys.executable, "-c", probe])  # the first run builds the lexicon cache
+            interpreter = statistics.median(run([sys.executable, "-c", "pass"])[0] for _ in range(repeat))
+            probes = [run([sys.executable, "-c", probe]) for _ in range(repeat)]
+            stages = [json.loads(out) for _, out in probes]
+            result = {"bench": "startup", "impl": "utils", "case": {"lexicon": size}, "seconds": statistics.median(t for t, _ in probes),
+                      "interpreter": interpreter, "audio_imported": stages[0]["audio_imported"]}
+            for stage in ("import", "load", "first_segment"):
+                result[stage] = statistics.median(s[stage] for s in stages)
+            results.append(result)
+            cli = statistics.median(run([sys.executable, "cli.py", "segment", "--audios", str(audios), "--map", str(map), text])[0] for _ in range(repeat))
+            results.append({"bench": "startup", "impl": "cli.py segment", "case": {"lexicon": size}, "seconds": cli, "interpreter": interpreter})
+            print("startup %-8d interpreter %.3f s, import %.3f s, load %.3f s, first segment %.4f s, cli.py segment %.3f s" % (
+                size, interpreter, result["import"], result["load"], result["first_segment"], cli), file=sys.stderr)
+    return results
+
+
+def _timed(func: Callable) -> float:
+    t0 = time.perf_counter()
+    func()
+    return time.perf_counter() - t0
+
+
+def meta() -> Dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": sys.version, "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def compare(old: Dict, new: Dict, threshold: float = 0.1) -> List[str]:
+    "Lines describing every result that got slower by more than threshold"
+    def key(r):
+        return r["bench"], r["impl"], json.dumps(r["case"], sort_keys=True)
+    before = {key(r): r for r in old["results"]}
+    lines = []
+    for r in new["results"]:
+        o = before.get(key(r))
+        if o is None or not o["seconds"]:
+            continue
+        ratio = r["seconds"] / o["seconds"]
+        flag = "SLOWER" if ratio > 1 + threshold else ("faster" if ratio < 1 - threshold else "")
+        lines.append("%-8s %-18s %-60s %6.2fx %s" % (r["bench"], r["impl"], json.dumps(r["case"])[:60], ratio, flag))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="segmentation benchmarks")
+    parser.add_argument("--profile", default="quick", choices=list(PROFILES))
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--compare", default=None, help="earlier result file to compare against")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc runs")
+    parser.add_argument("--only", nargs="*", default=None, help="implementations to run")
+    parser.add_argument("--bench", nargs="*", default=["build", "split", "startup"], choices=["build", "split", "startup"])
+    args = parser.parse_args()
+    profile = PROFILES[args.profile]
+    results = []
+    if "build" in args.bench:
+        results += bench_build(profile, args.repeat, not args.no_memory, args.seed)
+    if "split" in args.bench:
+        results += bench_split(profile, args.repeat, not args.no_memory, args.seed, args.only)
+    if "startup" in args.bench:
+        results += bench_startup(profile, args.repeat, args.seed)
+    report = {"meta": dict(meta(), profile=args.profile, seed=args.seed), "results": results}
+    with open(args.out, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=1)
+    mismatches = [r for r in report["results"] if r.get("identical") is False]
+    for r in mismatches:
+        print("output differs from %s: %s %s" % (REFERENCES[r["family"]], r["impl"], json.dumps(r["case"])))
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            print("\n".join(compare(json.load(f), report)))
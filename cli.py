@@ -1,21 +1,69 @@
-from utils import load, split, main
+from utils import load_cached, split, main, TEXT
+import argparse
+import json
 import sys
-import pydub
-import pyttsx3
-import pydub.playback
+
+
+def segment(argv):
+    "python cli.py segment [--spans] [text], prints the segments as JSON, reads stdin without text. Never touches the audio stack"
+    parser = argparse.ArgumentParser(prog="cli.py segment", description="split text into memes and plain text")
+    parser.add_argument("text", nargs="*")
+    parser.add_argument("--spans", action="store_true", help="{start, end, text, clip} instead of strings")
+    parser.add_argument("--audios", default="./audios")
+    parser.add_argument("--map", default="./name.json")
+    parser.add_argument("--normalize", default="./normalize.json", help="normalizer settings, empty to match text as it is")
+    args = parser.parse_args(argv)
+    data, matcher = load_cached(args.audios, args.map, normalizer=args.normalize or None)
+    lines = [" ".join(args.text)] if args.text else (line.rstrip("\n") for line in sys.stdin)
+    table = matcher.clips(data) if args.spans else None
+    for line in lines:
+        if args.spans:
+            spans = matcher.split_spans(line)
+            segments = []
+            for i in range(0, len(spans), 3):
+                start, end, clip = spans[i], spans[i + 1], spans[i + 2]
+                clip = table[clip] if clip != TEXT else None
+                segments.append({"start": start, "end": end, "text": line[start:end], "clip": str(clip) if clip is not None else None})
+            print(json.dumps(segments, ensure_ascii=False))
+        else:
+            print(json.dumps(list(split(line, data, ptrie=matcher)), ensure_ascii=False))
+
 
 if __name__ == "__main__":
-    string = " ".join(sys.argv[1:])
+    # python cli.py [-o out.wav] text
+    # python cli.py segment [--spans] [text]
+    args = sys.argv[1:]
+    if args and args[0] == "segment":
+        segment(args[1:])
+        sys.exit()
+    output = None
+    if len(args) >= 2 and args[0] in ("-o", "--output"):
+        output = args[1]
+        args = args[2:]
+    string = " ".join(args)
+    # the audio stack is imported only when something is going to be played or rendered
+    from audio import clips, play, wait
+    from synth import default_synthesizer, group
     if not string:
         main()
+    elif output is not None:
+        from render import render, export
+        data, matcher = load_cached("./audios", "./name.json", normalizer="./normalize.json")
+        clips.use_analysis()
+        clips.use_bank()
+        result, stats = render(string, data, ptrie=matcher)
+        export(result, output)
+        print("%d segments, %.2fs of audio rendered in %.2fs, RTF %.3f" % (stats["segments"], stats["duration"], stats["render"], stats["rtf"]))
     else:
-        engine = pyttsx3.init()
-        data = load("./audios", "./name.json")
-        words = split(string, data)
-        for word in words:
-            if word in data:
-                obj = pydub.AudioSegment.from_file(str(data[word]))
-                pydub.playback.play(obj)
-            else:
-                engine.say(word)
-                engine.runAndWait()
\ No newline at end of file
+        synthesizer = default_synthesizer()
+        data, matcher = load_cached("./audios", "./name.json", normalizer="./normalize.json")
+        clips.use_analysis()
+        clips.use_bank()
+        words = split(string, data, ptrie=matcher)
+        for word, is_meme in group(words, data):
+            if is_meme:
+                obj = clips.get(data[word])
+                play(obj)
+            elif word.strip():
+                play(synthesizer.synthesize(word))
+        wait()
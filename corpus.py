@@ -0,0 +1,291 @@
+"""Segmentation of texts too large for one core, like subtitle dumps and chat logs
+
+The text is cut into chunks that are segmented on a process pool, every chunk reads max_len folded characters past its end
+so a word starting in it is always seen whole. A chunk is segmented as if the text began there, when a word of the
+chunk before runs into it the two segmentations are stitched at the first position both of them pass through and only
+the part in between is segmented again here. The result is exactly what split() gives for the whole text.
+A file is memory-mapped and read a chunk at a time, so memory does not grow with its size"""
+from typing import Dict, Generator, Iterable, Iterator, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from itertools import chain
+from bisect import bisect_left
+from array import array
+from pathlib import Path
+import argparse
+import json
+import mmap
+import time
+import sys
+import os
+from utils import ACAutomaton, Normalizer, TEXT, load_cached
+
+CHUNK_SIZE = 1 << 22  # characters of a str, bytes of a file
+BLOCK = 1 << 16
+
+
+class _Source:
+    "A str, or a UTF-8 file mapped into memory. Positions are characters of a str and bytes of a file"
+    def __init__(self, source: str | Path):
+        self.file = None
+        if isinstance(source, Path):
+            self.file = open(source, "rb")
+            try:
+                self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                self.data = b""  # an empty file can not be mapped
+        else:
+            self.data = source
+        self.size = len(self.data)
+
+    def align(self, pos: int) -> int:
+        "The first position from pos on where a character starts"
+        pos = min(pos, self.size)
+        if self.file is not None:
+            while pos < self.size and self.data[pos] & 0xC0 == 0x80:  # UTF-8 continuation byte
+                pos += 1
+        return pos
+
+    def before(self, pos: int) -> str:
+        "The character that ends at pos, empty at the start"
+        if self.file is None:
+            return self.data[pos - 1:pos]
+        start = pos - 1
+        while start > 0 and self.data[start] & 0xC0 == 0x80:
+            start -= 1
+        return self.data[max(start, 0):pos].decode("utf8")
+
+    def read(self, start: int, stop: int) -> Tuple[str, int]:
+        "Text from start to about stop, and the position it really ends at"
+        stop = self.align(stop)
+        if self.file is None:
+            return self.data[start:stop], stop
+        return self.data[start:stop].decode("utf8"), stop
+
+    def close(self):
+        if self.file is not None:
+            if isinstance(self.data, mmap.mmap):
+                self.data.close()
+            self.file.close()
+
+
+class _Window:
+    "Folded text of a source from a position on, read as far as it is needed"
+    def __init__(self, source: _Source, start: int, normalizer: Normalizer | None):
+        self.source = source
+        self.pos = start
+        self.normalizer = normalizer
+        self.chars = 0  # characters read
+        self.previous = source.before(start) if normalizer is not None else ""  # whitespace folds depending on it
+        self.folded = ""
+        self.offsets = array("q") if normalizer is not None else None  # the character every folded one came from
+
+    def read(self, stop: int):
+        "Read up to source position stop"
+        text, self.pos = self.source.read(self.pos, stop)
+        if self.normalizer is None:
+            self.folded += text
+        else:
+            folded, offsets = self.normalizer.map(text, self.previous)
+            self.previous = text[-1:] or self.previous
+            self.folded += folded
+            self.offsets.extend(offset + self.chars for offset in offsets)
+        self.chars += len(text)
+
+    def fill(self, n: int):
+        "Read until there are n folded characters or the source ends"
+        while len(self.folded) < n and self.pos < self.source.size:
+            self.read(self.pos + max(n - len(self.folded), 1024))
+
+    def end(self, p: int) -> int:
+        "Where a segment ending at folded position p ends in the text read, -1 for 0 which depends on what came before"
+        if self.offsets is None:
+            return p
+        if p == 0:
+            return -1
+        end = self.offsets[p - 1] + 1
+        return min(end, self.offsets[p]) if p < len(self.offsets) else end  # folded away characters go with the next segment
+
+    def last(self, core: int) -> int:
+        "Where the last of the first core folded characters ends"
+        return self.offsets[core - 1] + 1 if self.offsets is not None else core
+
+
+_worker: Dict = {}
+
+def _init_worker(source: str | Path, matcher: ACAutomaton, max_len: int):
+    _worker["source"] = _Source(source)
+    _worker["matcher"] = matcher
+    _worker["max_len"] = max_len
+
+def _run_chunk(start: int, stop: int):
+    return _segment_chunk(_worker, start, stop)
+
+def _segment_chunk(state: Dict, start: int, stop: int):
+    """Words of the chunk from start to stop as if the text began there, flattened into (start, end) in folded
+    characters, clip id and (start, end) in characters, all counted from the start of the chunk"""
+    source, matcher, max_len = state["source"], state["matcher"], state["max_len"]
+    start, stop = source.align(start), source.align(stop)
+    window = _Window(source, start, matcher.normalizer)
+    window.read(stop)
+    core, chars = len(window.folded), window.chars
+    window.fill(core + max_len)
+    words = array("q")
+    for a, b, clip in matcher.spans(window.folded, 0, core):
+        words.extend((a, b, clip, window.end(a), window.end(b)))
+    return start, chars, core, window.last(core) if core else 0, words
+
+
+def _agree(starts: array, ends: array, x: int) -> int:
+    "The first position from x on that the segmentation with these words passes through"
+    j = bisect_left(starts, x) - 1
+    return ends[j] if j >= 0 and ends[j] > x else x
+
+def _resync(window: _Window, matcher: ACAutomaton, starts: array, ends: array, q: int, core: int, max_len: int):
+    """Segment from q, where a word of the chunk before ended inside one of the chunk's own words, until a position the
+    chunk's segmentation passes through as well. Returns the words up to there and that position, None if there is none"""
+    found = []
+    size = 4 * max_len
+    while q < core:
+        stop = min(q + size, core)
+        window.fill(stop + max_len)
+        gap = q  # the cursor passes every position from gap to the start of the next word
+        for a, b, clip in matcher.spans(window.folded, q, stop):
+            x = _agree(starts, ends, gap)
+            if x <= a:
+                return found, x
+            found.append((a, b, clip))
+            gap = b
+        q = max(gap, stop)
+        x = _agree(starts, ends, gap)
+        if x <= q:
+            return found, x
+        size *= 2
+    return found, None
+
+
+def _in_order(executor: ProcessPoolExecutor, starts: Iterable[int], chunk_size: int, ahead: int) -> Iterator:
+    "Chunk results in order, at most ahead of them in flight"
+    pending = deque()
+    for start in starts:
+        pending.append(executor.submit(_run_chunk, start, start + chunk_size))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _stitch(state: Dict, results: Iterable) -> Generator[Tuple[int, int, int], None, None]:
+    source, matcher, max_len = state["source"], state["matcher"], state["max_len"]
+    fbase = obase = 0  # folded characters and characters before the chunk
+    last = 0  # where the last folded character so far ends
+    cursor = 0  # folded position everything before is segmented up to
+    fend = oend = 0  # end of the last segment given out
+    for start, chars, core, chunk_last, words in results:
+        starts, ends = words[0::5], words[1::5]
+        found = []
+        i = 0
+        if cursor > fbase:
+            # a word of an earlier chunk runs into this one, its own segmentation holds from where the two agree
+            c = cursor - fbase
+            x = _agree(starts, ends, c)
+            if x != c:
+                window = _Window(source, start, matcher.normalizer)
+                found, x = _resync(window, matcher, starts, ends, c, core, max_len)
+                found = [(a, b, clip, window.end(a), window.end(b)) for a, b, clip in found]
+            i = bisect_left(starts, x) if x is not None else len(starts)
+        own = zip(starts[i:], ends[i:], words[5 * i + 2::5], words[5 * i + 3::5], words[5 * i + 4::5])
+        for a, b, clip, oa, ob in chain(found, own):
+            a += fbase
+            b += fbase
+            if a > fend:
+                oa = oa + obase if oa >= 0 else last
+                yield oend, oa, TEXT
+                oend = oa
+            ob += obase
+            yield oend, ob, clip
+            fend, oend = b, ob
+            cursor = b
+        if core:
+            last = obase + chunk_last
+        fbase += core
+        obase += chars
+    if fbase > fend:
+        yield oend, last, TEXT
+        oend = last
+    if oend < obase:
+        yield oend, obase, TEXT  # folded away characters at the very end
+
+
+def spans(source: str | Path, matcher: ACAutomaton, processes: int | None = None, chunk_size: int = CHUNK_SIZE) -> Generator[Tuple[int, int, int], None, None]:
+    """(start, end, clip id) of every segment in characters like ACAutomaton.split_spans, source is a str or the Path
+    of a UTF-8 file"""
+    src = _Source(source)
+    try:
+        max_len = max(matcher.depth)
+        state = {"source": src, "matcher": matcher, "max_len": max_len}
+        chunk_size = max(chunk_size, 16 * max_len)
+        starts = range(0, src.size, chunk_size)
+        if processes == 1 or len(starts) <= 1:
+            yield from _stitch(state, (_segment_chunk(state, start, start + chunk_size) for start in starts))
+            return
+        executor = ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(source, matcher, max_len))
+        try:
+            yield from _stitch(state, _in_order(executor, starts, chunk_size, 2 * (processes or os.cpu_count() or 1)))
+        finally:
+            executor.shutdown(cancel_futures=True)
+    finally:
+        src.close()
+
+
+def split(source: str | Path, words: Iterable[str], ptrie: ACAutomaton | None = None, processes: int | None = None,
+          chunk_size: int = CHUNK_SIZE) -> Generator[str, None, None]:
+    """Same segments as utils.split(text, words, ptrie) on several cores. A Path is memory-mapped and read as UTF-8
+    without newline translation, only the text of the segments being given out is held"""
+    matcher = ptrie if isinstance(ptrie, ACAutomaton) else ACAutomaton(words)
+    reader = _Source(source)
+    try:
+        buffer = ""
+        base = pos = 0  # character offset of buffer[0], source position after it
+        for start, end, _ in spans(source, matcher, processes, chunk_size):
+            if base + len(buffer) < end:
+                parts = [buffer[start - base:]]
+                base = start
+                n = len(parts[0])
+                while base + n < end:
+                    piece, pos = reader.read(pos, pos + BLOCK)
+                    parts.append(piece)
+                    n += len(piece)
+                buffer = "".join(parts)
+            yield buffer[start - base:end - base]
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    # python corpus.py corpus.txt [-j 8] [--spans] > segments.jsonl
+    parser = argparse.ArgumentParser(description="segment a large UTF-8 text file on all cores, one JSON line per segment")
+    parser.add_argument("file")
+    parser.add_argument("-j", "--processes", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="bytes per job")
+    parser.add_argument("--spans", action="store_true", help="[start, end, clip] in characters instead of the text")
+    parser.add_argument("--audios", default="./audios")
+    parser.add_argument("--map", default="./name.json")
+    parser.add_argument("--normalize", default="./normalize.json", help="normalizer settings, empty to match text as it is")
+    args = parser.parse_args()
+    data, matcher = load_cached(args.audios, args.map, normalizer=args.normalize or None)
+    out = sys.stdout
+    t = time.perf_counter()
+    count = 0
+    if args.spans:
+        table = matcher.clips(data)
+        for start, end, clip in spans(Path(args.file), matcher, args.processes, args.chunk_size):
+            clip = table[clip] if clip != TEXT else None
+            out.write(json.dumps([start, end, str(clip) if clip is not None else None]) + "\n")
+            count += 1
+    else:
+        for word in split(Path(args.file), data, matcher, args.processes, args.chunk_size):
+            out.write(json.dumps(word, ensure_ascii=False) + "\n")
+            count += 1
+    elapsed = time.perf_counter() - t
+    print("%d segments of %d bytes in %.2fs" % (count, os.path.getsize(args.file), elapsed), file=sys.stderr)
@@ -0,0 +1,92 @@
+"""Conversation history for the chat loop, kept under a token budget"""
+from typing import Dict, List, Tuple
+import math
+import re
+
+CJK = re.compile("[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate(text: str) -> int:
+    "Tokens of text without a tokenizer, DeepSeek documents about 0.6 per CJK character and 0.3 per other character"
+    cjk = len(CJK.findall(text))
+    return math.ceil(cjk * .6 + (len(text) - cjk) * .3)
+
+
+class History:
+    """The system prompt and whole turns, a user message with its answer. Every message is counted once when it is added.
+    A request over budget first shortens the oldest turns to compact_chars characters, then drops them,
+    the system prompt and the last keep turns are always sent.
+    usage() learns how far the estimate is off from the prompt_tokens the endpoint reports"""
+    OVERHEAD = 4  # tokens of every message for its role and separators
+
+    def __init__(self, system: str, budget: int = 4000, keep: int = 2, compact_chars: int = 80):
+        self.budget = budget
+        self.keep = max(keep, 1)  # the turn being answered
+        self.compact_chars = compact_chars
+        self.turns: List[List[Dict[str, str]]] = []
+        self.counts: List[List[int]] = []  # estimated tokens of every message of every turn
+        self.compacted = 0  # how many of the oldest turns are already shortened
+        self.dropped = 0
+        self.estimated = 0  # all turns
+        self.scale = 1.  # reported / estimated
+        self.sent: List[Dict] = []  # stats of every request
+        self.set_system(system)
+
+    def count(self, content: str) -> int:
+        return estimate(content) + self.OVERHEAD
+
+    def set_system(self, content: str):
+        self.system = {"role": "system", "content": content}
+        self.system_count = self.count(content)
+
+    def add(self, role: str, content: str):
+        "A user message starts a new turn, anything else belongs to the current one"
+        if role == "user" or not self.turns:
+            self.turns.append([])
+            self.counts.append([])
+        n = self.count(content)
+        self.turns[-1].append({"role": role, "content": content})
+        self.counts[-1].append(n)
+        self.estimated += n
+
+    def tokens(self) -> int:
+        "Estimated tokens of the next request"
+        return math.ceil((self.system_count + self.estimated) * self.scale)
+
+    def fit(self):
+        "Compact and drop old turns until the request fits the budget or only the last keep turns are left"
+        while self.tokens() > self.budget and len(self.turns) > self.keep:
+            if self.compacted < len(self.turns) - self.keep:
+                self._compact(self.compacted)
+                self.compacted += 1
+                continue
+            self.turns.pop(0)
+            self.estimated -= sum(self.counts.pop(0))
+            self.compacted -= 1
+            self.dropped += 1
+
+    def _compact(self, i: int):
+        turn, counts = self.turns[i], self.counts[i]
+        for j, message in enumerate(turn):
+            if len(message["content"]) > self.compact_chars:
+                message = turn[j] = dict(message, content=message["content"][:self.compact_chars] + "…")
+                n = self.count(message["content"])
+                self.estimated += n - counts[j]
+                counts[j] = n
+
+    def request(self) -> Tuple[List[Dict[str, str]], Dict]:
+        "Messages to send now and what they cost"
+        self.fit()
+        messages = [self.system] + [message for turn in self.turns for message in turn]
+        stats = {"tokens": self.tokens(), "estimated": self.system_count + self.estimated, "messages": len(messages),
+                 "turns": len(self.turns), "compacted": self.compacted, "dropped": self.dropped}
+        self.sent.append(stats)
+        return messages, stats
+
+    def usage(self, prompt_tokens: int):
+        "prompt_tokens the endpoint reported for the last request, corrects later estimates"
+        if not self.sent or not self.sent[-1]["estimated"]:
+            return
+        stats = self.sent[-1]
+        stats["reported"] = prompt_tokens
+        self.scale += .5 * (prompt_tokens / stats["estimated"] - self.scale)
@@ -1,56 +1,135 @@
-from openai import OpenAI
-from utils import load
+from openai import AsyncOpenAI
+from utils import Lexicon
 import os
 from io import StringIO
-import pyttsx3
-from tts import Speaker
+from tts import AsyncSpeaker
+from audio import clips
+from metrics import metrics
+from history import History, estimate
+from retrieval import MemeIndex
+from threading import Thread
+from typing import List
+import asyncio
+import signal
+import time
 
-client = OpenAI(base_url="https://api.deepseek.com/v1", api_key=os.getenv("DEEPSEEK_API_KEY"))
-words = load("./audios", "./name.json", suffixs=[".mp3", ".wav"])
-names = [i for i in load("./audios", suffixs=[".mp3", ".wav"]).keys()]
-messages = [{"role": "system", "content": f"""你是deepfuck,一个在B站多年的网友,喜欢玩梗
+# MEMETTS_LLM_URL=http://127.0.0.1:8000/v1 talks to python mock_llm.py instead
+client = AsyncOpenAI(base_url=os.getenv("MEMETTS_LLM_URL", "https://api.deepseek.com/v1"), api_key=os.getenv("DEEPSEEK_API_KEY"))
+model = os.getenv("MEMETTS_LLM_MODEL", "deepseek-chat")
+lexicon = Lexicon("./audios", "./name.json", suffixs=[".mp3", ".wav"], normalizer="./normalize.json").watch()
+system = """你是deepfuck,一个在B站多年的网友,喜欢玩梗
 你经常玩的梗有:
-{names}
+{}
 根据情况适当使用这些梗
 不要过度使用,除用户特殊要求外,一句话最多使用一个梗
 使用梗时必须保持语义连贯,必须与上下文匹配,不能为了凑数而使用
-"""}]
-engine = pyttsx3.init()
-speaker = Speaker(words, engine, "\n")
+"""
+# only the memes closest to the current message and the last turn go into the system prompt
+top_k = int(os.getenv("MEMETTS_MEMES", 20))
+index = MemeIndex(lexicon.current()[1], lexicon.normalizer)
+def reindex(version, data, matcher):
+    global index
+    index = MemeIndex(data, lexicon.normalizer)
+lexicon.listeners.append(reindex)
+history = History(system.format([]), budget=int(os.getenv("MEMETTS_HISTORY_TOKENS", 4000)))
+clips.use_analysis()
+speaker = AsyncSpeaker(lexicon, sep="\n")
 
-print(messages[0]["content"])
+print(system.format("(每轮从%d个梗里选出最相关的%d个)" % (len(index), top_k)))
 
 
-while True:
-    prompt = StringIO()
-    while True:
+def pick_memes(prompt: str) -> List[str]:
+    "Put the memes for this turn into the system prompt"
+    context = [message["content"] for turn in history.turns[-1:] for message in turn]
+    memes = index.search(prompt, top_k, context)
+    history.set_system(system.format(memes))
+    return memes
+
+
+def ainput(prompt: str) -> asyncio.Future:
+    "input() on a daemon thread, so Ctrl+C still exits while waiting for a prompt"
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    def run():
         try:
-            d = input(">>> ")
-        except EOFError:
-            break
-        prompt.write(d + "\n")
-    prompt = prompt.getvalue()
-    
-    response = StringIO()
-    messages.append({"role": "user", "content": prompt})
-    request = client.chat.completions.create(
+            result = input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_exception(e))
+        else:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+    Thread(target=run, daemon=True).start()
+    return future
+
+
+async def respond(response: StringIO):
+    messages, stats = history.request()
+    t = time.perf_counter()
+    request = await client.chat.completions.create(
         messages=messages,
-        model="deepseek-chat",
+        model=model,
         stream=True,
+        stream_options={"include_usage": True},
     ) # type: ignore
-    for chunk in request:
+    async for chunk in request:
         if not chunk:
             continue
+        if chunk.usage is not None:
+            history.usage(chunk.usage.prompt_tokens)
+        if not chunk.choices:
+            continue
         content = chunk.choices[0].delta.content
         if not content:
             continue
+        if t is not None and metrics.enabled:
+            metrics.observe("llm_first_token", time.perf_counter() - t)
+        t = None
         response.write(content)
-        speaker.speak(content)
+        print(content, end="", flush=True)
+        await speaker.feed(content)
+    await speaker.flush()
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    task: asyncio.Task | None = None
+
+    def barge_in():
+        speaker.cancel()
+        if task is not None:
+            task.cancel()
+
+    def interrupt(signum, frame):
+        # Ctrl+C while answering stops the answer and the audio, otherwise it exits as usual
+        if task is None or task.done():
+            raise KeyboardInterrupt
+        loop.call_soon_threadsafe(barge_in)
+    signal.signal(signal.SIGINT, interrupt)
+
+    while True:
+        prompt = StringIO()
+        while True:
+            try:
+                d = await ainput(">>> ")
+            except EOFError:
+                break
+            prompt.write(d + "\n")
+        prompt = prompt.getvalue()
+
+        response = StringIO()
+        memes = pick_memes(prompt)
+        history.add("user", prompt)
+        task = asyncio.create_task(respond(response))
         try:
-            print(content, end="", flush=True)
-        except KeyboardInterrupt:
-            break
-    response = response.getvalue()
-    speaker.finish()
-    print()
-    messages.append({"role": "assistant", "content": response})
\ No newline at end of file
+            await task
+        except asyncio.CancelledError:
+            pass
+        print()
+        history.add("assistant", response.getvalue())
+        stats = history.sent[-1]
+        full = estimate(system.format(index.names))
+        print("[%d tokens sent%s, %d turns, %d compacted, %d dropped, system prompt %d tokens with %d memes instead of %d with all %d]" % (
+            stats.get("reported", stats["tokens"]), "" if "reported" in stats else " (estimated)", stats["turns"], stats["compacted"], stats["dropped"],
+            estimate(history.system["content"]), len(memes), full, len(index)))
+
+
+asyncio.run(main())
@@ -0,0 +1,149 @@
+"""Load test for server.py, concurrent clients on keep-alive connections against localhost
+
+python loadtest.py [--url http://127.0.0.1:8765] [-c 16] [-n 200] [--endpoint segment|render|stream] [--texts test.txt]
+Every client sends its requests one after another, a stream request is one utterance fed in --chunk character pieces.
+Prints throughput and latency percentiles as JSON, with the server's own /metrics next to them"""
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+import argparse
+import asyncio
+import base64
+import json
+import time
+import os
+from metrics import Histogram
+from server import WebSocket, accept_key
+
+
+class Client:
+    "One keep-alive HTTP connection"
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b"", content_type: str = "text/plain; charset=utf-8") -> Tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(("%s %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n" % (
+            method, path, self.host, self.port, content_type, len(body))).encode("latin1") + body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        return status, await self.reader.readexactly(length)
+
+    async def stream(self, text: str, chunk: int) -> Dict[str, float]:
+        "Feed one utterance over a new WebSocket, returns when its done message arrives"
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        key = base64.b64encode(os.urandom(16)).decode("ascii")
+        writer.write(("GET /stream HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      "Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n" % (self.host, self.port, key)).encode("latin1"))
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if status != 101 or headers.get("sec-websocket-accept") != accept_key(key):
+            raise ConnectionError("upgrade refused with %d" % status)
+        ws = WebSocket(reader, writer, client=True)
+        t = time.perf_counter()
+        first = None
+        received = 0
+        try:
+            await ws.receive()  # the format
+            for i in range(0, len(text), chunk):
+                await ws.send(text[i:i + chunk])
+            await ws.send("")
+            while True:
+                message = await ws.receive()
+                if message is None:
+                    raise ConnectionError("closed before the utterance was done")
+                if isinstance(message, bytes):
+                    received += len(message)
+                    if first is None:
+                        first = time.perf_counter() - t
+                elif json.loads(message)["type"] == "done":
+                    break
+        finally:
+            await ws.close()
+            writer.close()
+        return {"first_audio": first if first is not None else time.perf_counter() - t, "bytes": received}
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def run(url: str, endpoint: str, texts: List[str], clients: int, requests: int, chunk: int) -> Dict:
+    address = urlsplit(url)
+    host, port = address.hostname, address.port or 80
+    latency, first_audio = Histogram(), Histogram()
+    counter = iter(range(requests))
+    errors = 0
+    received = 0
+
+    async def worker():
+        nonlocal errors, received
+        client = Client(host, port)
+        try:
+            for i in counter:
+                text = texts[i % len(texts)]
+                t = time.perf_counter()
+                try:
+                    if endpoint == "stream":
+                        result = await client.stream(text, chunk)
+                        first_audio.observe(result["first_audio"])
+                        received += result["bytes"]
+                    else:
+                        status, body = await client.request("POST", "/" + endpoint, text.encode("utf8"))
+                        received += len(body)
+                        if status != 200:
+                            errors += 1
+                except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                    errors += 1
+                    client.close()
+                    client = Client(host, port)
+                latency.observe(time.perf_counter() - t)
+        finally:
+            client.close()
+
+    t = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.perf_counter() - t
+    summary = {
+        "endpoint": endpoint,
+        "clients": clients,
+        "requests": latency.count,
+        "errors": errors,
+        "elapsed": elapsed,
+        "requests_per_second": latency.count / elapsed if elapsed else 0.,
+        "megabytes_received": received / 1024 / 1024,
+        "latency": latency.snapshot(),
+    }
+    if endpoint == "stream":
+        summary["first_audio"] = first_audio.snapshot()
+    client = Client(host, port)
+    try:
+        summary["server"] = json.loads((await client.request("GET", "/metrics"))[1])
+    finally:
+        client.close()
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="hammer a running server.py with concurrent clients")
+    parser.add_argument("--url", default="http://127.0.0.1:8765")
+    parser.add_argument("--endpoint", default="segment", choices=["segment", "render", "stream"])
+    parser.add_argument("-c", "--clients", type=int, default=16)
+    parser.add_argument("-n", "--requests", type=int, default=200)
+    parser.add_argument("--texts", default="test.txt", help="one request per line")
+    parser.add_argument("--chunk", type=int, default=8, help="characters per streamed message")
+    args = parser.parse_args()
+    with open(args.texts, encoding="utf8") as f:
+        texts = [line.strip() for line in f if line.strip()]
+    print(json.dumps(asyncio.run(run(args.url, args.endpoint, texts, args.clients, args.requests, args.chunk)), indent=4, ensure_ascii=False))
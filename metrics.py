@@ -0,0 +1,265 @@
+"""Per-segment latency from the LLM chunk to the sound
+
+Every segment gets a record of perf_counter timestamps, one per stage:
+arrived (chunk holding its last character came in), segmented, started / ready (decode or synthesis),
+queued (handed to the player) and audible (its first bytes reached the device).
+Nothing is recorded unless metrics.enable() was called or MEMETTS_METRICS is set,
+MEMETTS_METRICS=path.jsonl also writes every record as a JSON line"""
+from typing import Callable, Dict, Iterable, List, TextIO
+from collections import deque
+from bisect import bisect_left
+from threading import Lock, Thread
+from queue import Queue
+from pathlib import Path
+import itertools
+import json
+import math
+import time
+import sys
+import os
+
+
+class Histogram:
+    "Cumulative buckets like a Prometheus histogram, values in seconds"
+    BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+    def __init__(self, buckets: Iterable[float] = BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        "Estimated by linear interpolation inside the bucket, like histogram_quantile"
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.,
+            "p50": self.quantile(.5),
+            "p90": self.quantile(.9),
+            "p99": self.quantile(.99),
+            "max": self.max,
+        }
+
+    def prometheus(self, name: str) -> List[str]:
+        lines = ["# TYPE %s histogram" % name]
+        total = 0
+        for bound, n in zip(self.buckets + (math.inf,), self.counts):
+            total += n
+            lines.append('%s_bucket{le="%s"} %d' % (name, "+Inf" if bound == math.inf else repr(bound), total))
+        lines.append("%s_sum %r" % (name, self.sum))
+        lines.append("%s_count %d" % (name, self.count))
+        return lines
+
+
+class Tracer:
+    """Records of one speaker, remembers when each character of its text stream came in so a segment
+    can be traced back to its chunks. Characters equal to sep are dropped by the splitter and are not counted"""
+    def __init__(self, sep = None):
+        self.sep = sep if isinstance(sep, str) and len(sep) == 1 else None
+        self.chunks: deque = deque()  # (offset after the chunk, time)
+        self.bounds: deque = deque()  # offsets where an utterance ends
+        self.fed = 0
+        self.taken = 0
+        self.utterance: float | None = None  # arrival of the first chunk of the current utterance
+        self.heard: float | None = None  # utterance of the last segment handed to the player
+
+    def feed(self, chunk: str, t: float):
+        n = len(chunk) - (chunk.count(self.sep) if self.sep else 0)
+        if n:
+            self.fed += n
+            self.chunks.append((self.fed, t))
+
+    def end(self):
+        "The next segment starts a new utterance"
+        if not self.bounds or self.bounds[-1] != self.fed:
+            self.bounds.append(self.fed)
+
+    def take(self, word: str) -> Dict[str, float | None]:
+        "Timestamps of a segment, segments must be taken in order"
+        start = self.taken
+        self.taken += len(word)
+        while self.bounds and self.bounds[0] <= start:
+            self.bounds.popleft()
+            self.utterance = None
+        while self.chunks and self.chunks[0][0] <= start:
+            self.chunks.popleft()
+        if not self.chunks:
+            return {"arrived": None, "utterance": self.utterance}
+        if self.utterance is None:
+            self.utterance = self.chunks[0][1]
+        last = self.chunks[0][1]
+        for offset, t in self.chunks:
+            last = t
+            if offset >= self.taken:
+                break
+        return {"arrived": last, "utterance": self.utterance}
+
+    def segment(self, word: str, meme: bool) -> Dict | None:
+        "Record of the next segment, None when metrics are off. Every segment has to go through here, in order"
+        if not metrics.enabled:
+            return None
+        record = metrics.segment(word, meme)
+        record.update(self.take(word))
+        record["segmented"] = time.perf_counter()
+        return record
+
+    def mark(self, record: Dict | None) -> Callable[[float, float | None], None] | None:
+        "Call when record's segment is handed to the player and pass the result on as its mark"
+        if record is None:
+            return None
+        record["queued"] = time.perf_counter()
+        if record["utterance"] is not None and record["utterance"] != self.heard:
+            record["first"] = True
+            self.heard = record["utterance"]
+        def mark(t: float, idle: float | None):
+            record["audible"] = t
+            if not record.get("first"):
+                record["gap"] = t - idle if idle is not None else 0.
+            metrics.finish(record)
+        return mark
+
+    def reset(self):
+        self.chunks.clear()
+        self.bounds.clear()
+        self.fed = self.taken = 0
+        self.utterance = None
+
+
+class Metrics:
+    """Stage timestamps per segment turned into latency histograms, hooks get every finished record.
+    finish runs on the audio thread, so the log and the hooks are served from a writer thread of their own"""
+    HISTOGRAMS = ("time_to_first_audio", "llm_first_token", "holdback", "decode", "synthesis", "device_start", "gap")
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms: Dict[str, Histogram] = {name: Histogram() for name in self.HISTOGRAMS}
+        self.hooks: List[Callable[[Dict], None]] = []
+        self.log: TextIO | None = None
+        self.lock = Lock()
+        self.ids = itertools.count()
+        self.finished: Queue = Queue()  # (record, time) waiting for the log and the hooks
+        self.writer: Thread | None = None
+
+    def enable(self, log: str | Path | None = None):
+        "Start recording, with log every finished segment is appended to it as a JSON line"
+        with self.lock:
+            if log is not None and self.log is None:
+                self.log = open(log, "a", encoding="utf8", buffering=1)
+            self.enabled = True
+
+    def disable(self):
+        self.flush()
+        with self.lock:
+            self.enabled = False
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+    def hook(self, callback: Callable[[Dict], None]):
+        "callback(record) for every finished segment, in order on the writer thread, an exception is reported and ignored"
+        self.hooks.append(callback)
+
+    def segment(self, text: str, meme: bool) -> Dict:
+        return {"id": next(self.ids), "text": text, "meme": meme}
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            self.histograms[name].observe(seconds)
+
+    def finish(self, record: Dict):
+        "Derive the latencies of a segment that became audible and record them"
+        def between(a, b):
+            if record.get(a) is not None and record.get(b) is not None:
+                return max(record[b] - record[a], 0.)
+        record["holdback"] = between("arrived", "segmented")
+        record["decode" if record["meme"] else "synthesis"] = between("started", "ready")
+        record["device_start"] = between("queued", "audible")
+        if record.get("first"):
+            record["time_to_first_audio"] = between("utterance", "audible")
+        with self.lock:
+            for name in self.HISTOGRAMS:
+                if record.get(name) is not None:
+                    self.histograms[name].observe(record[name])
+            if self.log is None and not self.hooks:
+                return
+            if self.writer is None:
+                self.writer = Thread(target=self._write, daemon=True)
+                self.writer.start()
+        self.finished.put((record, time.time()))
+
+    def _write(self):
+        while True:
+            record, t = self.finished.get()
+            log = self.log  # not under the lock, a slow disk must not hold up finish on the audio thread
+            try:
+                if log is not None:
+                    log.write(json.dumps(dict(record, time=t), ensure_ascii=False) + "\n")
+            except (OSError, ValueError) as e:  # disk full, or closed by a disable racing a segment
+                print("metrics log failed: %r" % e, file=sys.stderr)
+            for callback in self.hooks:
+                try:
+                    callback(record)
+                except Exception as e:
+                    print("metrics hook failed: %r" % e, file=sys.stderr)
+            self.finished.task_done()
+
+    def flush(self):
+        "Wait until every finished record is logged and went through the hooks"
+        self.finished.join()
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+
+    def prometheus(self, prefix: str = "memetts_") -> str:
+        "Prometheus text exposition format"
+        with self.lock:
+            lines = []
+            for name, histogram in self.histograms.items():
+                lines += histogram.prometheus(prefix + name + "_seconds")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {name: Histogram() for name in self.HISTOGRAMS}
+
+
+metrics = Metrics()
+if os.getenv("MEMETTS_METRICS"):
+    metrics.enable(None if os.getenv("MEMETTS_METRICS") in ("1", "true") else os.getenv("MEMETTS_METRICS"))
+
+
+if __name__ == "__main__":
+    # python metrics.py log.jsonl [--prometheus], histograms of a JSON lines log
+    replay = Metrics()
+    with open(sys.argv[1], encoding="utf8") as f:
+        for line in f:
+            record = json.loads(line)
+            for name in Metrics.HISTOGRAMS:
+                if record.get(name) is not None:
+                    replay.histograms[name].observe(record[name])
+    if "--prometheus" in sys.argv:
+        print(replay.prometheus(), end="")
+    else:
+        print(json.dumps(replay.snapshot(), indent=4))
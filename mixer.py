@@ -0,0 +1,148 @@
+from typing import Callable
+from collections import deque
+from threading import Condition, Thread
+import time
+import numpy as np
+import pydub
+from audio import PyAudioSink, convert
+
+
+def db_to_gain(db: float) -> float:
+    return 10 ** (db / 20)
+
+
+class Mixer:
+    """Loops a background track from memory and mixes queued voice segments over it into one output stream.
+    Volumes are read again for every block so changing them never restarts anything, the music is ducked
+    while a voice plays and the sum is clipped to 16 bit"""
+    def __init__(self, sink = None, frame_rate: int = 44100, channels: int = 2, block_frames: int = 1024,
+                 music_db: float = 0., voice_db: float = 0., duck_db: float = -8., duck_seconds: float = .15):
+        self.sink = sink if sink is not None else PyAudioSink()
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.block_frames = block_frames
+        self.music_db = music_db
+        self.voice_db = voice_db
+        self.duck_db = duck_db  # extra music gain while a voice plays
+        # how far the ducking gain may move per block, so it fades over duck_seconds instead of clicking
+        self.duck_step = min(block_frames / (duck_seconds * frame_rate), 1.) if duck_seconds else 1.
+        self.duck = 1.
+        self.music: np.ndarray | None = None
+        self.music_pos = 0
+        self.music_on = False
+        self.voices: deque = deque()  # [frames, position, mark, idle since]
+        self.drained_at = time.perf_counter()  # when the last voice finished
+        self.closed = False
+        self.cond = Condition()
+        self.sink.open(frame_rate, channels, 2)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def frames(self, segment: pydub.AudioSegment) -> np.ndarray:
+        "int16 frames of segment in the output format, a view without copying when it already is in it"
+        segment = convert(segment, self.frame_rate, self.channels, 2)
+        return np.frombuffer(segment.raw_data, dtype=np.int16).reshape(-1, self.channels)
+
+    def set_music(self, segment: pydub.AudioSegment | None):
+        "Loop segment in the background from now on, decoded and converted only this once"
+        music = self.frames(segment) if segment is not None else None
+        with self.cond:
+            self.music = music if music is not None and len(music) else None
+            self.music_pos = 0
+            self.music_on = self.music is not None
+            self.cond.notify_all()
+
+    def stop_music(self):
+        with self.cond:
+            self.music_on = False
+
+    def play(self, segment: pydub.AudioSegment, mark: Callable[[float, float | None], None] | None = None):
+        "Queue a voice segment after the ones already queued, same mark as Player.play"
+        frames = self.frames(segment)
+        with self.cond:
+            self.voices.append([frames, 0, mark, None if self.voices else self.drained_at])
+            self.cond.notify_all()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        "Block until every queued voice has been mixed"
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.voices or self.closed, timeout)
+
+    def idle(self) -> bool:
+        with self.cond:
+            return not self.voices
+
+    def clear(self):
+        "Drop the queued voices, the music keeps playing"
+        with self.cond:
+            self.voices.clear()
+            self.drained_at = time.perf_counter()
+            self.cond.notify_all()
+
+    def _run(self):
+        n = self.block_frames
+        block = np.empty((n, self.channels), dtype=np.float32)
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or self.voices or self.music_on)
+                if self.closed:
+                    break
+                block.fill(0.)
+                marks = self._mix_voices(block) if self.voices else []
+                talking = bool(marks) or bool(self.voices)
+                music = self.music if self.music_on else None
+            duck = self._duck(talking)
+            if music is not None:
+                self._mix_music(block, music, duck)
+            np.clip(block, -32768, 32767, out=block)
+            now = time.perf_counter()
+            for mark, idle in marks:
+                mark(now, idle)
+            self.sink.write(block.astype(np.int16).tobytes())
+
+    def _mix_voices(self, block: np.ndarray) -> list:
+        "Add voices to block back to back, returns the marks of the ones that started in it"
+        gain = db_to_gain(self.voice_db)
+        marks = []
+        filled = 0
+        while self.voices and filled < len(block):
+            voice = self.voices[0]
+            frames, pos, mark, idle = voice
+            if pos == 0 and mark is not None:
+                marks.append((mark, idle))
+            take = min(len(block) - filled, len(frames) - pos)
+            block[filled:filled + take] += frames[pos:pos + take] * gain
+            filled += take
+            voice[1] = pos + take
+            if voice[1] >= len(frames):
+                self.voices.popleft()
+                if not self.voices:
+                    self.drained_at = time.perf_counter()
+                    self.cond.notify_all()
+        return marks
+
+    def _duck(self, talking: bool) -> np.ndarray:
+        "Per frame ducking gain for this block, a linear ramp towards the target"
+        target = db_to_gain(self.duck_db) if talking else 1.
+        start = self.duck
+        step = (1. - db_to_gain(self.duck_db)) * self.duck_step
+        self.duck = max(start - step, target) if target < start else min(start + step, target)
+        return np.linspace(start, self.duck, self.block_frames, dtype=np.float32)[:, None]
+
+    def _mix_music(self, block: np.ndarray, music: np.ndarray, duck: np.ndarray):
+        gain = duck * db_to_gain(self.music_db)
+        pos = self.music_pos % len(music)
+        filled = 0
+        while filled < len(block):
+            take = min(len(block) - filled, len(music) - pos)
+            block[filled:filled + take] += music[pos:pos + take] * gain[filled:filled + take]
+            filled += take
+            pos = (pos + take) % len(music)
+        self.music_pos = pos
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.sink.close()
@@ -0,0 +1,86 @@
+"""Local stand-in for an OpenAI compatible chat completions endpoint, streams a canned answer
+
+python mock_llm.py [--port 8000] [--first-token 0.3] [--delay 0.02]
+MEMETTS_LLM_URL=http://127.0.0.1:8000/v1 DEEPSEEK_API_KEY=x python llm.py
+Every request is printed with its message count and prompt_tokens, counted with history.estimate"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+import argparse
+import json
+import time
+import sys
+from history import estimate, History
+
+
+def prompt_tokens(messages: List[Dict]) -> int:
+    return sum(estimate(message.get("content") or "") + History.OVERHEAD for message in messages)
+
+
+class Handler(BaseHTTPRequestHandler):
+    reply = "收到,{}"
+    first_token = 0.
+    delay = 0.
+    piece = 4  # characters per streamed chunk
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        messages = body.get("messages", [])
+        tokens = prompt_tokens(messages)
+        user = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+        answer = self.reply.format(user.strip()[:50])
+        print(json.dumps({"messages": len(messages), "prompt_tokens": tokens, "bytes": len(json.dumps(messages, ensure_ascii=False).encode("utf8"))}),
+              file=sys.stderr, flush=True)
+        usage = {"prompt_tokens": tokens, "completion_tokens": estimate(answer), "total_tokens": tokens + estimate(answer)}
+        base = {"id": "chatcmpl-mock", "created": int(time.time()), "model": body.get("model", "mock")}
+        if not body.get("stream"):
+            self._json(dict(base, object="chat.completion", usage=usage,
+                            choices=[{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}]))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        time.sleep(self.first_token)
+        chunk = dict(base, object="chat.completion.chunk")
+        for i in range(0, len(answer), self.piece):
+            self._event(dict(chunk, choices=[{"index": 0, "delta": {"role": "assistant", "content": answer[i:i + self.piece]}, "finish_reason": None}]))
+            time.sleep(self.delay)
+        self._event(dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._event(dict(chunk, choices=[], usage=usage))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _event(self, data: Dict):
+        self.wfile.write(b"data: " + json.dumps(data, ensure_ascii=False).encode("utf8") + b"\n\n")
+        self.wfile.flush()
+
+    def _json(self, data: Dict):
+        body = json.dumps(data, ensure_ascii=False).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local stand-in for the chat completions endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--reply", default=Handler.reply, help="answer, {} is replaced with the start of the last user message")
+    parser.add_argument("--first-token", type=float, default=0., help="seconds before the first chunk")
+    parser.add_argument("--delay", type=float, default=0., help="seconds between chunks")
+    args = parser.parse_args()
+    Handler.reply = args.reply
+    Handler.first_token = args.first_token
+    Handler.delay = args.delay
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print("listening on http://%s:%d/v1" % (args.host, args.port), file=sys.stderr)
+    server.serve_forever()
@@ -1,6 +1,6 @@
-from utils import load, speak
+from utils import load_cached, speak
 import random
 
-data = load("./audios")
+data, _ = load_cached("./audios")
 while True:
     speak(random.choice(list(data.keys())), data)
\ No newline at end of file
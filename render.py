@@ -0,0 +1,205 @@
+from typing import Dict, List, Tuple
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
+from pathlib import Path
+import argparse
+import json
+import time
+import os
+import pydub
+from utils import load_cached, ACAutomaton, TEXT
+from audio import clips, convert, ANALYSIS, BANK
+from synth import Synthesizer, BACKENDS, default_synthesizer
+
+
+def render(text: str, data: Dict, ptrie: ACAutomaton | None = None, synthesizer: Synthesizer | None = None, workers: int | None = None,
+           frame_rate: int = 44100, channels: int = 2, sample_width: int = 2, executor: Executor | None = None,
+           table: List | None = None) -> Tuple[pydub.AudioSegment, Dict[str, float]]:
+    """The whole utterance as one segment, clips are decoded on a thread pool while speech is synthesized.
+    executor is used instead of a pool of its own, it must not be the one this call runs on,
+    table is ptrie.clips(data) when the caller keeps it"""
+    synthesizer = synthesizer or default_synthesizer()
+    t0 = time.perf_counter()
+    segments = _segments(text, data, ptrie, table)
+    t1 = time.perf_counter()
+    pool = executor if executor is not None else ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+    try:
+        futures: List[Future] = [pool.submit(clips.get, clip) if clip is not None else synthesizer.submit(words) for clip, words in segments]
+        parts = [convert(future.result(), frame_rate, channels, sample_width) for future in futures]
+    finally:
+        if executor is None:
+            pool.shutdown()
+    t2 = time.perf_counter()
+    result = pydub.AudioSegment(data=b"".join(part.raw_data for part in parts), frame_rate=frame_rate, channels=channels, sample_width=sample_width)
+    t3 = time.perf_counter()
+    duration = len(result.raw_data) / (frame_rate * channels * sample_width)
+    stats = {
+        "segments": len(segments),
+        "split": t1 - t0,
+        "decode": t2 - t1,
+        "concat": t3 - t2,
+        "render": t3 - t0,
+        "duration": duration,
+        "rtf": (t3 - t0) / duration if duration else 0.,
+    }
+    return result, stats
+
+
+def _segments(text: str, data: Dict, ptrie: ACAutomaton | None = None, table: List | None = None) -> List[Tuple]:
+    "(clip, None) for every meme and (None, text) for the plain text between them, straight from the spans without splitting"
+    matcher = ptrie if isinstance(ptrie, ACAutomaton) else ACAutomaton(data)
+    table = table if table is not None else matcher.clips(data)
+    spans = matcher.split_spans(text)
+    segments = []
+    plain = None  # start of the pending plain text
+    for i in range(0, len(spans), 3):
+        start, end, clip = spans[i], spans[i + 1], spans[i + 2]
+        clip = table[clip] if clip != TEXT else None
+        if clip is None:
+            if plain is None:
+                plain = start
+            continue
+        if plain is not None and text[plain:start].strip():
+            segments.append((None, text[plain:start]))
+        plain = None
+        segments.append((clip, None))
+    if plain is not None and text[plain:].strip():
+        segments.append((None, text[plain:]))
+    return segments
+
+
+def export(segment: pydub.AudioSegment, path: str | Path):
+    "Write segment, the format comes from the suffix (wav, mp3, ...)"
+    path = Path(path)
+    segment.export(path, format=path.suffix.lstrip(".").lower() or "wav")
+
+
+_worker: Dict = {}
+
+def _init_worker(dir: str, map: str | None, bank: str, synth: str | None, normalizer: str | None = None, analysis: str = ANALYSIS,
+                 threads: int = 4):
+    "Runs once in every worker process, so the lexicon, matcher, decode pool and synthesizer are warm for all its jobs"
+    data, matcher = load_cached(dir, map, normalizer=normalizer)
+    clips.use_analysis(analysis)
+    clips.use_bank(bank)
+    _worker["data"] = data
+    _worker["matcher"] = matcher
+    _worker["table"] = matcher.clips(data)
+    _worker["synthesizer"] = BACKENDS[synth]() if synth else default_synthesizer()
+    _worker["decoder"] = ThreadPoolExecutor(max_workers=threads)
+
+def _run_job(job: Dict, out: str) -> Dict:
+    options = job.get("options") or {}
+    fmt = options.get("format", "wav")
+    name = "%s.%s" % (job["id"], fmt)
+    path = Path(out) / name
+    try:
+        # id and format come from the job file, together they must name a file right in out
+        if Path(name).name != name or path.resolve().parent != Path(out).resolve():
+            raise ValueError("output %s is not a file in %s" % (path, out))
+        segment, stats = render(
+            job["text"], _worker["data"], ptrie=_worker["matcher"], table=_worker["table"], synthesizer=_worker["synthesizer"], executor=_worker["decoder"],
+            frame_rate=options.get("frame_rate", 44100), channels=options.get("channels", 2), sample_width=options.get("sample_width", 2),
+        )
+        t = time.perf_counter()
+        export(segment, path)
+        stats["export"] = time.perf_counter() - t
+    except Exception as e:
+        return {"id": job["id"], "ok": False, "error": repr(e)}
+    return {"id": job["id"], "ok": True, "output": str(path), **stats}
+
+
+def _read_jobs(jobs: str | Path) -> Tuple[List[Dict], List[Dict]]:
+    "The jobs of a JSONL file and a failed result for every line that is not one, including repeated ids"
+    todo, bad = [], []
+    ids = set()
+    with open(jobs, encoding="utf8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                bad.append({"id": None, "line": number, "ok": False, "error": "not JSON: %s" % e})
+                continue
+            if not isinstance(job, dict) or not isinstance(job.get("id"), str | int):
+                bad.append({"id": None, "line": number, "ok": False, "error": "no id"})
+            elif str(job["id"]) in ids:  # both would be rendered into the same file at once
+                bad.append({"id": job["id"], "line": number, "ok": False, "error": "duplicate id"})
+            else:
+                ids.add(str(job["id"]))
+                todo.append(job)
+    return todo, bad
+
+
+def batch(jobs: str | Path, out: str | Path, processes: int | None = None, dir: str = "./audios", map: str | None = "./name.json",
+          bank: str = BANK, synth: str | None = None, normalizer: str | None = "./normalize.json",
+          analysis: str = ANALYSIS, threads: int = 4) -> Dict[str, float]:
+    """Render every job of a JSONL file ({"id", "text", "options"}) into out, one file per job, on processes workers
+    that decode clips on threads threads each.
+    Results are appended to out/results.jsonl as they finish, jobs already there are skipped so a crashed run can resume.
+    Lines that are not a job with an id, and repeated ids, are recorded there as failed instead of stopping the run"""
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+    manifest = out / "results.jsonl"
+    done = set()
+    if manifest.exists():
+        with open(manifest, encoding="utf8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # last line of a crashed run
+                if result.get("ok") and Path(result["output"]).exists():
+                    done.add(str(result["id"]))
+    valid, invalid = _read_jobs(jobs)
+    todo = [job for job in valid if str(job["id"]) not in done]
+    # build the lexicon cache once here so the workers only read it
+    load_cached(dir, map, normalizer=normalizer)
+    totals: Dict[str, float] = {}
+    failed = 0
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(dir, map, bank, synth, normalizer, analysis, threads)) as executor, \
+            open(manifest, "a", encoding="utf8") as results:
+        for result in invalid:
+            results.write(json.dumps(result, ensure_ascii=False) + "\n")
+        futures = [executor.submit(_run_job, job, str(out)) for job in todo]
+        for future in as_completed(futures):
+            result = future.result()
+            results.write(json.dumps(result, ensure_ascii=False) + "\n")
+            results.flush()
+            if not result["ok"]:
+                failed += 1
+                continue
+            for key in ("split", "decode", "concat", "export", "render", "duration"):
+                totals[key] = totals.get(key, 0.) + result[key]
+    elapsed = time.perf_counter() - t0
+    rendered = len(todo) - failed
+    summary = {
+        "jobs": len(todo),
+        "skipped": len(valid) - len(todo),
+        "failed": failed,
+        "invalid": len(invalid),
+        "elapsed": elapsed,
+        "jobs_per_second": rendered / elapsed if elapsed else 0.,
+        "rtf": elapsed / totals["duration"] if totals.get("duration") else 0.,
+    }
+    for key, value in totals.items():
+        summary["mean_" + key] = value / rendered
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render a JSONL job file, one audio file per job")
+    parser.add_argument("jobs")
+    parser.add_argument("out")
+    parser.add_argument("-j", "--processes", type=int, default=None)
+    parser.add_argument("-t", "--threads", type=int, default=4, help="clip decoding threads per process")
+    parser.add_argument("--audios", default="./audios")
+    parser.add_argument("--map", default="./name.json")
+    parser.add_argument("--bank", default=BANK)
+    parser.add_argument("--analysis", default=ANALYSIS)
+    parser.add_argument("--synth", default=None, choices=list(BACKENDS))
+    parser.add_argument("--normalize", default="./normalize.json", help="normalizer settings, empty to match text as it is")
+    args = parser.parse_args()
+    summary = batch(args.jobs, args.out, args.processes, args.audios, args.map, args.bank, args.synth, args.normalize or None, args.analysis, args.threads)
+    print(json.dumps(summary, indent=4))
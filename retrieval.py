@@ -0,0 +1,62 @@
+"""Picks the memes worth offering the LLM for one turn, so the system prompt does not list the whole library"""
+from typing import Callable, Dict, Iterable, List, Mapping, Tuple
+from collections import defaultdict
+from pathlib import Path
+import heapq
+import math
+
+
+def grams(text: str, n: int = 2) -> List[str]:
+    "Character 1 to n-grams"
+    return [text[i:i + k] for k in range(1, n + 1) for i in range(len(text) - k + 1)]
+
+
+class MemeIndex:
+    """Character n-gram inverted index over the name of every clip and all its aliases from the map.
+    A gram counts once per meme, weighted by its idf and divided by the square root of how many grams the meme has,
+    so rare shared characters outweigh common ones and long alias lists do not win by size"""
+    def __init__(self, data: Mapping[str, Path], fold: Callable[[str], str] | None = None, n: int = 2):
+        self.fold = fold or (lambda text: text)
+        self.n = n
+        aliases: Dict[str, set] = {}  # meme -> every name it is matched by
+        for word, file in data.items():
+            aliases.setdefault(Path(file).stem, set()).add(word)
+        self.names = list(aliases)
+        # memes matched by the most names first, what a turn without a single hit falls back on
+        self.popular = sorted(self.names, key=lambda name: -len(aliases[name]))
+        self.last: List[str] = []  # the previous turn's hits
+        docs = []
+        for name in self.names:
+            docs.append(set(gram for alias in aliases[name] | {name} for gram in grams(self.fold(alias), n)))
+        df: Dict[str, int] = defaultdict(int)
+        for doc in docs:
+            for gram in doc:
+                df[gram] += 1
+        self.postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+        for i, doc in enumerate(docs):
+            norm = math.sqrt(len(doc)) or 1.
+            for gram in doc:
+                self.postings[gram].append((i, math.log(1 + len(docs) / df[gram]) / norm))
+
+    def scores(self, text: str, weight: float = 1., into: Dict[int, float] | None = None) -> Dict[int, float]:
+        into = {} if into is None else into
+        for gram in set(grams(self.fold(text), self.n)):
+            for i, w in self.postings.get(gram, ()):
+                into[i] = into.get(i, 0.) + w * weight
+        return into
+
+    def search(self, text: str, k: int = 20, context: Iterable[str] = (), context_weight: float = .5) -> List[str]:
+        """The k memes closest to text, context (recent messages) counts context_weight as much.
+        Fewer than k hits are topped up with the previous turn's hits and then the most aliased memes, never empty"""
+        scores = self.scores(text)
+        for message in context:
+            self.scores(message, context_weight, scores)
+        best = [self.names[i] for i, _ in heapq.nlargest(k, scores.items(), key=lambda item: item[1])]
+        if best:
+            self.last = best
+        if len(best) < k:
+            best = list(dict.fromkeys(best + self.last + self.popular[:k]))[:k]
+        return best
+
+    def __len__(self):
+        return len(self.names)
@@ -0,0 +1,432 @@
+"""Service mode: one warm lexicon, matcher, clip cache and synthesizer shared by every client
+
+python server.py [--port 8765] [-j workers] [--synth fake]
+POST /segment  text, or {"text": ...} as JSON, gives the segments like cli.py segment --spans
+POST /render   text, or {"text", "frame_rate", "channels", "sample_width"}, gives the utterance as audio/wav
+GET  /stream   WebSocket, every text message is a chunk of text and an empty one ends the utterance.
+               The server sends the PCM format as JSON first, then for every segment in order as soon as it is resolved
+               {"type": "segment", "text", "clip", "bytes"} followed by its PCM in binary messages of up to 64 KB,
+               and {"type": "done"} once an utterance is through
+GET  /metrics  requests, errors, bytes and latency per endpoint, ?format=prometheus for the text format
+GET  /health
+HTTP/1.1 with keep-alive and WebSocket (RFC 6455) are implemented on asyncio streams, so this needs nothing besides
+what playing already needs. Splitting, decoding and rendering run on a thread pool, the event loop only moves bytes"""
+from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import asyncio
+import hashlib
+import base64
+import struct
+import json
+import time
+import wave
+import sys
+import io
+import os
+from utils import ACAutomaton, Lexicon, StreamSplitter, TEXT
+from audio import clips, convert, ANALYSIS, BANK
+from synth import Synthesizer, BACKENDS, default_synthesizer
+from metrics import Histogram
+from render import render
+
+MAX_BODY = 1 << 20
+MAX_MESSAGE = 1 << 20
+FRAME = 1 << 16  # bytes of PCM per binary message
+FORMATS = {"frame_rate": (8000, 11025, 16000, 22050, 24000, 32000, 44100, 48000), "channels": (1, 2), "sample_width": (1, 2, 4)}
+GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+REASONS = {200: "OK", 101: "Switching Protocols", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+def _unmask(payload: bytes, mask: bytes) -> bytes:
+    n = len(payload)
+    key = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, "little") ^ int.from_bytes(key, "little")).to_bytes(n, "little")
+
+
+def accept_key(key: str) -> str:
+    return base64.b64encode(hashlib.sha1(key.encode("ascii") + GUID).digest()).decode("ascii")
+
+
+class WebSocket:
+    "Text and binary messages over asyncio streams, no extensions. Clients mask what they send, servers do not"
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, client: bool = False):
+        self.reader = reader
+        self.writer = writer
+        self.client = client
+        self.closed = False
+
+    async def receive(self) -> str | bytes | None:
+        "The next message, None once the other side closed"
+        parts = []
+        opcode = 0
+        while True:
+            head = await self.reader.readexactly(2)
+            fin, op = head[0] & 0x80, head[0] & 0x0F
+            n = head[1] & 0x7F
+            if n == 126:
+                (n,) = struct.unpack("!H", await self.reader.readexactly(2))
+            elif n == 127:
+                (n,) = struct.unpack("!Q", await self.reader.readexactly(8))
+            if n + sum(map(len, parts)) > MAX_MESSAGE:
+                await self.close(1009)
+                return None
+            mask = await self.reader.readexactly(4) if head[1] & 0x80 else None
+            payload = await self.reader.readexactly(n)
+            if mask is not None:
+                payload = _unmask(payload, mask)
+            if op == 0x8:
+                await self.close()
+                return None
+            if op == 0x9:
+                await self._send(0xA, payload)
+                continue
+            if op == 0xA:
+                continue
+            if op:
+                opcode = op
+            parts.append(payload)
+            if fin:
+                data = b"".join(parts)
+                return data.decode("utf8") if opcode == 0x1 else data
+
+    async def send(self, message: str | bytes | memoryview):
+        if isinstance(message, str):
+            await self._send(0x1, message.encode("utf8"))
+        else:
+            await self._send(0x2, message)
+
+    async def _send(self, opcode: int, payload: bytes):
+        if self.closed:
+            return
+        n = len(payload)
+        mask = 0x80 if self.client else 0
+        if n < 126:
+            head = struct.pack("!BB", 0x80 | opcode, mask | n)
+        elif n < 1 << 16:
+            head = struct.pack("!BBH", 0x80 | opcode, mask | 126, n)
+        else:
+            head = struct.pack("!BBQ", 0x80 | opcode, mask | 127, n)
+        if self.client:
+            key = os.urandom(4)
+            head += key
+            payload = _unmask(payload, key)
+        self.writer.write(head)
+        self.writer.write(payload)
+        await self.writer.drain()
+
+    async def close(self, code: int = 1000):
+        if not self.closed:
+            try:
+                await self._send(0x8, struct.pack("!H", code))
+            except ConnectionError:
+                pass
+            self.closed = True
+
+
+class Stats:
+    "Request count, errors, bytes sent and a latency histogram per endpoint, only touched from the event loop"
+    def __init__(self):
+        self.endpoints: Dict[str, Dict] = {}
+        self.active = 0  # requests and streams being served
+        self.started = time.time()
+
+    def record(self, endpoint: str, seconds: float, ok: bool = True, sent: int = 0):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = {"requests": 0, "errors": 0, "bytes": 0, "latency": Histogram()}
+        stats["requests"] += 1
+        stats["errors"] += not ok
+        stats["bytes"] += sent
+        stats["latency"].observe(seconds)
+
+    def snapshot(self) -> Dict:
+        return {
+            "uptime": time.time() - self.started,
+            "active": self.active,
+            "endpoints": {name: dict(stats, latency=stats["latency"].snapshot()) for name, stats in self.endpoints.items()},
+        }
+
+    def prometheus(self, prefix: str = "memetts_server_") -> str:
+        lines = ["# TYPE %sactive gauge" % prefix, "%sactive %d" % (prefix, self.active)]
+        for name, stats in self.endpoints.items():
+            for key in ("requests", "errors", "bytes"):
+                lines.append("%s%s_%s_total %d" % (prefix, name, key, stats[key]))
+            lines += stats["latency"].prometheus("%s%s_seconds" % (prefix, name))
+        return "\n".join(lines) + "\n"
+
+
+class Server:
+    """Serves every connection from the same lexicon, clip cache and synthesizer. A stream resolves up to lookahead
+    segments at a time and sends them in the order they were split"""
+    def __init__(self, lexicon: Lexicon, synthesizer: Synthesizer | None = None, workers: int | None = None, lookahead: int = 4,
+                 frame_rate: int = 44100, channels: int = 2, sample_width: int = 2, log: bool = True):
+        self.lexicon = lexicon
+        self.synthesizer = synthesizer if synthesizer is not None else default_synthesizer()
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        # clips of /render requests, which block on them from self.executor so they need a pool of their own
+        self.decoder = ThreadPoolExecutor(max_workers=self.workers)
+        self.lookahead = lookahead
+        self.format = {"frame_rate": frame_rate, "channels": channels, "sample_width": sample_width}
+        self.stats = Stats()
+        self.log = log
+        self.tables: Dict[int, List] = {}  # clip id -> clip of the current lexicon version, built once per version
+
+    def _current(self) -> Tuple[Dict, ACAutomaton, List]:
+        "The lexicon and matcher to use now, with the clip table of their version"
+        version, data, matcher = self.lexicon.current()
+        table = self.tables.get(version)
+        if table is None:
+            table = matcher.clips(data)
+            self.tables = {version: table}  # replaced rather than changed, requests may be reading the old one
+        return data, matcher, table
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        "One connection, requests are served one after another until the client closes it or upgrades to a stream"
+        try:
+            while True:
+                request = await self._request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                url = urlsplit(target)
+                if url.path == "/stream" and headers.get("upgrade", "").lower() == "websocket":
+                    await self._stream(reader, writer, headers)
+                    break
+                t = time.perf_counter()
+                self.stats.active += 1
+                try:
+                    if body is None:  # left unread, so the connection can not go on after the answer
+                        error = self._json({"error": "body over %d bytes" % MAX_BODY})
+                        status, content_type, payload, extra = 413, "application/json", error, {"Connection": "close"}
+                    else:
+                        status, content_type, payload, extra = await self._route(method, url.path, parse_qs(url.query), headers, body)
+                except Exception as e:
+                    status, content_type, payload, extra = 500, "application/json", self._json({"error": repr(e)}), {}
+                finally:
+                    self.stats.active -= 1
+                self._respond(writer, status, content_type, payload, extra)
+                await writer.drain()
+                elapsed = time.perf_counter() - t
+                if url.path in self.ROUTES:
+                    self.stats.record(url.path.strip("/"), elapsed, status < 400, len(payload))
+                if self.log:
+                    print(json.dumps({"method": method, "path": url.path, "status": status, "bytes": len(payload), "seconds": round(elapsed, 4)}),
+                          file=sys.stderr, flush=True)
+                if body is None or headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _request(self, reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str], bytes | None] | None:
+        "The next request, its body is None when it is over MAX_BODY"
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, _ = line.decode("latin1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY:
+            return method, target, headers, None
+        return method, target, headers, await reader.readexactly(length) if length else b""
+
+    def _respond(self, writer: asyncio.StreamWriter, status: int, content_type: str, payload: bytes, extra: Dict[str, str] = {}):
+        head = ["HTTP/1.1 %d %s" % (status, REASONS.get(status, "")), "Content-Type: " + content_type, "Content-Length: %d" % len(payload)]
+        head += ["%s: %s" % item for item in extra.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin1"))
+        writer.write(payload)
+
+    @staticmethod
+    def _json(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False).encode("utf8")
+
+    ROUTES = {"/segment": "POST", "/render": "POST", "/metrics": "GET", "/health": "GET"}
+
+    async def _route(self, method: str, path: str, query: Dict[str, List[str]], headers: Dict[str, str], body: bytes):
+        if path not in self.ROUTES:
+            return 404, "application/json", self._json({"error": "no such endpoint"}), {}
+        if method != self.ROUTES[path]:
+            return 405, "application/json", self._json({"error": "use " + self.ROUTES[path]}), {"Allow": self.ROUTES[path]}
+        loop = asyncio.get_running_loop()
+        if path == "/health":
+            version, data, _ = self.lexicon.current()
+            return 200, "application/json", self._json({"ok": True, "lexicon": version, "words": len(data), "workers": self.workers}), {}
+        if path == "/metrics":
+            if query.get("format") == ["prometheus"]:
+                return 200, "text/plain; version=0.0.4", self.stats.prometheus().encode("utf8"), {}
+            return 200, "application/json", self._json(dict(self.stats.snapshot(), clips=clips.stats())), {}
+        try:
+            options = json.loads(body) if headers.get("content-type", "").startswith("application/json") else {"text": body.decode("utf8")}
+        except ValueError as e:  # bad JSON or not UTF-8
+            return 400, "application/json", self._json({"error": "unreadable body: %s" % e}), {}
+        if not isinstance(options, dict) or not isinstance(options.get("text"), str):
+            return 400, "application/json", self._json({"error": "no text"}), {}
+        if path == "/segment":
+            segments = await loop.run_in_executor(self.executor, self._segment, options["text"])
+            return 200, "application/json", self._json(segments), {}
+        fmt = dict(self.format)
+        for key, allowed in FORMATS.items():
+            if key in options:
+                if type(options[key]) is not int or options[key] not in allowed:
+                    return 400, "application/json", self._json({"error": "%s must be one of %s" % (key, list(allowed))}), {}
+                fmt[key] = options[key]
+        wav, stats = await loop.run_in_executor(self.executor, self._render, options["text"], fmt)
+        return 200, "audio/wav", wav, {"X-Render-Stats": json.dumps(stats)}
+
+    def _segment(self, text: str) -> List[Dict]:
+        _, matcher, table = self._current()
+        spans = matcher.split_spans(text)
+        segments = []
+        for i in range(0, len(spans), 3):
+            start, end, clip = spans[i], spans[i + 1], spans[i + 2]
+            clip = table[clip] if clip != TEXT else None
+            segments.append({"start": start, "end": end, "text": text[start:end], "clip": str(clip) if clip is not None else None})
+        return segments
+
+    def _render(self, text: str, fmt: Dict[str, int]) -> Tuple[bytes, Dict[str, float]]:
+        data, matcher, table = self._current()
+        segment, stats = render(text, data, ptrie=matcher, table=table, synthesizer=self.synthesizer, executor=self.decoder, **fmt)
+        out = io.BytesIO()
+        with wave.open(out, "wb") as f:
+            f.setnchannels(segment.channels)
+            f.setsampwidth(segment.sample_width)
+            f.setframerate(segment.frame_rate)
+            f.writeframes(segment.raw_data)
+        return out.getvalue(), stats
+
+    async def _pcm(self, word: str, path) -> bytes:
+        "A segment in the stream's format, empty for blank text"
+        loop = asyncio.get_running_loop()
+        if path is not None:
+            clip = await loop.run_in_executor(self.executor, clips.get, path)
+        elif word.strip():
+            clip = await asyncio.wrap_future(self.synthesizer.submit(word))
+        else:
+            return b""
+        return await loop.run_in_executor(self.executor, lambda: convert(clip, **self.format).raw_data)
+
+    async def _stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: Dict[str, str]):
+        key = headers.get("sec-websocket-key")
+        if not key:
+            self._respond(writer, 400, "application/json", self._json({"error": "no Sec-WebSocket-Key"}))
+            return
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      "Sec-WebSocket-Accept: %s\r\n\r\n" % accept_key(key)).encode("latin1"))
+        ws = WebSocket(reader, writer)
+        await ws.send(json.dumps(dict(self.format, type="format")))
+        pending: asyncio.Queue = asyncio.Queue(self.lookahead)
+        sender = asyncio.create_task(self._send(ws, pending))
+        self.stats.active += 1
+        try:
+            _, data, matcher = self.lexicon.current()
+            splitter = StreamSplitter(data, ptrie=matcher)
+            utterance = None  # what the stats of the current utterance are collected in
+            while not sender.done():
+                message = await ws.receive()
+                if message is None:
+                    break
+                if not isinstance(message, str):
+                    continue
+                if utterance is None:
+                    utterance = {"started": time.perf_counter(), "first": None, "bytes": 0, "ok": True}
+                for word in splitter.feed(message) if message else splitter.flush():
+                    path = data.get(word)
+                    await pending.put((word, path, asyncio.ensure_future(self._pcm(word, path)), utterance))
+                if not message:
+                    await pending.put((None, None, None, utterance))
+                    utterance = None
+                    _, data, matcher = self.lexicon.current()  # a reload is picked up between utterances
+                    splitter = StreamSplitter(data, ptrie=matcher)
+        except (asyncio.IncompleteReadError, ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            # nobody is listening any more, drop whatever is still being resolved
+            self.stats.active -= 1
+            sender.cancel()
+            while not pending.empty():
+                future = pending.get_nowait()[2]
+                if future is not None:
+                    future.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            await ws.close()
+
+    async def _send(self, ws: WebSocket, pending: asyncio.Queue):
+        "Sends the segments of a stream in order, one utterance at a time"
+        while True:
+            item = await pending.get()
+            try:
+                await self._send_segment(ws, *item)
+            except ConnectionError:
+                ws.closed = True  # the client is gone, keep emptying the queue so the reading side never waits on it
+
+    async def _send_segment(self, ws: WebSocket, word: str | None, path, future: asyncio.Future | None, utterance: Dict):
+        if future is None:
+            elapsed = time.perf_counter() - utterance["started"]
+            self.stats.record("stream", elapsed, utterance["ok"], utterance["bytes"])
+            if utterance["first"] is not None:
+                self.stats.record("stream_first_audio", utterance["first"] - utterance["started"])
+            await ws.send(json.dumps({"type": "done", "seconds": round(elapsed, 4)}))
+            return
+        try:
+            await asyncio.wait([future])  # unlike await future, a cancelled segment does not look like a cancelled sender
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        error = asyncio.CancelledError("segment was cancelled") if future.cancelled() else future.exception()
+        if error is not None:
+            utterance["ok"] = False
+            await ws.send(json.dumps({"type": "error", "text": word, "error": repr(error)}, ensure_ascii=False))
+            return
+        pcm = future.result()
+        if not pcm:
+            return
+        await ws.send(json.dumps({"type": "segment", "text": word, "clip": str(path) if path is not None else None, "bytes": len(pcm)},
+                                 ensure_ascii=False))
+        view = memoryview(pcm)
+        for i in range(0, len(pcm), FRAME):
+            await ws.send(view[i:i + FRAME])
+            if utterance["first"] is None:
+                utterance["first"] = time.perf_counter()
+        utterance["bytes"] += len(pcm)
+
+async def serve(server: Server, host: str = "127.0.0.1", port: int = 8765):
+    listener = await asyncio.start_server(server.handle, host, port)
+    print("listening on http://%s:%d" % (host, port), file=sys.stderr, flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="keep the lexicon and caches warm and serve segmenting, rendering and streaming")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--audios", default="./audios")
+    parser.add_argument("--map", default="./name.json")
+    parser.add_argument("--normalize", default="./normalize.json", help="normalizer settings, empty to match text as it is")
+    parser.add_argument("--bank", default=BANK)
+    parser.add_argument("--analysis", default=ANALYSIS)
+    parser.add_argument("--synth", default=None, choices=list(BACKENDS))
+    parser.add_argument("-q", "--quiet", action="store_true", help="no line per request on stderr")
+    args = parser.parse_args()
+    lexicon = Lexicon(args.audios, args.map, normalizer=args.normalize or None).watch()
+    _, data, _ = lexicon.current()
+    clips.use_analysis(args.analysis)
+    if not clips.use_bank(args.bank):
+        clips.warm(data.values(), wait=False)
+    synthesizer = BACKENDS[args.synth]() if args.synth else default_synthesizer()
+    try:
+        asyncio.run(serve(Server(lexicon, synthesizer, args.workers, log=not args.quiet), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
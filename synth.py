@@ -0,0 +1,444 @@
+from typing import Dict, Iterable, List, Generator, Tuple
+from concurrent.futures import Future
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread, Lock
+from pathlib import Path
+import subprocess
+import unicodedata
+import tempfile
+import hashlib
+import base64
+import json
+import wave
+import shutil
+import time
+import uuid
+import sys
+import os
+import pydub
+
+
+class Synthesizer:
+    "Speech synthesis backend, one long-lived worker thread does all the work so engines stay warm"
+    name = "base"
+
+    def __init__(self, voice: str | None = None, rate: int | None = None):
+        self.voice = voice
+        self.rate = rate
+        self.jobs: Queue = Queue()
+        self.thread: Thread | None = None
+        self.lock = Lock()
+
+    def submit(self, text: str) -> Future:
+        "Queue text, the future resolves to an AudioSegment"
+        future = Future()
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._work, daemon=True)
+                self.thread.start()
+        self.jobs.put((text, future))
+        return future
+
+    def synthesize(self, text: str) -> pydub.AudioSegment:
+        return self.submit(text).result()
+
+    def _work(self):
+        try:
+            self._setup()
+        except Exception as e:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                job[1].set_exception(e)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            text, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._synthesize(text))
+            except Exception as e:
+                future.set_exception(e)
+        self._teardown()
+
+    def _setup(self):
+        "Runs once on the worker thread before the first job"
+
+    def _teardown(self):
+        "Runs on the worker thread after close"
+
+    def _synthesize(self, text: str) -> pydub.AudioSegment:
+        raise NotImplementedError
+
+    def close(self):
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class FakeSynthesizer(Synthesizer):
+    "Silence as long as the text would take to say, records every call, for tests"
+    name = "fake"
+
+    def __init__(self, voice: str | None = None, rate: int | None = None, ms_per_char: int = 80, frame_rate: int = 16000, delay: float = 0.):
+        super().__init__(voice, rate)
+        self.ms_per_char = ms_per_char
+        self.frame_rate = frame_rate
+        self.delay = delay
+        self.calls: List[str] = []
+
+    def _synthesize(self, text: str) -> pydub.AudioSegment:
+        self.calls.append(text)
+        if self.delay:
+            time.sleep(self.delay)
+        return pydub.AudioSegment.silent(duration=len(text) * self.ms_per_char, frame_rate=self.frame_rate)
+
+
+class Pyttsx3Synthesizer(Synthesizer):
+    "pyttsx3 rendering to a temporary file, the engine is created once on the worker thread"
+    name = "pyttsx3"
+
+    def _setup(self):
+        import pyttsx3
+        self.engine = pyttsx3.init()
+        if self.voice is not None:
+            self.engine.setProperty("voice", self.voice)
+        if self.rate is not None:
+            self.engine.setProperty("rate", self.rate)
+        self.tmp = Path(tempfile.mkdtemp(prefix="memetts"))
+
+    def _synthesize(self, text: str) -> pydub.AudioSegment:
+        path = self.tmp / "speech.wav"
+        self.engine.save_to_file(text, str(path))
+        self.engine.runAndWait()
+        return pydub.AudioSegment.from_file(path)
+
+    def _teardown(self):
+        self.engine.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+class EspeakSynthesizer(Synthesizer):
+    "espeak-ng / espeak writing wav to stdout, text goes through stdin so it is never parsed as options"
+    name = "espeak"
+
+    def __init__(self, voice: str | None = None, rate: int | None = None, executable: str | None = None):
+        super().__init__(voice, rate)
+        self.executable = executable or shutil.which("espeak-ng") or shutil.which("espeak") or "espeak-ng"
+
+    def _synthesize(self, text: str) -> pydub.AudioSegment:
+        command = [self.executable, "--stdout", "--stdin"]
+        if self.voice is not None:
+            command += ["-v", self.voice]
+        if self.rate is not None:
+            command += ["-s", str(self.rate)]
+        result = subprocess.run(command, input=" ".join(text.split()).encode("utf8"), capture_output=True, check=True)
+        return pydub.AudioSegment(data=result.stdout)
+
+
+class PowerShellSynthesizer(Synthesizer):
+    "System.Speech in one PowerShell process that stays open, instead of a new powershell for every phrase"
+    name = "powershell"
+
+    def _setup(self):
+        self.process = subprocess.Popen(
+            ["powershell", "-NoProfile", "-NonInteractive", "-Command", "-"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, encoding="utf8",
+        )
+        self.tmp = Path(tempfile.mkdtemp(prefix="memetts"))
+        setup = "Add-Type -AssemblyName System.Speech; $s = New-Object System.Speech.Synthesis.SpeechSynthesizer"
+        if self.voice is not None:
+            setup += "; $s.SelectVoice('%s')" % self.voice.replace("'", "''")
+        if self.rate is not None:
+            setup += "; $s.Rate = %d" % self.rate
+        self._run(setup)
+
+    def _run(self, command: str):
+        marker = uuid.uuid4().hex
+        self.process.stdin.write("%s; [Console]::Out.WriteLine('%s'); [Console]::Out.Flush()\n" % (command, marker))
+        self.process.stdin.flush()
+        for line in self.process.stdout:
+            if line.strip() == marker:
+                return
+        raise RuntimeError("powershell exited")
+
+    def _synthesize(self, text: str) -> pydub.AudioSegment:
+        path = self.tmp / "speech.wav"
+        # base64 keeps quotes and newlines in text from ever reaching the command line
+        encoded = base64.b64encode(text.encode("utf8")).decode("ascii")
+        self._run(
+            "$s.SetOutputToWaveFile('%s'); $s.Speak([Text.Encoding]::UTF8.GetString([Convert]::FromBase64String('%s'))); $s.SetOutputToNull()"
+            % (str(path).replace("'", "''"), encoded)
+        )
+        return pydub.AudioSegment.from_wav(path)
+
+    def _teardown(self):
+        self.process.stdin.close()
+        self.process.wait()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+BACKENDS = {cls.name: cls for cls in (FakeSynthesizer, Pyttsx3Synthesizer, EspeakSynthesizer, PowerShellSynthesizer)}
+
+SPEECH_CACHE = "speech.cache"
+
+
+def normalize(text: str) -> str:
+    "Text as it is synthesized and cached, width folded and whitespace collapsed"
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class SpeechCache:
+    """Synthesized speech keyed by a hash of the normalized text, backend, voice and rate.
+    PCM is kept in WAV files under dir, the least recently used go first once they pass max_bytes,
+    with an LRU of max_memory bytes of segments in front of them. Several processes can share dir, files are written
+    on a writer thread and the budget is kept over everything in dir, not just what this process wrote"""
+    def __init__(self, dir: str | Path = SPEECH_CACHE, max_bytes: int = 512 * 1024 * 1024, max_memory: int = 32 * 1024 * 1024):
+        self.dir = Path(dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_memory = max_memory
+        self.lock = Lock()
+        self.memory: OrderedDict[str, pydub.AudioSegment] = OrderedDict()
+        self.memory_bytes = 0
+        self.files: OrderedDict[str, int] = OrderedDict()  # key -> size, least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes: Queue = Queue()
+        self.writer: Thread | None = None
+        self._rescan()
+
+    def _rescan(self):
+        "Files as they are in dir now, other processes add and evict too, least recently used by mtime first"
+        entries = []
+        for entry in os.scandir(self.dir):
+            if entry.name.endswith(".wav"):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue  # evicted meanwhile
+                entries.append((st.st_mtime_ns, entry.name[:-4], st.st_size))
+        with self.lock:
+            self.files = OrderedDict((key, size) for _, key, size in sorted(entries))
+            self.bytes = sum(self.files.values())
+
+    @staticmethod
+    def key(text: str, backend: str, voice: str | None, rate: int | None) -> str:
+        return hashlib.blake2b(json.dumps([normalize(text), backend, voice, rate], ensure_ascii=False).encode("utf8"), digest_size=16).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.dir / (key + ".wav")
+
+    def get(self, key: str) -> pydub.AudioSegment | None:
+        with self.lock:
+            segment = self.memory.get(key)
+            if segment is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return segment
+            if key not in self.files:
+                self.misses += 1
+                return None
+        path = self.path(key)
+        try:
+            with wave.open(str(path), "rb") as f:
+                segment = pydub.AudioSegment(data=f.readframes(f.getnframes()), sample_width=f.getsampwidth(),
+                                             frame_rate=f.getframerate(), channels=f.getnchannels())
+            os.utime(path)  # the order survives a restart
+        except (OSError, EOFError, wave.Error):
+            with self.lock:
+                self.bytes -= self.files.pop(key, 0)  # evicted by another process
+                self.misses += 1
+            return None
+        with self.lock:
+            if key in self.files:
+                self.files.move_to_end(key)
+            self.disk_hits += 1
+            self._remember(key, segment)
+        return segment
+
+    def put(self, key: str, segment: pydub.AudioSegment):
+        "Served from memory right away, the file is written on the writer thread"
+        with self.lock:
+            self._remember(key, segment)
+            if self.writer is None:
+                self.writer = Thread(target=self._write, daemon=True)
+                self.writer.start()
+        self.writes.put((key, segment))
+
+    def flush(self):
+        "Wait until every put is on disk"
+        self.writes.join()
+
+    def _write(self):
+        while True:
+            key, segment = self.writes.get()
+            try:
+                self._save(key, segment)
+            except (OSError, wave.Error) as e:
+                print("speech cache write failed: %r" % e, file=sys.stderr)
+            finally:
+                self.writes.task_done()
+
+    def _save(self, key: str, segment: pydub.AudioSegment):
+        path = self.path(key)
+        tmp = path.with_name("%s.%d.tmp" % (key, os.getpid()))
+        with wave.open(str(tmp), "wb") as f:
+            f.setnchannels(segment.channels)
+            f.setsampwidth(segment.sample_width)
+            f.setframerate(segment.frame_rate)
+            f.writeframes(segment.raw_data)
+        os.replace(tmp, path)
+        self._rescan()
+        with self.lock:
+            if key in self.files:
+                self.files.move_to_end(key)
+            evicted = []
+            while self.bytes > self.max_bytes and len(self.files) > 1:
+                old, old_size = self.files.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except OSError:
+                pass
+
+    def _remember(self, key: str, segment: pydub.AudioSegment):
+        size = len(segment.raw_data)
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_bytes -= len(old.raw_data)
+        if size > self.max_memory:
+            return
+        self.memory[key] = segment
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory:
+            _, old = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old.raw_data)
+
+    def stats(self) -> Dict[str, int | float]:
+        with self.lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.disk_hits) / total if total else 0.,
+                "files": len(self.files),
+                "bytes": self.bytes,
+                "memory_bytes": self.memory_bytes,
+            }
+
+
+class CachedSynthesizer(Synthesizer):
+    """A synthesizer behind a SpeechCache, text that is already cached or being synthesized is not synthesized again.
+    Every caller gets a future of its own, cancelling it only gives up on the backend job once nobody else waits for it"""
+    def __init__(self, synthesizer: Synthesizer, cache: SpeechCache):
+        self.synthesizer = synthesizer
+        self.cache = cache
+        self.name = synthesizer.name
+        self.voice = synthesizer.voice
+        self.rate = synthesizer.rate
+        self.lock = Lock()
+        self.pending: Dict[str, Tuple[Future, List[Future]]] = {}  # key -> backend job and the callers waiting for it
+
+    def submit(self, text: str) -> Future:
+        text = normalize(text)
+        key = self.cache.key(text, self.name, self.voice, self.rate)
+        future = Future()
+        segment = self.cache.get(key)
+        if segment is not None:
+            future.set_result(segment)
+            return future
+        with self.lock:
+            job = self.pending.get(key)
+            started = job is None
+            if started:
+                job = self.pending[key] = (self.synthesizer.submit(text), [])
+            job[1].append(future)
+        future.add_done_callback(lambda future: self._cancelled(key, future))
+        if started:
+            job[0].add_done_callback(lambda job: self._done(key, job))
+        return future
+
+    def _cancelled(self, key: str, future: Future):
+        if not future.cancelled():
+            return
+        with self.lock:
+            job = self.pending.get(key)
+            if job is None or future not in job[1]:
+                return
+            job[1].remove(future)
+            if job[1]:
+                return
+        job[0].cancel()  # nobody waits any more, drop it unless it is already running
+
+    def _done(self, key: str, job: Future):
+        with self.lock:
+            _, waiting = self.pending.pop(key, (None, []))
+        if job.cancelled():
+            for future in waiting:
+                future.cancel()
+            return
+        error = job.exception()
+        if error is None:
+            self.cache.put(key, job.result())
+        for future in waiting:
+            if future.set_running_or_notify_cancel():
+                if error is None:
+                    future.set_result(job.result())
+                else:
+                    future.set_exception(error)
+
+    def close(self):
+        self.synthesizer.close()
+        self.cache.flush()
+
+_default: Synthesizer | None = None
+_default_lock = Lock()
+
+def default_synthesizer() -> Synthesizer:
+    """The shared backend, MEMETTS_SYNTH picks one by name, otherwise the best one for this platform.
+    It is cached in MEMETTS_SPEECH_CACHE (speech.cache by default, empty turns it off) of up to MEMETTS_SPEECH_CACHE_MB"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            name = os.getenv("MEMETTS_SYNTH")
+            if name is None:
+                if sys.platform == "win32":
+                    name = "powershell"
+                elif shutil.which("espeak-ng") or shutil.which("espeak"):
+                    name = "espeak"
+                else:
+                    name = "pyttsx3"
+            _default = BACKENDS[name]()
+            cache = os.getenv("MEMETTS_SPEECH_CACHE", SPEECH_CACHE)
+            if cache:
+                _default = CachedSynthesizer(_default, SpeechCache(cache, int(os.getenv("MEMETTS_SPEECH_CACHE_MB", 512)) * 1024 * 1024))
+        return _default
+
+
+def group(words: Iterable[str], data: Dict) -> Generator[Tuple[str, bool], None, None]:
+    "(word, True) for every meme, consecutive plain text joined into one (text, False) so it is synthesized in one call"
+    pending: List[str] = []
+    for word in words:
+        if word in data:
+            if pending:
+                yield "".join(pending), False
+                pending = []
+            yield word, True
+        else:
+            pending.append(word)
+    if pending:
+        yield "".join(pending), False
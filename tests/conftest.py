@@ -0,0 +1,25 @@
+"""The modules live at the top of the repo, not in a package. wav() writes small clips pydub can read without ffmpeg"""
+from pathlib import Path
+import struct
+import sys
+import wave
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def write_wav(path: Path, frames: int = 800, value: int = 1000, frame_rate: int = 8000, channels: int = 1) -> Path:
+    "A 16 bit clip of frames samples all at value"
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(frame_rate)
+        f.writeframes(struct.pack("<h", value) * frames * channels)
+    return path
+
+
+@pytest.fixture
+def wav(tmp_path):
+    def make(name: str, frames: int = 800, value: int = 1000, **kwargs) -> Path:
+        return write_wav(tmp_path / name, frames, value, **kwargs)
+    return make
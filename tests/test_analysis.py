@@ -0,0 +1,19 @@
+"""One clip that can not be decoded must not cost the analysis of the others"""
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("pydub")
+from analysis import Analysis
+
+
+def test_update_skips_bad_files(wav, tmp_path):
+    good = wav("good.wav")
+    bad = tmp_path / "bad.wav"
+    bad.write_bytes(b"RIFF not really")
+    analysis = Analysis(tmp_path / "x.analysis")
+    assert analysis.update([good, bad, tmp_path / "missing.wav"], workers=2) == 1
+    assert sorted(analysis.failed) == [str(bad), str(tmp_path / "missing.wav")]
+    analysis.save()
+    saved = Analysis(tmp_path / "x.analysis")
+    assert saved.get(good)["duration"] == .1 and saved.get(bad) is None
+    assert saved.update([good]) == 0 and not saved.failed
@@ -0,0 +1,151 @@
+"""Clip cache, audio bank and player, on wav files and NullSink so no sound card or ffmpeg is needed"""
+import os
+import pytest
+
+pytest.importorskip("pydub")
+from audio import ClipCache
+
+
+def touch(path, seconds: float = 1.):
+    "Move path's mtime forward, a rewrite within the same clock tick would look unchanged"
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + int(seconds * 1e9)))
+
+
+def test_clip_cache_hits_and_staleness(wav):
+    path = wav("a.wav", value=1000)
+    cache = ClipCache()
+    first = cache.get(path)
+    assert cache.get(path) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    wav("a.wav", value=-1000)
+    touch(path)
+    second = cache.get(path)
+    assert second is not first and second.raw_data != first.raw_data
+    assert (cache.hits, cache.misses, len(cache)) == (1, 2, 1)
+    assert cache.bytes == len(second.raw_data)
+
+
+def test_clip_cache_evicts_least_recently_used(wav):
+    paths = [wav("%d.wav" % i) for i in range(3)]
+    size = 800 * 2
+    cache = ClipCache(max_bytes=2 * size)
+    cache.get(paths[0])
+    cache.get(paths[1])
+    cache.get(paths[0])  # 1 is now the oldest
+    cache.get(paths[2])
+    assert str(paths[0]) in cache and str(paths[2]) in cache and str(paths[1]) not in cache
+    assert (cache.evictions, cache.bytes) == (1, 2 * size)
+    cache.resize(size)
+    assert list(cache.clips) == [str(paths[2])] and cache.evictions == 2
+
+
+def test_clip_cache_skips_clips_over_budget(wav):
+    cache = ClipCache(max_bytes=100)
+    clip = cache.get(wav("big.wav"))
+    assert len(clip.raw_data) == 1600
+    assert len(cache) == 0 and cache.bytes == 0
+
+
+def test_audio_bank_staleness_and_fallback(wav, tmp_path):
+    from audio import AudioBank
+    a, b = wav("a.wav", value=1000), wav("b.wav", value=2000)
+    bank = AudioBank.build(tmp_path / "x.bank", [a, b], frame_rate=8000, channels=1, sample_width=2, workers=2)
+    assert len(bank) == 2 and a in bank
+    assert bytes(bank.view(a)) == bank.clip(a).raw_data == ClipCache().get(a).raw_data
+    cache = ClipCache()
+    assert cache.use_bank(tmp_path / "x.bank")
+    assert cache.get(b).raw_data == bytes(bank.view(b)) and cache.bank_hits == 1
+    wav("b.wav", value=-2000)
+    touch(b)
+    assert bank.view(b) is None  # changed since the bank was built
+    assert cache.get(b).raw_data == ClipCache().get(b).raw_data and (cache.bank_hits, cache.misses) == (1, 1)
+    c = wav("c.wav")
+    assert bank.view(c) is None and c not in bank
+    assert len(cache.get(c).raw_data) == 1600 and cache.misses == 2
+    os.remove(a)
+    assert bank.view(a) is None
+    assert not cache.use_bank(tmp_path / "missing.bank")
+
+
+def test_ring_buffer_wraps_and_unblocks():
+    from threading import Thread
+    from audio import RingBuffer
+    ring = RingBuffer(8)
+    assert ring.write(b"abcdef") == 6 and ring.read(4) == b"abcd"
+    assert ring.write(b"ghijkl") == 6 and len(ring) == 8
+    assert ring.read(8) + ring.read(8) == b"efghijkl"
+    ring.write(b"12345678")
+    results = []
+    writer = Thread(target=lambda: results.append(ring.write(b"xyz")))
+    writer.start()
+    writer.join(.1)
+    assert writer.is_alive()  # full, waiting for room
+    assert ring.clear() == 8
+    writer.join(1)
+    assert results == [0] and len(ring) == 0
+    writer = Thread(target=lambda: results.append(ring.write(b"x" * 20)))
+    writer.start()
+    writer.join(.1)
+    ring.close()
+    writer.join(1)
+    assert results == [0, 8] and ring.read(100, timeout=0) == b"x" * 8 and ring.read(100) == b""
+
+
+def player_with(sink, **kwargs):
+    from audio import Player
+    return Player(sink, frame_rate=8000, channels=1, sample_width=2, **kwargs)
+
+
+def test_player_plays_in_order_and_clears():
+    from audio import NullSink
+    sink = NullSink()
+    player = player_with(sink)
+    heard = []
+    for i in range(3):
+        player.write(b"\0" * 1600, mark=lambda t, idle, i=i: heard.append(i))
+    assert player.wait(2) and player.idle()
+    assert heard == [0, 1, 2] and sink.bytes == player.played == player.queued == 4800
+    slow = player_with(NullSink(realtime=True), buffer_seconds=.5)
+    slow.write(b"\0" * 4000)
+    slow.clear()
+    assert slow.wait(2) and slow.played < 4000 and slow.played == slow.queued
+    slow.close()
+    player.close()
+
+
+def test_player_survives_bad_marks_and_stops_on_bad_sink():
+    from threading import Thread
+    from audio import NullSink
+
+    class Broken(NullSink):
+        def write(self, data):
+            if self.bytes >= 400:
+                raise OSError("device unplugged")
+            super().write(data)
+
+    player = player_with(Broken(), buffer_seconds=.1, block_frames=100)
+    heard = []
+    player.write(b"\0" * 200, mark=lambda t, idle: 1 / 0)
+    player.write(b"\0" * 200, mark=lambda t, idle: heard.append(t))
+    writer = Thread(target=player.write, args=(b"\0" * 16000,))
+    writer.start()
+    writer.join(2)
+    assert not writer.is_alive() and player.wait(2)
+    assert isinstance(player.error, OSError) and player.ring.closed and not player.thread.is_alive()
+    assert len(heard) == 1  # the failing mark did not stop the next one
+
+
+def test_player_falls_back_without_output_device(monkeypatch):
+    import audio
+
+    class NoDevice:
+        def __init__(self):
+            raise OSError("no default output device")
+
+    opened = []
+    monkeypatch.setattr(audio, "PyAudioSink", lambda: opened.append(1) or NoDevice())
+    monkeypatch.setattr(audio, "_player", None)
+    monkeypatch.setattr(audio, "_no_player", False)
+    assert audio.player() is None and audio.player() is None
+    assert opened == [1]  # not retried on every segment
@@ -0,0 +1,50 @@
+"""History compacts, then drops the oldest turns to stay under budget, and never the system prompt or the last turns"""
+from history import History, estimate
+
+
+def test_estimate():
+    assert estimate("") == 0
+    assert estimate("哈" * 10) == 6 and estimate("a" * 10) == 3 and estimate("哈a") == 1
+
+
+def test_history_budget():
+    history = History("sys", budget=100, keep=2, compact_chars=10)
+    for i in range(4):
+        history.add("user", "哈" * 50)  # 34 tokens
+        history.add("assistant", "%d" % i + "a" * 39)  # 16 tokens
+    assert history.tokens() == 5 + 4 * 50
+    messages, stats = history.request()
+    # both older turns were shortened first, that was not enough so they went, the last two stay even over budget
+    assert (stats["turns"], stats["compacted"], stats["dropped"], stats["tokens"]) == (2, 0, 2, 105)
+    assert messages[0] == {"role": "system", "content": "sys"} and len(messages) == 5
+    assert [m["content"][0] for m in messages[1:]] == ["哈", "2", "哈", "3"] and len(messages[1]["content"]) == 50
+
+    history.add("user", "哈" * 50)
+    messages, stats = history.request()
+    assert (stats["turns"], stats["compacted"], stats["dropped"]) == (2, 0, 3)
+    history.budget = 1000
+    history.add("assistant", "a" * 40)
+    history.add("user", "a" * 100)  # 34 tokens
+    messages, stats = history.request()
+    assert stats["turns"] == 3 and stats["tokens"] == 5 + 50 + 50 + 34
+
+
+def test_history_compacts_before_dropping():
+    history = History("sys", budget=150, keep=1, compact_chars=10)
+    for i in range(3):
+        history.add("user", "哈" * 50)
+        history.add("assistant", "a" * 40)
+    messages, stats = history.request()
+    # the first turn shrinks to 11 + 8 tokens, that is enough
+    assert (stats["turns"], stats["compacted"], stats["dropped"], stats["tokens"]) == (3, 1, 0, 5 + 19 + 50 + 50)
+    assert messages[1]["content"] == "哈" * 10 + "…" and messages[2]["content"] == "a" * 10 + "…"
+
+
+def test_history_learns_from_usage():
+    history = History("sys", budget=100)
+    history.add("user", "a" * 40)
+    _, stats = history.request()
+    assert stats["estimated"] == 5 + 16
+    history.usage(42)  # the endpoint counted twice as many
+    assert history.scale == 1.5 and history.tokens() == 32 and history.sent[-1]["reported"] == 42
+    History("").usage(10)  # nothing sent yet
@@ -0,0 +1,63 @@
+"""The lexicon manifest is used as long as nothing it was built from changed, and rebuilt as soon as something did"""
+import json
+import os
+import pytest
+import _utils
+from utils import load_cached
+
+
+@pytest.fixture
+def audios(tmp_path):
+    dir = tmp_path / "audios"
+    (dir / "sub").mkdir(parents=True)
+    for name in ["哈基米.wav", "sub/保熟.mp3", "notes.txt"]:
+        (dir / name).write_bytes(b"x")
+    (tmp_path / "name.json").write_text(json.dumps({"保熟": ["保熟", "包熟"]}, ensure_ascii=False), encoding="utf8")
+    return dir
+
+
+def bump(path):
+    "Move path's mtime forward so the change shows even within one clock tick"
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def no_load(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("rebuilt from a fresh manifest")
+    monkeypatch.setattr(_utils, "load", fail)
+
+
+def test_manifest_is_reused(audios, monkeypatch):
+    map = audios.parent / "name.json"
+    data, matcher = load_cached(audios, map)
+    assert sorted(data) == ["保熟", "包熟", "哈基米"]
+    assert len(list(audios.parent.glob("audios.*.lexicon"))) == 1
+    no_load(monkeypatch)
+    cached, matcher = load_cached(audios, map)
+    assert cached == data and list(matcher.split("包熟哈基米")) == ["包熟", "哈基米"]
+
+
+def test_manifest_rebuilds_on_changes(audios, monkeypatch):
+    map = audios.parent / "name.json"
+    load_cached(audios, map)
+    (audios / "sub" / "新.wav").write_bytes(b"x")
+    bump(audios / "sub")
+    assert "新" in load_cached(audios, map)[0]
+    map.write_text(json.dumps({"新": "新的"}, ensure_ascii=False), encoding="utf8")
+    data, _ = load_cached(audios, map)
+    assert "新的" in data and "包熟" not in data
+    os.remove(audios / "哈基米.wav")
+    bump(audios)
+    assert "哈基米" not in load_cached(audios, map)[0]
+
+
+def test_manifest_per_settings_and_corrupt(audios):
+    map = audios.parent / "name.json"
+    load_cached(audios, map)
+    assert sorted(load_cached(audios, map, suffixs=[".wav"])[0]) == ["哈基米"]
+    caches = sorted(audios.parent.glob("audios.*.lexicon"))
+    assert len(caches) == 2
+    for cache in caches:
+        cache.write_bytes(b"not a pickle")
+    assert sorted(load_cached(audios, map)[0]) == ["保熟", "包熟", "哈基米"]
@@ -0,0 +1,41 @@
+"""finish runs on the audio thread, it must neither wait for the log or the hooks nor die with them"""
+import json
+import threading
+import time
+from metrics import Metrics
+
+
+def record(i: int) -> dict:
+    return {"id": i, "text": "哈", "meme": True, "started": 1., "ready": 1.5, "queued": 2., "audible": 2.25}
+
+
+def test_finish_hands_log_and_hooks_to_a_writer(tmp_path):
+    metrics = Metrics()
+    metrics.enable(tmp_path / "metrics.jsonl")
+    seen = []
+
+    def slow(rec):
+        time.sleep(.2)
+        seen.append((rec["id"], threading.current_thread()))
+
+    metrics.hook(lambda rec: 1 / 0)
+    metrics.hook(slow)
+    t = time.perf_counter()
+    for i in range(3):
+        metrics.finish(record(i))
+    assert time.perf_counter() - t < .1
+    assert metrics.snapshot()["decode"]["count"] == 3  # histograms are updated right away
+    metrics.flush()
+    assert [i for i, _ in seen] == [0, 1, 2] and all(thread is not threading.current_thread() for _, thread in seen)
+    metrics.disable()
+    with open(tmp_path / "metrics.jsonl", encoding="utf8") as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["id"] for line in lines] == [0, 1, 2]
+    assert lines[0]["decode"] == .5 and lines[0]["device_start"] == .25 and "time" in lines[0]
+
+
+def test_finish_without_log_or_hooks_starts_no_thread():
+    metrics = Metrics()
+    metrics.enable()
+    metrics.finish(record(0))
+    assert metrics.writer is None and metrics.snapshot()["device_start"]["count"] == 1
@@ -0,0 +1,43 @@
+"""Batch rendering on the fake synthesizer, one worker process"""
+import json
+import os
+import pytest
+
+pytest.importorskip("pydub")
+from render import batch
+
+
+def run(tmp_path, jobs):
+    path = tmp_path / "jobs.jsonl"
+    path.write_text("\n".join(job if isinstance(job, str) else json.dumps(job, ensure_ascii=False) for job in jobs), encoding="utf8")
+    summary = batch(path, tmp_path / "out", processes=1, dir=str(tmp_path / "audios"), map=None, bank=str(tmp_path / "no.bank"),
+                    synth="fake", normalizer=None, analysis=str(tmp_path / "no.analysis"), threads=2)
+    with open(tmp_path / "out" / "results.jsonl", encoding="utf8") as f:
+        return summary, [json.loads(line) for line in f]
+
+
+def test_batch_records_bad_lines_and_resumes(tmp_path, wav):
+    (tmp_path / "audios").mkdir()
+    wav("audios/哈基米.wav")
+    format = {"frame_rate": 8000, "channels": 1}
+    jobs = [
+        {"id": "a", "text": "哈基米你好", "options": format},
+        {"id": 2, "text": "你好哈基米", "options": format},
+        "{not json",
+        {"text": "no id"},
+        {"id": "a", "text": "same id again"},
+        {"id": "../escape", "text": "哈基米"},
+    ]
+    summary, results = run(tmp_path, jobs)
+    assert (summary["jobs"], summary["skipped"], summary["failed"], summary["invalid"]) == (3, 0, 1, 3)
+    ok = {result["id"]: result for result in results if result["ok"]}
+    assert sorted(ok, key=str) == [2, "a"] and os.path.exists(ok["a"]["output"])
+    assert sorted(result["error"] for result in results if result.get("line")) == ["duplicate id", "no id", "not JSON: Expecting property name enclosed in double quotes: line 1 column 2 (char 1)"]
+    assert not (tmp_path / "escape.wav").exists()
+    os.remove(ok[2]["output"])
+    # a is done, 2 lost its file, b is new, c finished in an earlier run of another job file and is not counted
+    with open(tmp_path / "out" / "results.jsonl", "a", encoding="utf8") as f:
+        f.write(json.dumps({"id": "c", "ok": True, "output": ok["a"]["output"]}) + "\n")
+    summary, results = run(tmp_path, jobs[:2] + [{"id": "b", "text": "哈基米", "options": format}])
+    assert (summary["jobs"], summary["skipped"], summary["failed"], summary["invalid"]) == (2, 1, 0, 0)
+    assert sorted(str(result["id"]) for result in results[-2:]) == ["2", "b"]
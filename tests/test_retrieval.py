@@ -0,0 +1,30 @@
+"""MemeIndex ranks by shared grams and falls back on the last hits and the most aliased memes, never on nothing"""
+from retrieval import MemeIndex, grams
+
+DATA = {
+    "哈基米": "audios/哈基米.mp3", "哈基": "audios/哈基米.mp3", "hjm": "audios/哈基米.mp3",
+    "保熟": "audios/保熟.mp3", "包熟": "audios/保熟.mp3",
+    "牛逼": "audios/牛逼.mp3",
+}
+
+
+def test_grams():
+    assert grams("abc") == ["a", "b", "c", "ab", "bc"] and grams("") == []
+
+
+def test_search_ranks_hits():
+    index = MemeIndex(DATA, fold=str.casefold)
+    assert len(index) == 3 and index.popular == ["哈基米", "保熟", "牛逼"]
+    assert index.search("这瓜包熟吗", k=1) == ["保熟"]
+    assert index.search("HJM 牛逼", k=2)[0] == "牛逼"  # 牛逼 has fewer grams, each shared one weighs more
+    assert index.search("你好", k=1, context=["哈基米"]) == ["哈基米"]
+
+
+def test_search_falls_back():
+    index = MemeIndex(DATA)
+    assert index.search("今天天气", k=5) == ["哈基米", "保熟", "牛逼"]  # nothing seen yet, the most aliased
+    assert index.search("这瓜保熟吗", k=2) == ["保熟", "哈基米"]  # topped up
+    assert index.last == ["保熟"]
+    assert index.search("今天天气", k=2) == ["保熟", "哈基米"]  # the previous turn's hits first
+    assert index.last == ["保熟"]
+    assert MemeIndex({}).search("哈") == []
@@ -0,0 +1,188 @@
+"""Every fast segmentation path against the naive one it replaced, on random texts made of few characters so words
+overlap all the time. Batch paths are checked against utils.split (brute force leftmost-longest), streaming paths
+against split_stream without a matcher (the original streaming semantics, which differ from batch on overlaps)"""
+from pathlib import Path
+import random
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import _utils
+import corpus
+from utils import split, ACAutomaton, CompactTrie, Normalizer, PTrie, StreamSplitter, TEXT
+
+ALPHABET = "abcAB 草操艹"
+NORMALIZER = Normalizer(equivalents=["操草艹"])
+
+
+def random_words(rng: random.Random, count: int = 6, alphabet: str = ALPHABET):
+    words = {"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(count)}
+    return sorted(word for word in words if word.strip())
+
+
+def random_text(rng: random.Random, length: int = 16, alphabet: str = ALPHABET + "x"):
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, length)))
+
+
+def random_chunks(rng: random.Random, text: str):
+    chunks = []
+    i = 0
+    while i < len(text):
+        k = rng.randint(1, 5)
+        chunks.append(text[i:i + k])
+        i += k
+    return chunks
+
+
+def naive(text: str, words, normalizer: Normalizer | None = None):
+    "utils.split on the folded text, mapped back onto text"
+    if normalizer is None:
+        return list(split(text, set(words)))
+    folded, offsets = normalizer.map(text)
+    segments = split(folded, {normalizer(word) for word in words})
+    return list(normalizer.restore(text, offsets, segments)) if folded else ([text] if text else [])
+
+
+def naive_stream(text: str, words, normalizer: Normalizer | None = None):
+    if normalizer is None:
+        return list(_utils.split_stream(text, words))
+    folded, offsets = normalizer.map(text)
+    segments = _utils.split_stream(folded, [normalizer(word) for word in words])
+    return list(normalizer.restore(text, offsets, segments)) if folded else ([text] if text else [])
+
+
+def stream(splitter: StreamSplitter, chunks):
+    out = []
+    for chunk in chunks:
+        out += splitter.feed(chunk)
+    return out + splitter.flush()
+
+
+def from_spans(text: str, spans):
+    return [text[spans[i]:spans[i + 1]] for i in range(0, len(spans), 3)]
+
+
+def test_overlapping_words():
+    words = ["哈基", "哈基米", "米哈", "基米哈基"]
+    assert naive("哈基米哈基", words) == ["哈基米", "哈基"]
+    assert list(ACAutomaton(words).split("哈基米哈基")) == ["哈基米", "哈基"]
+    words = ["ab", "bc", "abc", "c", "cab"]
+    for text in ["abcbc", "cabc", "xabcabx", "bcab"]:
+        assert list(ACAutomaton(words).split(text)) == naive(text, words)
+        assert list(_utils.split(text, words)) == naive(text, words)
+
+
+def test_batch_matches_naive():
+    rng = random.Random(1)
+    for _ in range(2000):
+        words, text = random_words(rng), random_text(rng)
+        expected = naive(text, words)
+        matcher = ACAutomaton(words)
+        assert list(matcher.split(text)) == expected
+        assert list(_utils.split(text, words)) == expected
+        assert list(_utils.split(text, words, PTrie(words))) == expected
+        assert list(_utils.split(text, words, CompactTrie(words))) == expected
+        spans = matcher.split_spans(text)
+        assert from_spans(text, spans) == expected
+        assert all((spans[i + 2] == TEXT) == (text[spans[i]:spans[i + 1]] not in words) for i in range(0, len(spans), 3))
+
+
+def test_normalizer_offsets():
+    words = ["操你", "ab c", "草c"]
+    matcher = ACAutomaton(words, NORMALIZER)
+    for text in ["艹你ＡＢ  Ｃ", "  AB\tc草C  ", "ＡＢ", "x　草ｃ  "]:
+        segments = list(matcher.split(text))
+        assert "".join(segments) == text
+        assert segments == naive(text, words, NORMALIZER)
+        assert from_spans(text, matcher.split_spans(text)) == segments
+    rng = random.Random(2)
+    for _ in range(2000):
+        words, text = random_words(rng), random_text(rng, alphabet=ALPHABET + "xＡｂ　\t")
+        matcher = ACAutomaton(words, NORMALIZER)
+        segments = list(matcher.split(text))
+        assert "".join(segments) == text
+        assert segments == naive(text, words, NORMALIZER)
+        assert from_spans(text, matcher.split_spans(text)) == segments
+
+
+def test_whitespace_between_latin_words_is_kept():
+    words = ["wc", "man", "哈基米", "ab c"]
+    matcher = ACAutomaton(words, NORMALIZER)
+    for text in ["a new car", "I am an  apple", "a NEW\tcar"]:
+        assert "".join(matcher.split(text)) == text and all(segment.strip() not in words for segment in matcher.split(text))
+        assert stream(StreamSplitter(words, ptrie=matcher), list(text)) == [text]
+    assert list(matcher.split("哈 基\t米 ab  C")) == ["哈 基\t米", " ab  C"]
+    assert NORMALIZER("Ａ  Ｂ 操 c") == "a b 操c" and NORMALIZER.map("  c", "b") == (" c", [0, 2])
+
+
+def test_stream_chunk_boundaries():
+    rng = random.Random(3)
+    for _ in range(2000):
+        words, text = random_words(rng), random_text(rng)
+        chunks = random_chunks(rng, text)
+        expected = naive_stream(text, words)
+        assert stream(StreamSplitter(words), chunks) == expected
+        assert stream(StreamSplitter(words), [text]) == expected
+        assert list(_utils.split_stream(chunks, words, ptrie=ACAutomaton(words))) == expected
+        matcher = ACAutomaton(words, NORMALIZER)
+        assert stream(StreamSplitter(words, ptrie=matcher), chunks) == naive_stream(text, words, NORMALIZER)
+
+
+def test_automaton_add_remove():
+    rng = random.Random(4)
+    for _ in range(300):
+        words = random_words(rng)
+        matcher = ACAutomaton(words)
+        current = set(words)
+        for _ in range(8):
+            word = rng.choice(random_words(rng, 1) or ["a"])
+            edited = matcher.copy()
+            if word in current and rng.random() < .6:
+                edited.remove(word)
+                current.discard(word)
+            else:
+                edited.add(word)
+                current.add(word)
+            fresh = ACAutomaton(current)
+            assert edited.words == fresh.words
+            for _ in range(5):
+                text = random_text(rng)
+                assert list(edited.split(text)) == list(fresh.split(text)) == naive(text, current)
+                assert edited.longest(text) == fresh.longest(text)
+            matcher = edited
+
+
+def test_compact_trie(tmp_path):
+    rng = random.Random(5)
+    for _ in range(300):
+        words = random_words(rng)
+        compact = CompactTrie(words)
+        assert sorted(compact) == sorted(words) and len(compact) == len(set(words))
+        for _ in range(10):
+            text = random_text(rng, 6) or "x"
+            assert (text in compact) == (text in words)
+            assert compact.is_prefix(text) == any(word.startswith(text) for word in words)
+            assert compact.longest(text) == max((word for word in words if text.startswith(word)), key=len, default=None)
+            assert compact.longest(text) == PTrie(words).longest(text)
+    compact.save(tmp_path / "trie")
+    loaded = CompactTrie.load(tmp_path / "trie")
+    assert sorted(loaded) == sorted(compact)
+    assert all(loaded.longest(word + "x") == compact.longest(word + "x") for word in words)
+
+
+def test_corpus_stitching(tmp_path):
+    rng = random.Random(6)
+    for normalizer in (None, NORMALIZER):
+        for _ in range(40):
+            words = random_words(rng)
+            text = random_text(rng, 600)
+            matcher = ACAutomaton(words, normalizer)
+            expected = list(matcher.split(text))
+            assert expected == naive(text, words, normalizer)
+            # the smallest chunks corpus allows, so many words cross a chunk boundary
+            assert list(corpus.split(text, words, matcher, processes=1, chunk_size=1)) == expected
+            spans = list(corpus.spans(text, matcher, processes=1, chunk_size=1))
+            assert [value for span in spans for value in span] == list(matcher.split_spans(text))
+        path = tmp_path / "corpus.txt"
+        path.write_bytes(text.encode("utf8"))
+        assert list(corpus.split(path, words, matcher, processes=1, chunk_size=1)) == expected
+    assert list(corpus.split(text, words, matcher, processes=2, chunk_size=1)) == expected
@@ -0,0 +1,132 @@
+"""Server routing, bad requests and a stream, in process on the fake synthesizer"""
+import asyncio
+import json
+from concurrent.futures import Future
+import pytest
+
+pytest.importorskip("pydub")
+import server
+from server import Server, WebSocket
+from synth import FakeSynthesizer
+from utils import Lexicon
+
+
+class Cancelling(FakeSynthesizer):
+    "Text containing 炸 comes back cancelled, as when the cache gives up on it"
+    def submit(self, text):
+        if "炸" in text:
+            future = Future()
+            future.cancel()
+            return future
+        return super().submit(text)
+
+
+@pytest.fixture
+def app(wav, tmp_path):
+    (tmp_path / "audios").mkdir()
+    wav("audios/哈基米.wav")
+    lexicon = Lexicon(tmp_path / "audios", normalizer=None)
+    synthesizer = Cancelling(frame_rate=8000)
+    yield Server(lexicon, synthesizer, workers=2, frame_rate=8000, channels=1, log=False)
+    synthesizer.close()
+
+
+def run(app: Server, client):
+    async def main():
+        handlers = []
+
+        async def handle(reader, writer):
+            handlers.append(asyncio.current_task())
+            await app.handle(reader, writer)
+
+        listener = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        async with listener:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            try:
+                return await asyncio.wait_for(client(reader, writer), 10)
+            finally:
+                writer.close()
+                await asyncio.wait_for(asyncio.gather(*handlers), 5)  # the server side saw the close too
+    return asyncio.run(main())
+
+
+async def request(reader, writer, method, path, body=b"", headers=()):
+    head = ["%s %s HTTP/1.1" % (method, path), "Host: test", "Content-Length: %d" % len(body)] + list(headers)
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin1") + body)
+    status = int((await reader.readline()).split()[1])
+    response = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin1").partition(":")
+        response[name.strip().lower()] = value.strip()
+    payload = await reader.readexactly(int(response["content-length"]))
+    return status, response, payload
+
+
+def test_routes_and_bad_requests(app):
+    async def client(reader, writer):
+        results = []
+        for method, path, body, headers in [
+            ("GET", "/health", b"", ()),
+            ("POST", "/health", b"", ()),
+            ("GET", "/nope", b"", ()),
+            ("POST", "/segment", "你好哈基米".encode("utf8"), ()),
+            ("POST", "/segment", b"{bad", ("Content-Type: application/json",)),
+            ("POST", "/segment", b'{"txt": "x"}', ("Content-Type: application/json",)),
+            ("POST", "/segment", b"\xff", ()),
+            ("POST", "/render", b'{"text": "x", "frame_rate": 1}', ("Content-Type: application/json",)),
+            ("POST", "/render", "哈基米".encode("utf8"), ()),
+            ("GET", "/metrics", b"", ()),
+        ]:  # all on one keep-alive connection
+            results.append(await request(reader, writer, method, path, body, headers))
+        return results
+
+    results = run(app, client)
+    assert [status for status, _, _ in results] == [200, 405, 404, 200, 400, 400, 400, 400, 200, 200]
+    assert json.loads(results[0][2])["words"] == 1 and results[1][1]["allow"] == "GET"
+    segments = json.loads(results[3][2])
+    assert [(s["text"], s["clip"] is not None) for s in segments] == [("你好", False), ("哈基米", True)]
+    assert results[8][1]["content-type"] == "audio/wav" and results[8][2][:4] == b"RIFF"
+    endpoints = json.loads(results[9][2])["endpoints"]
+    assert (endpoints["segment"]["requests"], endpoints["segment"]["errors"]) == (4, 3)
+
+
+def test_body_too_large(app):
+    async def client(reader, writer):
+        status, headers, payload = await request(reader, writer, "POST", "/segment", headers=("Content-Length: %d" % (server.MAX_BODY + 1),))
+        return status, headers, payload, await reader.read()
+
+    status, headers, payload, rest = run(app, client)
+    assert status == 413 and headers["connection"] == "close" and "body" in json.loads(payload)["error"]
+    assert rest == b""  # closed
+
+
+def test_stream_reports_failed_segments(app):
+    async def client(reader, writer):
+        writer.write(b"GET /stream HTTP/1.1\r\nHost: test\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+        head = await reader.readuntil(b"\r\n\r\n")
+        assert head.startswith(b"HTTP/1.1 101") and b"s3pPLMBiTxaQ9kYGzzhZRbK+xOo=" in head
+        ws = WebSocket(reader, writer, client=True)
+        messages = [json.loads(await ws.receive())]
+        for chunk in ["你好哈基", "米炸", "再见", ""]:
+            await ws.send(chunk)
+        while True:
+            message = await ws.receive()
+            if isinstance(message, bytes):
+                messages.append(len(message))
+                continue
+            messages.append(json.loads(message))
+            if messages[-1]["type"] == "done":
+                break
+        await ws.close()
+        return messages
+
+    messages = run(app, client)
+    assert messages[0] == {"type": "format", "frame_rate": 8000, "channels": 1, "sample_width": 2}
+    kinds = [(m["type"], m.get("text")) if isinstance(m, dict) else "pcm" for m in messages[1:]]
+    assert kinds == [("segment", "你好"), "pcm", ("segment", "哈基米"), "pcm", ("error", "炸再见"), ("done", None)]
+    assert "cancelled" in messages[-2]["error"]
@@ -0,0 +1,67 @@
+"""Speech cache and the cached synthesizer on the fake backend"""
+import os
+import pytest
+
+pydub = pytest.importorskip("pydub")
+from synth import CachedSynthesizer, FakeSynthesizer, SpeechCache
+
+FILE = 44 + 1600  # a 100 ms wav at 8 kHz mono
+
+
+def segment(value: int = 0) -> "pydub.AudioSegment":
+    return pydub.AudioSegment(data=value.to_bytes(2, "little", signed=True) * 800, sample_width=2, frame_rate=8000, channels=1)
+
+
+def test_key_normalization():
+    key = SpeechCache.key("ＡＢ  c\n", "fake", None, None)
+    assert key == SpeechCache.key("AB c", "fake", None, None)
+    assert key != SpeechCache.key("ab c", "fake", None, None)
+    assert len({key, SpeechCache.key("AB c", "espeak", None, None), SpeechCache.key("AB c", "fake", "zh", None),
+                SpeechCache.key("AB c", "fake", None, 200)}) == 4
+
+
+def test_memory_lru(tmp_path):
+    cache = SpeechCache(tmp_path, max_memory=2 * 1600)
+    for key in "ab":
+        cache.put(key, segment())
+    assert cache.get("a") is not None  # b is now the oldest
+    cache.put("c", segment())
+    assert list(cache.memory) == ["a", "c"] and cache.memory_bytes == 3200
+    cache.flush()
+    assert cache.get("b").raw_data == segment().raw_data and cache.disk_hits == 1
+    assert cache.get("x") is None and cache.stats()["misses"] == 1
+
+
+def test_disk_budget_counts_other_processes(tmp_path):
+    cache = SpeechCache(tmp_path, max_bytes=2 * FILE + 10)
+    cache.put("mine", segment(1))
+    cache.flush()
+    other = SpeechCache(tmp_path)  # another process sharing the directory
+    for i, key in enumerate(["old", "older"]):
+        other.put(key, segment())
+        other.flush()
+        os.utime(other.path(key), (1000 - i, 1000 - i))
+    assert cache.bytes == FILE  # it has not looked yet
+    cache.put("new", segment(2))
+    cache.flush()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["mine.wav", "new.wav"]
+    assert (cache.evictions, cache.bytes, list(cache.files)) == (2, 2 * FILE, ["mine", "new"])
+    restarted = SpeechCache(tmp_path, max_memory=0)
+    assert restarted.get("new").raw_data == segment(2).raw_data and restarted.disk_hits == 1
+
+
+def test_cached_synthesizer_shares_jobs_not_futures(tmp_path):
+    engine = FakeSynthesizer(frame_rate=8000, delay=.1)
+    synth = CachedSynthesizer(engine, SpeechCache(tmp_path))
+    busy = synth.submit("慢")  # keeps the worker busy while the rest queue up
+    a, b = synth.submit("你好"), synth.submit(" 你好\n")
+    assert a is not b and synth.submit("你好　").cancel()
+    assert a.cancel() and not b.cancelled()
+    assert len(b.result(5)) == 160 and engine.calls == ["慢", "你好"]
+    c = synth.submit("再见")
+    assert c.cancel()  # the only caller, the backend job goes too
+    assert synth.submit("完").result(5) and engine.calls == ["慢", "你好", "完"]
+    assert busy.done() and not synth.pending
+    synth.close()
+    assert sorted(path.stem for path in tmp_path.iterdir()) == sorted(synth.cache.key(text, "fake", None, None) for text in ["慢", "你好", "完"])
+    assert synth.submit("你好").result() and engine.calls == ["慢", "你好", "完"]
@@ -0,0 +1,90 @@
+"""Speakers on a NullSink player and the fake synthesizer, one segment failing must not take the rest with it"""
+import asyncio
+import pytest
+
+pytest.importorskip("pydub")
+from audio import NullSink, Player
+from synth import FakeSynthesizer
+from tts import AsyncSpeaker
+
+SPEECH = 2 * 8000 * 80 // 1000  # bytes of one character of fake speech at 8 kHz mono
+CLIP = 1600
+
+
+class Flaky(FakeSynthesizer):
+    "Fails on every text containing 炸"
+    def _synthesize(self, text):
+        if "炸" in text:
+            raise RuntimeError("engine crashed")
+        return super()._synthesize(text)
+
+
+@pytest.fixture
+def setup(wav, tmp_path):
+    data = {"哈基米": wav("哈基米.wav"), "坏": tmp_path / "missing.wav"}
+    player = Player(NullSink(), frame_rate=8000, channels=1, sample_width=2)
+    yield data, player, Flaky()
+    player.close()
+
+
+def test_async_speaker_skips_failed_segments(setup):
+    data, player, engine = setup
+
+    async def main():
+        speaker = AsyncSpeaker(data, engine=engine, audio_player=player)
+        await speaker.feed("你好哈基米炸坏再见")
+        await asyncio.wait_for(speaker.flush(), 5)
+        await asyncio.wait_for(speaker.wait(), 5)
+        first = player.queued
+        await speaker.feed("哈基米")
+        await asyncio.wait_for(speaker.flush(), 5)
+        await speaker.close()
+        return first
+
+    first = asyncio.run(main())
+    assert engine.calls == ["你好", "再见"]  # 炸 raised before it was recorded
+    assert first == 2 * SPEECH + CLIP + 2 * SPEECH
+    assert player.queued == first + CLIP
+
+
+def test_async_speaker_close_resolves_flush(setup):
+    data, player, engine = setup
+    engine.delay = .2
+
+    async def main():
+        speaker = AsyncSpeaker(data, engine=engine, audio_player=player)
+        await speaker.feed("你好")
+        flush = asyncio.create_task(speaker.flush())
+        await asyncio.sleep(.05)
+        await speaker.close()
+        await asyncio.wait_for(flush, 1)
+
+    asyncio.run(main())
+
+
+def test_player_drops_stale_epochs(setup):
+    _, player, _ = setup
+    epoch = player.epoch
+    player.write(b"\0" * 100, epoch=epoch)
+    player.clear()
+    assert player.epoch != epoch
+    player.write(b"\0" * 100, mark=lambda t, idle: None, epoch=epoch)  # handed over before the barge-in
+    assert player.wait(1) and player.queued == player.played and not player.marks
+    player.write(b"\0" * 100, epoch=player.epoch)
+    assert player.wait(1) and player.played == player.queued >= 100
+
+
+@pytest.mark.parametrize("lookahead", [0, 2])
+def test_speaker_skips_failed_segments(setup, monkeypatch, lookahead):
+    import tts
+    data, player, engine = setup
+    monkeypatch.setattr(tts, "player", lambda: player)
+    monkeypatch.setattr(tts, "play", player.play)
+    speaker = tts.Speaker(data, engine=engine, lookahead=lookahead)
+    speaker.speak("你好哈基米炸坏再见", sep=True)
+    speaker.speak("哈基米炸", sep=True)
+    speaker.speak("哈基米", sep=True)
+    speaker.stop()
+    speaker.speak_thread.join(5)
+    assert not speaker.speak_thread.is_alive()
+    assert player.wait(1) and player.queued == 2 * SPEECH + CLIP + 2 * SPEECH + 2 * CLIP
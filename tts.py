@@ -1,53 +1,337 @@
-import pyttsx3
-from queue import Queue
-from utils import load, split_stream, speak
-from threading import Thread
-import os
-
-class Speaker:
-    def __init__(self, data, engine: pyttsx3.Engine, sep = None):
-        if type(data) == str:
-            self.data = load(data)
-        else:
-            self.data = data
-        self.engine = engine
-        self.speak_thread = None
-        self.queue = Queue()
-        self.sep = object() if sep is None else sep
-        self.stop_sign = object()
-    
-    def speak(self, text: str, sep = False):
-        self.queue.put(text)
-        if sep:
-            self.queue.put(self.sep)
-        if self.speak_thread is None or not self.speak_thread.is_alive():
-            self.speak_thread = Thread(target = self._speak)
-            self.speak_thread.daemon = True
-            self.speak_thread.start()
-    
-    def finish(self):
-        self.queue.put(self.sep)
-    
-    def stop(self):
-        self.queue.put(self.stop_sign)
-
-    def _speak(self):
-        for i in split_stream(self._get(), self.data, sep=self.sep):
-            speak(i, data=self.data)
-
-    def _get(self):
-        while True:
-            data = self.queue.get()
-            if data is self.stop_sign:
-                break
-            else:
-                yield data
-
-
-
-# if __name__ == '__main__':
-
-#     speaker = Speaker(load("./audios", "./name.json"), pyttsx3.init(), sep="\n")
-#     while True:
-#         speaker.speak(input(">>> ") + "\n")
-
+from typing import Dict, List
+from queue import Queue
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from utils import load_cached, split_stream, ACAutomaton, StreamSplitter, Lexicon
+from threading import Thread
+from synth import Synthesizer, default_synthesizer
+from audio import Player, clips, player, play
+from metrics import metrics, Tracer
+import asyncio
+import time
+import sys
+import os
+
+class Speaker:
+    "data is a dict, the path of an audios dir or a Lexicon, with a Lexicon every utterance is split with the version current when it starts"
+    def __init__(self, data, engine: Synthesizer | None = None, sep = None, ptrie: ACAutomaton | None = None, lookahead: int = 0):
+        self.lexicon = data if isinstance(data, Lexicon) else None
+        if self.lexicon is not None:
+            self.version, self.data, ptrie = self.lexicon.current()
+        elif type(data) == str:
+            self.data, ptrie = load_cached(data)
+        else:
+            self.data = data
+        self.matcher = ptrie if ptrie is not None else ACAutomaton(self.data)
+        self.engine = engine if engine is not None else default_synthesizer()
+        self.speak_thread = None
+        self.stopped = False
+        self.queue = Queue()
+        self.sep = object() if sep is None else sep
+        self.stop_sign = object()
+        # with lookahead > 0 up to that many upcoming segments are decoded / synthesized while one plays
+        self.lookahead = lookahead
+        self.gaps: deque[float] = deque(maxlen=1000)  # seconds of silence before each segment that was ready in time to avoid it
+        self.tracer = Tracer(sep)
+    
+    def speak(self, text: str, sep = False):
+        t = time.perf_counter() if metrics.enabled else None
+        self.queue.put((text, t))
+        if sep:
+            self.queue.put((self.sep, t))
+        if self.speak_thread is None or not self.speak_thread.is_alive():
+            self.stopped = False
+            self.speak_thread = Thread(target = self._speak)
+            self.speak_thread.daemon = True
+            self.speak_thread.start()
+    
+    def finish(self):
+        self.queue.put((self.sep, time.perf_counter() if metrics.enabled else None))
+    
+    def stop(self):
+        self.queue.put(self.stop_sign)
+
+    def _speak(self):
+        segments = self._segments()
+        if not self.lookahead:
+            for word, path in segments:
+                record = self.tracer.segment(word, path is not None)
+                try:
+                    clip = self._load(word, path, record)
+                    if clip is not None:
+                        play(clip, self.tracer.mark(record))
+                except Exception as e:
+                    print("segment %r failed: %r" % (word, e), file=sys.stderr)
+            return
+        ready: Queue = Queue(self.lookahead)
+        playback = Thread(target=self._playback, args=(ready,), daemon=True)
+        playback.start()
+        with ThreadPoolExecutor(max_workers=self.lookahead) as executor:
+            for word, path in segments:
+                record = self.tracer.segment(word, path is not None)
+                if path is not None:
+                    future = executor.submit(self._load, word, path, record)
+                elif word.strip():
+                    future = self.engine.submit(word)
+                    if record is not None:
+                        # includes the time spent waiting behind earlier text on the synthesizer
+                        record["started"] = time.perf_counter()
+                        future.add_done_callback(lambda _, record=record: record.__setitem__("ready", time.perf_counter()))
+                else:
+                    continue
+                ready.put((future, time.perf_counter(), record))  # blocks once lookahead segments are waiting
+            ready.put(None)
+            playback.join()
+
+    def _playback(self, ready: Queue):
+        "Plays prefetched segments strictly in the order they were split"
+        p = player()
+        ended = None  # when the previous segment finished, only known for blocking playback
+        while True:
+            item = ready.get()
+            if item is None:
+                break
+            future, submitted, record = item
+            try:
+                self._play_ready(p, future.result(), submitted, record, ended)
+            except Exception as e:
+                # a failed or cancelled decode or synthesis loses that segment, this thread has to keep draining ready
+                print("segment failed: %r" % e, file=sys.stderr)
+                continue
+            if p is None:
+                ended = time.perf_counter()
+
+    def _play_ready(self, p, clip, submitted: float, record: Dict | None, ended: float | None):
+        "Hand one prefetched clip to the player, or play it blocking without one, and note the gap before it"
+        now = time.perf_counter()
+        if p is None:
+            if ended is not None and submitted <= ended:
+                self.gaps.append(now - ended)
+            mark = self.tracer.mark(record)
+            if mark is not None:
+                mark(now, None)
+            import pydub.playback
+            pydub.playback.play(clip)
+        else:
+            # the player only goes silent in between if it ran dry before this segment was ready
+            if p.idle() and submitted <= p.drained_at:
+                self.gaps.append(now - p.drained_at)
+            elif not p.idle():
+                self.gaps.append(0.)
+            p.play(clip, self.tracer.mark(record))
+
+    def _segments(self):
+        "(segment, clip path or None) until stop, every utterance split with the lexicon version current when it starts"
+        while not self.stopped:
+            text = self._get()
+            first = next(text, None)  # the utterance starts with its first chunk, not when the last one ended
+            if first is None:
+                continue
+            if self.lexicon is not None:
+                self.version, self.data, self.matcher = self.lexicon.current()
+            data = self.data
+            for word in split_stream(chain([first], text), data, sep=self.sep, ptrie=self.matcher):
+                yield word, data.get(word)
+
+    def _load(self, word: str, path = None, record: Dict | None = None):
+        "Clip or speech for a segment, None for blank text"
+        if record is not None:
+            record["started"] = time.perf_counter()
+        if path is not None:
+            clip = clips.get(path)
+        elif word.strip():
+            clip = self.engine.synthesize(word)
+        else:
+            return None
+        if record is not None:
+            record["ready"] = time.perf_counter()
+        return clip
+
+    def gap_stats(self) -> Dict[str, float]:
+        "Silence between consecutive segments, in seconds"
+        gaps = list(self.gaps)
+        if not gaps:
+            return {"count": 0, "mean": 0., "max": 0.}
+        return {"count": len(gaps), "mean": sum(gaps) / len(gaps), "max": max(gaps)}
+
+    def _get(self):
+        "Queued text up to the end of the utterance"
+        while True:
+            data = self.queue.get()
+            if data is self.stop_sign:
+                self.stopped = True
+                return
+            data, t = data
+            if t is not None:
+                if data is self.sep:
+                    self.tracer.end()
+                else:
+                    self.tracer.feed(data, t)
+            yield data
+            if data is self.sep:
+                return
+
+
+class AsyncSpeaker:
+    """Speaker for asyncio: feed/flush wait when the bounded queues are full, so a fast stream can not
+    buffer unbounded text, and cancel() silences the current clip and drops everything pending.
+    With a Lexicon a reload is picked up at the next utterance, the current one keeps the version it started with"""
+    def __init__(self, data, engine: Synthesizer | None = None, sep = None, ptrie: ACAutomaton | None = None,
+                 audio_player: Player | None = None, max_chunks: int = 64, max_segments: int = 4):
+        self.lexicon = data if isinstance(data, Lexicon) else None
+        self.version = None
+        if self.lexicon is not None:
+            self.version, self.data, ptrie = self.lexicon.current()
+        elif type(data) == str:
+            self.data, ptrie = load_cached(data)
+        else:
+            self.data = data
+        self.matcher = ptrie if ptrie is not None else ACAutomaton(self.data)
+        self.engine = engine if engine is not None else default_synthesizer()
+        self.player = audio_player if audio_player is not None else player()
+        self.sep = sep
+        self.splitter = StreamSplitter(self.data, sep=sep, ptrie=self.matcher)
+        self.chunks: asyncio.Queue = asyncio.Queue(max_chunks)
+        self.segments: asyncio.Queue = asyncio.Queue(max_segments)
+        self.generation = 0  # bumped by cancel, anything tagged with an older one is dropped
+        self.tasks: List[asyncio.Task] = []
+        self.flushes: set = set()  # futures of flush calls still waiting, close resolves them
+        self.tracer = Tracer(sep)
+
+    def _start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._segment()), asyncio.create_task(self._play())]
+
+    async def feed(self, chunk: str):
+        "Queue a chunk of text, waits while the speaker is too far behind"
+        self._start()
+        await self.chunks.put((self.generation, chunk, time.perf_counter() if metrics.enabled else None))
+
+    async def flush(self):
+        "End the utterance, returns once all of it has been handed to the player"
+        self._start()
+        done = asyncio.get_running_loop().create_future()
+        self.flushes.add(done)
+        try:
+            await self.chunks.put((self.generation, done, None))
+            await done
+        finally:
+            self.flushes.discard(done)
+
+    async def wait(self):
+        "Wait until everything handed to the player has been heard"
+        if self.player is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.player.wait)
+
+    def cancel(self):
+        "Barge in, stop the current clip and drop pending text and segments"
+        self.generation += 1
+        for queue in (self.chunks, self.segments):
+            while not queue.empty():
+                item = queue.get_nowait()[1]
+                if isinstance(item, asyncio.Future) and not item.done():
+                    item.set_result(None)
+        self.splitter.flush()  # throw away the half-segmented buffer
+        self._refresh()
+        self.tracer.reset()
+        if self.player is not None:
+            self.player.clear()
+
+    async def close(self):
+        self.cancel()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for done in self.flushes:
+            if not done.done():
+                done.set_result(None)  # dropped by a task that was cancelled mid-way
+
+    def _refresh(self):
+        "Switch to the newest lexicon, only called in between utterances"
+        if self.lexicon is None:
+            return
+        version, data, matcher = self.lexicon.current()
+        if version != self.version:
+            self.version, self.data, self.matcher = version, data, matcher
+            self.splitter = StreamSplitter(data, sep=self.sep, ptrie=matcher)
+
+    async def _segment(self):
+        while True:
+            generation, chunk, t = await self.chunks.get()
+            if generation != self.generation:
+                if isinstance(chunk, asyncio.Future) and not chunk.done():
+                    chunk.set_result(None)
+                continue
+            data = self.data
+            if isinstance(chunk, asyncio.Future):
+                words = self.splitter.flush()
+                self.tracer.end()
+                self._refresh()
+            else:
+                if t is not None:
+                    self.tracer.feed(chunk, t)
+                words = self.splitter.feed(chunk)
+            for word in words:
+                if generation != self.generation:
+                    break  # cancelled while waiting for room
+                path = data.get(word)
+                await self.segments.put((generation, word, path, self.tracer.segment(word, path is not None)))
+            if isinstance(chunk, asyncio.Future):
+                await self.segments.put((generation, chunk, None, None))
+
+    async def _play(self):
+        while True:
+            generation, word, path, record = await self.segments.get()
+            if isinstance(word, asyncio.Future):
+                if not word.done():
+                    word.set_result(None)
+                continue
+            if generation != self.generation:
+                continue
+            try:
+                await self._play_segment(generation, word, path, record)
+            except Exception as e:
+                # a missing clip or a failed synthesis loses that segment, not the rest of the stream
+                print("segment %r failed: %r" % (word, e), file=sys.stderr)
+
+    async def _play_segment(self, generation: int, word: str, path, record: Dict | None):
+        loop = asyncio.get_running_loop()
+        if record is not None:
+            record["started"] = time.perf_counter()
+        if path is not None:
+            clip = await loop.run_in_executor(None, clips.get, path)
+        elif word.strip():
+            future = asyncio.wrap_future(self.engine.submit(word))
+            try:
+                await asyncio.wait([future])  # unlike await future, a job cancelled by someone else does not cancel this task
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            if future.cancelled():
+                raise RuntimeError("speech was cancelled")
+            clip = future.result()
+        else:
+            return
+        if generation != self.generation:
+            return
+        if record is not None:
+            record["ready"] = time.perf_counter()
+        mark = self.tracer.mark(record)
+        if self.player is not None:
+            # the epoch is read here, a cancel after this point drops the clip even if play has not started yet
+            await loop.run_in_executor(None, self.player.play, clip, mark, self.player.epoch)
+        else:
+            if mark is not None:
+                mark(time.perf_counter(), None)
+            import pydub.playback
+            await loop.run_in_executor(None, pydub.playback.play, clip)
+
+
+# if __name__ == '__main__':
+
+#     speaker = Speaker(load("./audios", "./name.json"), sep="\n")
+#     while True:
+#         speaker.speak(input(">>> ") + "\n")
+
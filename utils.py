@@ -6,8 +6,16 @@ split = _utils._split # Violent matching is usually faster
 _split = _utils.split
 split_stream = _utils.split_stream # more accurate
 _split_stream = _utils._split_stream # faster
+StreamSplitter = _utils.StreamSplitter # split_stream as an object, feed(chunk) / flush()
 PTrie = _utils.PTrie
+CompactTrie = _utils.CompactTrie # smaller, can be saved to a file
+ACAutomaton = _utils.ACAutomaton # linear time, same result as split
 load = _utils.load
+load_cached = _utils.load_cached # load() and ACAutomaton, cached on disk
+Normalizer = _utils.Normalizer # folds case, width, whitespace and look-alike characters before matching
+FoldedDict = _utils.FoldedDict
+TEXT = _utils.TEXT # clip id of plain text in ACAutomaton.split_spans
+Lexicon = _utils.Lexicon # load_cached() that reloads when the audios, the map or the normalizer change
 main = _utils.main
 stream_test = _utils.stream_test
 speak = _utils.speak
\ No newline at end of file
@@ -1,11 +1,11 @@
-from utils import load, split
+from utils import Lexicon, split
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from threading import Thread, Lock
-import pyttsx3
-import pydub
-import pydub.playback
+from audio import clips, ANALYSIS, BANK
+from synth import default_synthesizer, group
+from mixer import Mixer
 from pathlib import Path
 import sys
 
@@ -24,13 +24,14 @@ class MainWindow(QWidget):
         self.setPalette(palette)
         self.setAutoFillBackground(True)
         self.dir = dir
-        self.data = load(dir / "audios", dir / "name.json")
-        self.engine = pyttsx3.init()
+        self.lexicon = Lexicon(dir / "audios", dir / "name.json", normalizer=dir / "normalize.json").watch()
+        _, data, _ = self.lexicon.current()
+        clips.use_analysis(dir / ANALYSIS)
+        if not clips.use_bank(dir / BANK):
+            clips.warm(data.values(), wait=False)
+        self.synthesizer = default_synthesizer()
         self.speaking = Lock()
-        self.playing = True
-        self.play_obj = None
-        self.music_vol = -15
-        self.voice_vol = 5
+        self.mixer = Mixer(music_db=-15, voice_db=5)
 
         self.layout1 = QVBoxLayout()
         self.layout2 = QHBoxLayout()
@@ -71,37 +72,27 @@ class MainWindow(QWidget):
         t.start()
     
     def set_music_vol(self, value):
-        self.music_vol = value
-        if self.play_obj:
-            self.play_obj.stop()
-
+        self.mixer.music_db = value
     
     def set_voice_vol(self, value):
-        self.voice_vol = value
+        self.mixer.voice_db = value
     
     def _play(self):
-        while self.playing:
-            obj = pydub.AudioSegment.from_file(self.dir / "岁月无声DJ.mp3")
-            obj += self.music_vol
-            self.play_obj = pydub.playback._play_with_simpleaudio(obj)
-            self.play_obj.wait_done()
+        self.mixer.set_music(clips.get(self.dir / "岁月无声DJ.mp3"))
 
     def _stop(self):
-        self.playing = False
-        if self.play_obj:
-            self.play_obj.stop()
+        self.mixer.stop_music()
 
     def _speak_(self, text: str):
         with self.speaking:
-            words = split(text, self.data)
-            for word in words:
-                if word in self.data:
-                    obj = pydub.AudioSegment.from_file(self.data[word])
-                    obj += self.voice_vol
-                    pydub.playback.play(obj)
-                else:
-                    self.engine.say(word)
-                    self.engine.runAndWait()
+            _, data, matcher = self.lexicon.current()
+            words = split(text, data, ptrie=matcher)
+            for word, is_meme in group(words, data):
+                if is_meme:
+                    self.mixer.play(clips.get(data[word]))
+                elif word.strip():
+                    self.mixer.play(self.synthesizer.synthesize(word))
+            self.mixer.wait()
     
     def send_message(self) -> None:
         t = Thread(target=self._speak_, args=(self.input.text(),))